@@ -0,0 +1,1045 @@
+"""Бенчмарки горячих путей бота.
+
+Запуск: python benchmark.py [имя ...]
+Без аргументов выполняются все бенчмарки. Работает на временной базе,
+боевой scam_bot.db не трогается.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('METRICS_PORT', '0')
+os.chdir(tempfile.mkdtemp(prefix='scam_bot_bench_'))
+
+import bot  # noqa: E402
+import httpx  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+
+bot.logger.setLevel(logging.WARNING)
+
+
+def report(name: str, ops: int, elapsed: float):
+    print(f"{name:<48} {ops / elapsed:>14,.0f} ops/s  {elapsed * 1e6 / ops:>10.2f} мкс/op")
+
+
+def fresh_database(name: str) -> bot.Database:
+    path = os.path.join(os.getcwd(), name)
+    if os.path.exists(path):
+        os.remove(path)
+    return bot.Database(path)
+
+
+def remove_database_files(path: str):
+    """Удалить файлы закрытой базы бенчмарка вместе с WAL"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# ==================== ПУЛ СОЕДИНЕНИЙ ====================
+
+SCAM_LOOKUP_SQL = 'SELECT COUNT(*) FROM scam_list WHERE username = ? AND status = "active"'
+
+def bench_connection_pool(n: int = 5000):
+    database = fresh_database('pool.db')
+    for i in range(200):
+        database.add_to_scam_list({'username': f'user{i}', 'reason': 'bench', 'proofs': ''})
+
+    def legacy_count() -> int:
+        # Старая схема: connect + PRAGMA + запрос + close на каждый вызов
+        conn = sqlite3.connect(database.db_path, timeout=5)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute(SCAM_LOOKUP_SQL, ('user7',))
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    start = time.perf_counter()
+    for _ in range(n):
+        legacy_count()
+    report('поиск в scam_list: connect на запрос', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        database._scalar(SCAM_LOOKUP_SQL, ('user7',))
+    report('поиск в scam_list: пул соединений', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        database.is_user_in_scam_list('@User7')
+    report('is_user_in_scam_list: индекс в памяти', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        database.get_scam_list_page()
+    report('get_scam_list_page: пул соединений', n, time.perf_counter() - start)
+    database.pool.close_all()
+
+
+# ==================== ИНДЕКСЫ ====================
+
+def fill_tables(database: bot.Database, rows: int):
+    """Заполняет основные таблицы синтетическими данными (~1% записей в ожидании)"""
+    statuses = ['pending' if i % 100 == 0 else 'approved' for i in range(rows)]
+    with database.pool.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO white_list (user_id, username, activity, created_at, status) '
+            'VALUES (?, ?, ?, datetime("now", ?), ?)',
+            ((i, f'white{i}', 'торговля', f'-{i} seconds', 'approved' if i % 10 else 'hidden') for i in range(rows)))
+        conn.executemany(
+            'INSERT INTO scam_list (username, reason, created_at, status) VALUES (?, ?, datetime("now", ?), ?)',
+            ((f'scam{i}', 'кидок', f'-{i} seconds', 'active' if i % 10 else 'removed') for i in range(rows)))
+        for table in ('white_list_applications', 'appeal_applications'):
+            conn.executemany(
+                f'INSERT INTO {table} (user_id, username, status) VALUES (?, ?, ?)',
+                ((i, f'user{i}', statuses[i]) for i in range(rows)))
+        conn.executemany(
+            'INSERT INTO scam_reports (reporter_id, scammer_username, status) VALUES (?, ?, ?)',
+            ((i, f'scam{i}', statuses[i]) for i in range(rows)))
+        conn.executemany(
+            'INSERT INTO info_requests (request_type, request_id, user_id, admin_id, request_text, status) '
+            'VALUES (?, ?, ?, 1, "?", ?)',
+            ((('white', 'scam', 'appeal')[i % 3], i, i % (rows // 4), 'completed' if i % 7 else 'pending')
+             for i in range(rows)))
+
+
+def time_lookups(database: bot.Database, rows: int, label: str, n: int = 2000):
+    lookups = [
+        ('scam_list по username', lambda i: database._scalar(SCAM_LOOKUP_SQL, (f'scam{i % rows}',))),
+        ('get_active_info_request(type)', lambda i: database.get_active_info_request(i % (rows // 4), 'white')),
+        ('get_active_info_request', lambda i: database.get_active_info_request(i % (rows // 4))),
+        ('get_info_request_by_type_id', lambda i: database.get_info_request_by_type_id('scam', i % rows)),
+        ('get_white_list_page()', lambda i: database.get_white_list_page()),
+        ('get_scam_list_page()', lambda i: database.get_scam_list_page()),
+        ('get_pending_reports', lambda i: database.get_pending_reports()),
+    ]
+    for name, lookup in lookups:
+        count = n if label == 'с индексами' else 20
+        start = time.perf_counter()
+        for i in range(count):
+            lookup(i * 7919)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<14} {name:<32} {elapsed * 1e3 / count:>10.3f} мс/запрос")
+
+
+def bench_indexes(rows: int = 100_000):
+    database = fresh_database('indexes.db')
+    fill_tables(database, rows)
+    database.pool.connection().execute('ANALYZE')
+    print(f"{rows:,} строк в каждой таблице, schema_version={database.get_schema_version()}")
+    time_lookups(database, rows, 'с индексами')
+
+    with database.pool.transaction() as conn:
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+            conn.execute(f'DROP INDEX {name}')
+    time_lookups(database, rows, 'без индексов')
+    database.pool.close_all()
+
+
+# ==================== ПАГИНАЦИЯ ====================
+
+def bench_pagination(rows: int = 100_000, n: int = 200):
+    database = fresh_database('pagination.db')
+    fill_tables(database, rows)
+    conn = database.pool.connection()
+    deep_page = rows // 10 // bot.ITEMS_PER_PAGE
+    offset = (deep_page - 1) * bot.ITEMS_PER_PAGE
+    last = conn.execute(
+        'SELECT created_at, id FROM scam_list WHERE status = "active" '
+        'ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?', (offset - 1,)).fetchone()
+
+    start = time.perf_counter()
+    for _ in range(n):
+        conn.execute(
+            'SELECT * FROM scam_list WHERE status = "active" ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?',
+            (bot.ITEMS_PER_PAGE, offset)).fetchall()
+        conn.execute('SELECT COUNT(*) FROM scam_list WHERE status = "active"').fetchone()
+    report(f'страница {deep_page}: OFFSET + COUNT(*)', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        database.get_scam_list_page(after=tuple(last))
+        database.get_scam_list_count()
+    report(f'страница {deep_page}: keyset + счетчик', n, time.perf_counter() - start)
+    database.pool.close_all()
+
+
+# ==================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ====================
+
+class LegacyRateLimiter:
+    """Прежний SecurityManager.is_rate_limited: список меток времени на пользователя"""
+
+    def __init__(self, limit: int = 30):
+        self.user_requests = defaultdict(list)
+        self.blocked_users = set()
+        self.limit = limit
+
+    def is_rate_limited(self, user_id: int, now: float) -> bool:
+        self.user_requests[user_id] = [t for t in self.user_requests[user_id] if now - t < 60]
+        if len(self.user_requests[user_id]) >= self.limit:
+            self.blocked_users.add(user_id)
+            return True
+        self.user_requests[user_id].append(now)
+        return user_id in self.blocked_users
+
+
+def bench_rate_limiter(calls: int = 1_000_000, users: int = 100_000):
+    # Синтетические часы: вызовы равномерно распределены по 10 минутам
+    step = 600 / calls
+    for name, factory, check in (
+        ('прежний список меток', LegacyRateLimiter, lambda limiter, user, now: limiter.is_rate_limited(user, now)),
+        ('GCRA', lambda: bot.RateLimiter(30), lambda limiter, user, now: limiter.hit(user, now)),
+    ):
+        limiter = factory()
+        start = time.perf_counter()
+        for i in range(calls):
+            check(limiter, (i * 7919) % users, i * step)
+        report(f'{name}: {calls:,} вызовов / {users:,} польз.', calls, time.perf_counter() - start)
+
+        # Отдельный прогон под tracemalloc, чтобы он не искажал время
+        limiter = factory()
+        tracemalloc.start()
+        for i in range(calls):
+            check(limiter, (i * 7919) % users, i * step)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'':<48} пик памяти {peak / 1024 / 1024:.1f} МБ")
+
+
+# ==================== ВАЛИДАЦИЯ ВВОДА ====================
+
+RUSSIAN_MESSAGES = [
+    "Привет! Хочу подать заявку в белый список",
+    "Занимаюсь продажей игровых аккаунтов уже третий год, есть отзывы",
+    "Москва",
+    "Санкт-Петербург, Ленинградская область",
+    "Продаю скины и внутриигровую валюту, работаю через гаранта",
+    "Он взял предоплату 5000 рублей и пропал, на сообщения не отвечает",
+    "Меня добавили по ошибке, сделка была закрыта, скриншоты прилагаю",
+    "нет",
+    "Ремонт телефонов и ноутбуков, выезд на дом по городу",
+    "Обмен криптовалюты, USDT/RUB, комиссия 1.5%, сделки от 10 тысяч",
+    "Обманул на сумму 12000, обещал отправить товар после оплаты",
+    "Подскажите, сколько рассматривается заявка?",
+]
+SUSPICIOUS_MESSAGES = [
+    "Пишите в лс @seller_pro",
+    "Мой сайт https://example.com, там все отзывы",
+    "Почта для связи ivan.petrov@mail.ru",
+    "Карта для оплаты 2200700012345678",
+    "Я admin этого чата",
+    "'; DROP TABLE white_list; --",
+    "Сделка была; потом он пропал",
+]
+
+
+def legacy_validate(text: str) -> bool:
+    """Прежний SecurityManager.validate_input: пять re.search и проверка ключевых слов через upper()"""
+    for pattern in (r'http[s]?://', r'@\w+', r'[\w\.-]+@[\w\.-]+', r'[0-9]{16}', r'(?i)admin'):
+        if re.search(pattern, text):
+            return False
+    return not any(keyword in text.upper() for keyword in ['DROP', 'DELETE', 'UPDATE', 'INSERT', '--', ';'])
+
+
+def bench_validator(size: int = 20_000, repeat: int = 5):
+    messages = RUSSIAN_MESSAGES * 9 + SUSPICIOUS_MESSAGES
+    corpus = [f"{messages[i % len(messages)]} {i}" if i % 3 else messages[i % len(messages)] for i in range(size)]
+    validator = bot.InputValidator()
+
+    mismatches = [text for text in corpus if legacy_validate(text) != (validator.scan(text) is None)]
+    print(f"корпус: {size:,} сообщений, {sum(validator.scan(t) is not None for t in corpus):,} отклонено, "
+          f"расхождений с прежней проверкой: {len(mismatches)}")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            legacy_validate(text)
+    report('прежняя проверка (5 regex + upper)', size * repeat, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            validator.scan(text)
+    report('InputValidator: одно регулярное выражение', size * repeat, time.perf_counter() - start)
+
+
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ ====================
+
+def bench_write_behind(n: int = 5000):
+    database = fresh_database('writes.db')
+    insert_user = 'INSERT OR REPLACE INTO bot_users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)'
+
+    start = time.perf_counter()
+    for i in range(n):
+        database._write(insert_user, (i % 1000, 'user', 'Имя', None))
+        database._write('INSERT INTO action_logs (admin_id, action) VALUES (?, ?)', (1, 'start'))
+    report('add_user + log_action: транзакция на строку', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(n):
+        database.add_user(i % 1000, 'user', 'Имя')
+        database.log_action(1, 'start')
+    database.write_buffer.stop()
+    report('add_user + log_action: отложенная запись', n, time.perf_counter() - start)
+    print(f"{'':<48} {database.write_buffer.stats()}")
+    database.pool.close_all()
+
+# ==================== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ====================
+
+def make_update(update_id: int, user_id: int) -> bot.Update:
+    return bot.Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': str(update_id),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+        },
+    }, None)
+
+
+async def drive_processor(processor, updates, latency: float) -> list:
+    """Эмулирует Application: задача на каждое обновление в порядке поступления"""
+    handled = []
+
+    async def handler(update):
+        await asyncio.sleep(latency)  # запрос к Bot API / базе
+        handled.append((update.effective_user.id, update.update_id))
+
+    await asyncio.gather(*(
+        asyncio.create_task(processor.process_update(update, handler(update)))
+        for update in updates
+    ))
+    return handled
+
+
+def bench_concurrent_updates(users: int = 200, per_user: int = 10, latency: float = 0.005):
+    updates = [make_update(i, i % users) for i in range(users * per_user)]
+    for limit in (1, 8, 32, 128):
+        processor = bot.PerUserUpdateProcessor(limit)
+        start = time.perf_counter()
+        handled = asyncio.run(drive_processor(processor, updates, latency))
+        elapsed = time.perf_counter() - start
+
+        last_seen = {}
+        reordered = 0
+        for user_id, update_id in handled:
+            reordered += update_id < last_seen.get(user_id, -1)
+            last_seen[user_id] = update_id
+        report(f'обновления, лимит {limit}', len(updates), elapsed)
+        print(f"{'':<48} пик {processor.peak_in_flight}, нарушений порядка: {reordered}")
+
+# ==================== СОСТОЯНИЕ ДИАЛОГОВ ====================
+
+def bench_persistence(users: int = 50_000, rounds: int = 5):
+    database = fresh_database('persistence.db')
+    persistence = bot.SQLitePersistence(database)
+    asyncio.run(persistence.get_user_data())
+    user_data = {
+        user_id: {
+            'white_application': {'user_id': user_id, 'username': f'user{user_id}', 'activity': 'Продажа аккаунтов'},
+            'last_page': 1,
+        }
+        for user_id in range(users)
+    }
+
+    async def save_all():
+        for user_id, data in user_data.items():
+            await persistence.update_user_data(user_id, data)
+
+    # Периодическое сохранение: меняется один ключ у каждого десятого пользователя
+    start = time.perf_counter()
+    for round_number in range(rounds):
+        for user_id in range(0, users, 10):
+            user_data[user_id]['last_page'] = round_number
+        asyncio.run(save_all())
+        database.write_buffer.flush()
+    report('update_user_data: только изменившиеся ключи', users * rounds, time.perf_counter() - start)
+    print(f"{'':<48} записано ключей: {persistence.written_keys} из {users * 2 * rounds}")
+    database.close()
+
+    database = bot.Database(os.path.join(os.getcwd(), 'persistence.db'))
+    start = time.perf_counter()
+    loaded = asyncio.run(bot.SQLitePersistence(database).get_user_data())
+    elapsed = time.perf_counter() - start
+    print(f"{'теплый старт':<48} {len(loaded):>14,} польз.  {elapsed * 1e3:>10.1f} мс")
+    database.close()
+
+# ==================== МАССОВАЯ МОДЕРАЦИЯ ====================
+
+def add_applications(database: bot.Database, n: int):
+    for i in range(n):
+        database.add_white_list_application({
+            'user_id': i, 'username': f'user{i}', 'activity': 'Продажа аккаунтов',
+            'city': 'Москва', 'link': '', 'description': '', 'proofs': '',
+        })
+
+
+def bench_bulk_moderation(n: int = 1000, batch: int = bot.MAX_BULK_MODERATION):
+    database = fresh_database('moderation_legacy.db')
+    add_applications(database, n)
+    start = time.perf_counter()
+    for application_id in range(1, n + 1):
+        application = database.get_white_list_application_by_id(application_id)
+        database.add_to_white_list(dict(application))
+        database.update_application_status(application_id, 'approved')
+        database.log_action(1, 'approved_white', application['user_id'], f"#{application_id}")
+    database.write_buffer.flush()
+    report('одобрение: 4 вызова и 3 транзакции на заявку', n, time.perf_counter() - start)
+    database.close()
+
+    database = fresh_database('moderation_bulk.db')
+    add_applications(database, n)
+    start = time.perf_counter()
+    for first in range(1, n + 1, batch):
+        items = [(application_id, 0) for application_id in range(first, min(first + batch, n + 1))]
+        database.moderate_items('white_list_applications', items, 'approved', 1, 'approved_white')
+    report(f'одобрение: moderate_items по {batch}', n, time.perf_counter() - start)
+    print(f"{'':<48} в белом списке: {database.get_white_list_count()}")
+    database.close()
+
+# ==================== СТАТИСТИКА ====================
+
+NAIVE_STATS_QUERIES = [
+    'SELECT COUNT(*) FROM bot_users',
+    'SELECT COUNT(*) FROM white_list WHERE status = "approved"',
+    'SELECT COUNT(*) FROM scam_list WHERE status = "active"',
+    'SELECT status, COUNT(*) FROM white_list_applications GROUP BY status',
+    'SELECT status, COUNT(*) FROM scam_reports GROUP BY status',
+    'SELECT status, COUNT(*) FROM appeal_applications GROUP BY status',
+    'SELECT COUNT(*) FROM action_logs',
+    'SELECT date(created_at), COUNT(*) FROM bot_users WHERE created_at > date("now", "-7 days") GROUP BY 1',
+]
+
+
+def bench_stats(rows: int = 100_000, n: int = 50):
+    database = fresh_database('stats.db')
+    fill_tables(database, rows)
+    with database.pool.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO bot_users (user_id, username, created_at) VALUES (?, ?, datetime("now", ?))',
+            ((i, f'user{i}', f'-{i} minutes') for i in range(rows)))
+        conn.executemany(
+            'INSERT INTO action_logs (admin_id, action, target_user_id) VALUES (1, "approved_white", ?)',
+            ((i,) for i in range(rows)))
+    conn = database.pool.connection()
+
+    start = time.perf_counter()
+    for _ in range(n):
+        for query in NAIVE_STATS_QUERIES:
+            conn.execute(query).fetchall()
+    report(f'статистика: COUNT(*) по таблицам, {rows:,} строк', n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(n * 20):
+        bot.format_statistics(database.get_stats_snapshot())
+    report('статистика: счетчики и дневные сводки', n * 20, time.perf_counter() - start)
+    database.close()
+
+# ==================== ПОЛНОТЕКСТОВЫЙ ПОИСК ====================
+
+SEARCH_CITIES = ['Москва', 'Санкт-Петербург', 'Казань', 'Новосибирск', 'Екатеринбург', 'Минск', 'Алматы']
+SEARCH_QUERIES = ['user123456', 'user4242', 'продажа аккаунтов', 'гарант москва', 'скин', 'кинул предоплата',
+                  'обмен криптовалюты казань', 'несуществующее слово']
+
+
+def search_vocabulary(size: int = 5000) -> list:
+    """Синтетический словарь: настоящие слова предметной области и случайные псевдослова"""
+    rng = random.Random(1)
+    words = ['продажа', 'аккаунтов', 'гарант', 'обмен', 'криптовалюты', 'скинов', 'предоплата', 'кинул',
+             'доставка', 'ключи', 'игровые', 'предметы', 'услуги', 'дизайн', 'реклама']
+    syllables = ['ка', 'ро', 'ми', 'ту', 'ле', 'на', 'по', 'ви', 'за', 'ст', 'ор', 'ен']
+    while len(words) < size:
+        words.append(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return words
+
+
+def bench_search(rows: int = 500_000, repeat: int = 20):
+    database = fresh_database('search.db')
+    rng = random.Random(2)
+    words = search_vocabulary()
+
+    def phrase(n: int) -> str:
+        return ' '.join(rng.choice(words) for _ in range(n))
+
+    start = time.perf_counter()
+    with database.pool.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO white_list (user_id, username, activity, city, description) VALUES (?, ?, ?, ?, ?)',
+            ((i, f'user{i}', phrase(3), rng.choice(SEARCH_CITIES), phrase(12)) for i in range(rows)))
+        conn.executemany(
+            'INSERT INTO scam_list (username, reason) VALUES (?, ?)',
+            ((f'user{i * 7}', phrase(10)) for i in range(rows)))
+    print(f"{'вставка с триггерами FTS5':<48} {2 * rows:>14,} строк  {time.perf_counter() - start:>10.1f} с")
+    # Одна огромная транзакция оставляет WAL на сотни МБ, в работе его сбрасывают автоматические checkpoint
+    database.pool.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    for text in SEARCH_QUERIES:
+        match = bot.build_search_query(text)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = database.search_lists(match)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        found = len(results['white']) + len(results['scam'])
+        print(f"{'поиск: ' + text:<48} медиана {timings[len(timings) // 2] * 1e3:6.2f} мс, "
+              f"макс {timings[-1] * 1e3:6.2f} мс, найдено {found}")
+    database.close()
+
+
+# ==================== INLINE-КНОПКИ ====================
+
+# Прежняя схема: по CallbackQueryHandler с регулярным выражением на каждый тип кнопки,
+# PTB проверяет их по очереди до первого совпадения
+LEGACY_CALLBACK_PATTERNS = [re.compile(pattern) for pattern in (
+    r'^(white|scam)_(next|prev)_(\d+)_(\d{14})_(\d+)$',
+    r'^modmenu$',
+    r'^mod_(white|scam|appeal)_(pending|approved|rejected)(?:_(\d{14})_(\d+))?$',
+    r'^modview_(white|scam|appeal)_(\d+)$',
+    r'^modset_(white|scam|appeal)_(\d+)_(\d+)_(approved|rejected)$',
+    r'^modproofs_(white|scam|appeal)_(\d+)$',
+    r'^modsel_(white|scam|appeal)_(\d+)_(\d+)$',
+    r'^modbulk_(white|scam|appeal)_(approved|rejected|clear)$',
+)]
+
+
+def legacy_dispatch(data: str, patterns: list):
+    for pattern in patterns:
+        match = pattern.match(data)
+        if match:
+            return pattern, match.groups()
+    return None, None
+
+
+def bench_callbacks(n: int = 200_000, extra_routes: int = 200):
+    legacy = [
+        'white_next_2_20261017021302_1500', 'modmenu', 'mod_scam_pending_20261017021302_99',
+        'modview_appeal_123456', 'modset_white_123456_3_approved', 'modproofs_scam_42',
+        'modsel_white_123456_3', 'modbulk_appeal_clear',
+    ]
+    router = bot.callback_router
+    current = [
+        router.encode('lp', 'white', 'next', 2, '2026-10-17 02:13:02', 1500), router.encode('mm'),
+        router.encode('mp', 'scam', 'pending', '2026-10-17 02:13:02', 99), router.encode('mv', 'appeal', 123456),
+        router.encode('md', 'white', 123456, 3, 'approved'), router.encode('mf', 'scam', 42),
+        router.encode('ms', 'white', 123456, 3), router.encode('mb', 'appeal', 'clear'),
+    ]
+    print(f"размер callback_data: прежний {sum(map(len, legacy)) / len(legacy):.1f} байт, "
+          f"кодек {sum(map(len, current)) / len(current):.1f} байт")
+
+    # Кнопки, которые появятся позже: в прежней схеме каждая добавляет regex в цепочку
+    grown = [re.compile(rf'^action{i}_(white|scam|appeal)_(\d+)$') for i in range(extra_routes)]
+    grown_router = bot.CallbackRouter()
+    grown_router._routes.update(router._routes)
+    for i in range(extra_routes):
+        grown_router.route(f"x{i}", bot.CALLBACK_QUEUE, bot.CALLBACK_INT)(bot.handle_callback)
+
+    for label, patterns, codec in (
+        (f"{len(LEGACY_CALLBACK_PATTERNS)} типов кнопок", LEGACY_CALLBACK_PATTERNS, router),
+        (f"{len(LEGACY_CALLBACK_PATTERNS) + extra_routes} типов кнопок", grown + LEGACY_CALLBACK_PATTERNS, grown_router),
+    ):
+        start = time.perf_counter()
+        for i in range(n):
+            legacy_dispatch(legacy[i % len(legacy)], patterns)
+        report(f'regex-цепочка, {label}', n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for i in range(n):
+            codec.decode(current[i % len(current)])
+        report(f'CallbackRouter.decode, {label}', n, time.perf_counter() - start)
+
+
+# ==================== МЕТРИКИ ====================
+
+def bench_metrics(n: int = 200_000):
+    histogram = bot.Histogram()
+    start = time.perf_counter()
+    for i in range(n):
+        histogram.observe((i % 1000) / 10_000)
+    report('Histogram.observe', n, time.perf_counter() - start)
+
+    async def handler(update, context):
+        pass
+
+    # Без флуд-контроля: сравнивается только цена обертки и замеров
+    wrapped = bot.secure_handler(rate_limit=False)(handler)
+    updates = [make_update(i, i % 1000) for i in range(1000)]
+
+    async def drive(func):
+        start = time.perf_counter()
+        for i in range(n):
+            await func(updates[i % len(updates)], None)
+        return time.perf_counter() - start
+
+    plain = asyncio.run(drive(handler))
+    instrumented = asyncio.run(drive(wrapped))
+    report('обработчик без обертки', n, plain)
+    report('secure_handler + гистограмма + счетчики', n, instrumented)
+    print(f"{'накладные расходы на обновление':<48} {(instrumented - plain) * 1e6 / n:>10.2f} мкс "
+          f"(включая проверку ввода)")
+
+
+# ==================== ОТЛОЖЕННЫЕ ЗАДАЧИ ====================
+
+def bench_jobs(rows: int = 100_000, n: int = 2000):
+    database = fresh_database('bench_jobs.db')
+    try:
+        now = int(time.time())
+        with database.pool.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO info_requests (request_type, request_id, user_id, admin_id, request_text, created_at) '
+                "VALUES ('white', ?, ?, 1, 'q', datetime(?, 'unixepoch'))",
+                [(i, i, now - random.randrange(bot.INFO_REMINDER_DELAY)) for i in range(rows)])
+            conn.execute('''
+                INSERT INTO jobs (kind, key, due_at)
+                SELECT 'info_reminder', id, CAST(strftime('%s', created_at) AS INTEGER) + ?
+                FROM info_requests
+            ''', (bot.INFO_REMINDER_DELAY,))
+
+        # Прежний подход: периодический проход по всем ожидающим запросам
+        start = time.perf_counter()
+        for _ in range(n // 100):
+            [row for row in database._fetchall("SELECT id, created_at FROM info_requests WHERE status = 'pending'")
+                   if bot.sqlite_timestamp(row['created_at']) + bot.INFO_REMINDER_DELAY <= now]
+        report(f'опрос всех запросов ({rows} строк)', n // 100, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(n):
+            database.get_due_jobs(now, 50)
+            database.get_next_job_due()
+        report(f'пробуждение JobScheduler ({rows} задач)', n, time.perf_counter() - start)
+    finally:
+        database.close()
+        remove_database_files(database.db_path)
+
+
+# ==================== ОБСЛУЖИВАНИЕ БАЗЫ ====================
+
+def bench_maintenance(rows: int = 200_000, retention_days: int = 90):
+    database = fresh_database('bench_maintenance.db')
+    async_database = bot.AsyncDatabase(database)
+    archive_dir = 'bench_archive'
+    try:
+        with database.pool.transaction() as conn:
+            for table, column in bot.LOG_TABLES.items():
+                conn.executemany(
+                    f"INSERT INTO {table} (details, {column}) VALUES (?, datetime('now', ?))",
+                    [(f'событие {i} ' * 10, f'-{i % 365} days') for i in range(rows)])
+        maintenance = bot.DatabaseMaintenance(async_database, archive_dir, retention_days)
+        start = time.perf_counter()
+        result = asyncio.run(maintenance.run())
+        elapsed = time.perf_counter() - start
+        archived = sum(result['archived'].values())
+        report(f'архивация логов старше {retention_days} дн.', archived, elapsed)
+        print(bot.format_maintenance_report(result))
+        archive_size = sum(os.path.getsize(os.path.join(archive_dir, name)) for name in os.listdir(archive_dir))
+        print(f"архивы: {bot.format_size(archive_size)} на {archived} строк")
+    finally:
+        # Останавливает пул потоков и закрывает базу
+        async_database.shutdown()
+        remove_database_files(database.db_path)
+        shutil.rmtree(archive_dir, ignore_errors=True)
+
+
+# ==================== НАГРУЗОЧНЫЙ ТЕСТ ====================
+
+STUB_TOKEN = '123456:stub'
+
+
+class StubBotApi:
+    """Заглушка Bot API на bot.HttpServer: отвечает как Telegram и считает вызовы по методам"""
+
+    MESSAGE_METHODS = ('sendMessage', 'editMessageText', 'sendPhoto', 'sendVideo', 'sendDocument', 'sendAudio')
+    TRUE_METHODS = ('answerCallbackQuery', 'answerInlineQuery', 'editMessageReplyMarkup', 'deleteMessage')
+
+    def __init__(self, token: str, latency: float = 0.0):
+        self.token = token
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.message_ids = itertools.count(1000)
+        self.server = bot.HttpServer('127.0.0.1', 0, max_concurrency=10_000)
+        for method in ('getMe', 'sendMediaGroup') + self.MESSAGE_METHODS + self.TRUE_METHODS:
+            self.server.route('POST', f'/bot{token}/{method}', functools.partial(self.handle, method))
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.port}/bot'
+
+    def message(self, params: dict) -> dict:
+        return {
+            'message_id': next(self.message_ids), 'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}, 'text': params.get('text', ''),
+        }
+
+    async def handle(self, method: str, request) -> tuple:
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)  # сеть до api.telegram.org
+        params = {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': True}
+        elif method == 'sendMediaGroup':
+            result = [self.message(params) for _ in json.loads(params.get('media', '[]'))]
+        elif method in self.MESSAGE_METHODS:
+            result = self.message(params)
+        else:
+            result = True
+        return 200, 'application/json', json.dumps({'ok': True, 'result': result}).encode()
+
+
+def user_json(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'}
+
+
+def message_json(user_id: int, text: str) -> dict:
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+            'from': user_json(user_id), 'text': text, 'entities': entities}
+
+
+def callback_json(user_id: int, data: str) -> dict:
+    return {'id': str(user_id), 'from': user_json(user_id), 'chat_instance': '1', 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+                        'text': '...'}}
+
+
+def browsing_session(user_id: int, rows: int) -> list:
+    """Пользователь листает списки и проверяет username"""
+    page = bot.callback_router.encode('lp', 'white', 'next', 2, '2026-01-01 00:00:00', rows)
+    return [
+        ('menu', message_json(user_id, '/start')),
+        ('menu', message_json(user_id, '🟩 Белый список')),
+        ('callback', callback_json(user_id, page)),
+        ('menu', message_json(user_id, '🟥 Список скамеров')),
+        ('check', message_json(user_id, f'/check @scam{user_id % rows}')),
+        ('search', message_json(user_id, f'/search white{user_id % rows}')),
+    ]
+
+
+def application_session(user_id: int) -> list:
+    """Заявка в белый список целиком: process_activity ... finish_white_application"""
+    return [('application', message_json(user_id, text)) for text in (
+        '✉️ Подать заявку в белый список', 'Продажа аккаунтов', 'Москва', 'нет',
+        'Три года на рынке, больше 500 сделок', 'Отзывы в канале', '✅ Готово', '✅ Отправить',
+    )]
+
+
+def admin_session(admin_id: int, application_ids: list) -> list:
+    """Администратор открывает очередь и принимает решения кнопками уведомлений"""
+    session = [
+        ('menu', message_json(admin_id, '📋 Управление заявками')),
+        ('callback', callback_json(admin_id, bot.callback_router.encode('mp', 'white', 'pending'))),
+    ]
+    for application_id in application_ids:
+        session.append(('moderation', callback_json(
+            admin_id, bot.callback_router.encode('ad', 'white', application_id, 'approved'))))
+    return session
+
+
+def flood_session(user_id: int, messages: int) -> list:
+    return [('flood', message_json(user_id, 'ℹ️ О проекте')) for _ in range(messages)]
+
+
+def interleave(sessions: list) -> list:
+    """Сессии пользователей вперемешку, порядок внутри сессии сохраняется"""
+    queues = [list(reversed(session)) for session in sessions if session]
+    traffic = []
+    while queues:
+        index = random.randrange(len(queues))
+        traffic.append(queues[index].pop())
+        if not queues[index]:
+            queues[index] = queues[-1]
+            queues.pop()
+    return traffic
+
+
+def histogram_totals(name: str) -> tuple:
+    """Сумма всех гистограмм семейства: (число наблюдений по корзинам, всего)"""
+    counts = [0] * (len(bot.LATENCY_BUCKETS) + 1)
+    for histogram in bot.metrics.family(name).values():
+        counts = [a + b for a, b in zip(counts, histogram.counts)]
+    return counts
+
+
+def bucket_quantile(counts: list, q: float) -> float:
+    merged = bot.Histogram()
+    merged.counts, merged.count = counts, sum(counts)
+    return merged.quantile(q)
+
+
+class LoadRun:
+    """Подает обновления в update_queue и замеряет время до конца обработки всеми группами"""
+
+    def __init__(self, application):
+        self.application = application
+        self.started = {}
+        self.latencies = defaultdict(list)
+        self.kinds = {}
+        self.errors = 0
+        self.pending = 0
+        self.finished = asyncio.Event()
+        application.add_handler(TypeHandler(bot.Update, self.on_done), group=100)
+        application.add_error_handler(self.on_error)
+
+    async def on_done(self, update, context):
+        self.latencies[self.kinds.pop(update.update_id)].append(
+            time.perf_counter() - self.started.pop(update.update_id))
+        self.pending -= 1
+        if not self.pending:
+            self.finished.set()
+
+    async def on_error(self, update, context):
+        self.errors += 1
+
+    async def play(self, traffic: list, update_ids, rate: float) -> float:
+        self.finished.clear()
+        self.pending += len(traffic)
+        start = time.perf_counter()
+        for i, (kind, payload) in enumerate(traffic):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update_id = next(update_ids)
+            field = 'callback_query' if 'chat_instance' in payload else 'message'
+            update = bot.Update.de_json({'update_id': update_id, field: payload}, self.application.bot)
+            self.kinds[update_id] = kind
+            self.started[update_id] = time.perf_counter()
+            await self.application.update_queue.put(update)
+        await asyncio.wait_for(self.finished.wait(), timeout=300)
+        return time.perf_counter() - start
+
+
+def report_load(label: str, run: LoadRun, elapsed: float, total: int, sql_before: list, calls_before: list,
+                retries_before: int):
+    everything = sorted(latency for latencies in run.latencies.values() for latency in latencies)
+    percentile = lambda values, q: values[min(len(values) - 1, int(len(values) * q))] * 1e3
+    print(f"{label}: {total / elapsed:,.0f} обновлений/с, p50 {percentile(everything, 0.5):.1f} мс, "
+          f"p99 {percentile(everything, 0.99):.1f} мс, ошибок {run.errors}")
+    for kind, latencies in sorted(run.latencies.items()):
+        latencies.sort()
+        print(f"   {kind:<12} {len(latencies):>6} шт.  p50 {percentile(latencies, 0.5):7.1f} мс  "
+              f"p99 {percentile(latencies, 0.99):7.1f} мс")
+    sql = [a - b for a, b in zip(histogram_totals('bot_db_query_duration_seconds'), sql_before)]
+    calls = [a - b for a, b in zip(histogram_totals('bot_db_call_duration_seconds'), calls_before)]
+    # Разница между вызовом через AsyncDatabase и самим SQL - ожидание потока БД и блокировок
+    print(f"   SQLite: {sum(sql):,} запросов, p99 {bucket_quantile(sql, 0.99) * 1e3:g} мс; "
+          f"вызовы AsyncDatabase p99 {bucket_quantile(calls, 0.99) * 1e3:g} мс; "
+          f"повторов после database is locked: {bot.db_lock_retries_total.value - retries_before}")
+    run.latencies.clear()
+
+
+async def drive_load(users: int, rows: int, rate: float, api_latency: float):
+    api = StubBotApi(STUB_TOKEN, latency=api_latency)
+    await api.server.start()
+    application = bot.build_application(STUB_TOKEN, base_url=api.base_url, updater=False)
+    run = LoadRun(application)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    admins = sorted(bot.ADMIN_IDS)
+    pending = bot.db._fetchall(
+        'SELECT id FROM white_list_applications WHERE status = "pending" ORDER BY id LIMIT ?', (20 * len(admins),))
+    pending = [row['id'] for row in pending]
+    update_ids = itertools.count(1)
+    try:
+        for label, first_user, phase_rate in (('равномерно', 10_000_000, rate), ('пачкой', 20_000_000, 0)):
+            sessions = []
+            for i in range(users):
+                user_id = first_user + i
+                if i % 50 == 0:
+                    sessions.append(flood_session(user_id, 60))
+                elif i % 3 == 0:
+                    sessions.append(application_session(user_id))
+                else:
+                    sessions.append(browsing_session(user_id, rows))
+            if label == 'равномерно':
+                sessions += [admin_session(admin, pending[k::len(admins)]) for k, admin in enumerate(admins)]
+            traffic = interleave(sessions)
+
+            sql_before = histogram_totals('bot_db_query_duration_seconds')
+            calls_before = histogram_totals('bot_db_call_duration_seconds')
+            retries_before = bot.db_lock_retries_total.value
+            rejected_before = bot.rate_limited_total.value
+            elapsed = await run.play(traffic, update_ids, phase_rate)
+            title = f"{label} ({phase_rate:g}/с)" if phase_rate else label
+            report_load(title, run, elapsed, len(traffic), sql_before, calls_before, retries_before)
+            print(f"   отклонено флуд-контролем: {bot.rate_limited_total.value - rejected_before}")
+        saved = bot.db._scalar('SELECT COUNT(*) FROM white_list_applications WHERE user_id >= 10000000')
+        print(f"заявок сохранено через диалог: {saved}")
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await api.server.stop()
+    print(f"вызовы Bot API: {dict(sorted(api.calls.items()))}")
+
+
+def bench_load(users: int = 600, rows: int = 20_000, rate: float = 300, api_latency: float = 0.02):
+    """Реальный Application из build_application против заглушки Bot API.
+
+    Запускается последним: on_shutdown закрывает глобальную базу бота.
+    """
+    random.seed(1)
+    # Флуд в сценарии намеренный: предупреждения безопасности и журнал httpx не нужны
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    fill_tables(bot.db, rows)
+    bot.db.load_scam_index()
+    bot.db.load_white_index()
+    asyncio.run(drive_load(users, rows, rate, api_latency))
+
+
+# ==================== WEBHOOK ====================
+
+BENCH_WEBHOOK_SECRET = 'bench-secret'
+
+
+def recorded_updates(path: str) -> list:
+    """Обновления из файла JSON Lines: объект Update в строке, как его отдает getUpdates"""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generated_updates(users: int, rows: int) -> list:
+    sessions = [application_session(30_000_000 + i) if i % 3 == 0 else browsing_session(30_000_000 + i, rows)
+                for i in range(users)]
+    updates = []
+    for update_id, (_, payload) in enumerate(interleave(sessions), 1):
+        field = 'callback_query' if 'chat_instance' in payload else 'message'
+        updates.append({'update_id': update_id, field: payload})
+    return updates
+
+
+async def post_updates(url: str, updates: list, connections: int, receiver, retry_delay: float = 0.05) -> tuple:
+    """POST обновлений как от Telegram: на 503 доставка повторяется после паузы"""
+    statuses = defaultdict(int)
+    peak_backlog = 0
+    queue = iter(updates)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': BENCH_WEBHOOK_SECRET}
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=connections)) as client:
+        async def worker():
+            nonlocal peak_backlog
+            for update in queue:
+                while True:
+                    response = await client.post(url, json=update, headers=headers)
+                    statuses[response.status_code] += 1
+                    peak_backlog = max(peak_backlog, receiver.backlog())
+                    if response.status_code != 503:
+                        break
+                    await asyncio.sleep(retry_delay)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(connections)))
+        elapsed = time.perf_counter() - start
+        rejected = {
+            'без секрета': (await client.post(url, json=updates[0])).status_code,
+            'тело null': (await client.post(url, content=b'null', headers=headers)).status_code,
+            'тело []': (await client.post(url, content=b'[]', headers=headers)).status_code,
+        }
+    return dict(statuses), peak_backlog, elapsed, rejected
+
+
+async def drive_webhook(updates: list, connections: int, max_pending: int, api_latency: float):
+    api = StubBotApi(STUB_TOKEN, latency=api_latency)
+    await api.server.start()
+    application = bot.build_application(STUB_TOKEN, base_url=api.base_url, updater=False)
+    handled = 0
+    done = asyncio.Event()
+
+    async def on_done(update, context):
+        nonlocal handled
+        handled += 1
+        if handled == len(updates):
+            done.set()
+
+    application.add_handler(TypeHandler(bot.Update, on_done), group=100)
+    server, receiver = bot.build_webhook_server(application, '127.0.0.1', 0, BENCH_WEBHOOK_SECRET)
+    receiver.max_pending = max_pending
+    # Без post_init/post_shutdown: глобальная база бота остается открытой для следующих бенчмарков
+    await application.initialize()
+    await application.start()
+    await server.start()
+    try:
+        url = f'http://127.0.0.1:{server.port}{bot.WEBHOOK_PATH}'
+        statuses, peak_backlog, elapsed, rejected = await post_updates(url, updates, connections, receiver)
+        await asyncio.wait_for(done.wait(), timeout=300)
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        await api.server.stop()
+    print(f"принято {len(updates)} обновлений за {elapsed:.1f} с ({len(updates) / elapsed:,.0f}/с), "
+          f"ответы: {statuses}")
+    print(f"пиковое отставание: {peak_backlog} при лимите {max_pending}")
+    print(f"отклоненные запросы: {rejected}")
+
+
+def bench_webhook(users: int = 300, rows: int = 20_000, connections: int = 50,
+                  max_pending: int = bot.WEBHOOK_MAX_PENDING, api_latency: float = 0.02):
+    """POST обновлений в настоящий webhook-сервер бота.
+
+    WEBHOOK_REPLAY=updates.jsonl подставляет записанные обновления вместо сгенерированных.
+    """
+    random.seed(1)
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    replay = os.environ.get('WEBHOOK_REPLAY')
+    updates = recorded_updates(replay) if replay else generated_updates(users, rows)
+    asyncio.run(drive_webhook(updates, connections, max_pending, api_latency))
+
+
+BENCHMARKS = {
+    'pool': bench_connection_pool,
+    'indexes': bench_indexes,
+    'pagination': bench_pagination,
+    'ratelimit': bench_rate_limiter,
+    'validator': bench_validator,
+    'writes': bench_write_behind,
+    'updates': bench_concurrent_updates,
+    'persistence': bench_persistence,
+    'moderation': bench_bulk_moderation,
+    'stats': bench_stats,
+    'search': bench_search,
+    'callbacks': bench_callbacks,
+    'metrics': bench_metrics,
+    'jobs': bench_jobs,
+    'maintenance': bench_maintenance,
+    'webhook': bench_webhook,
+    # Последним: после него глобальная база бота закрыта
+    'load': bench_load,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    parser.add_argument('names', nargs='*', choices=list(BENCHMARKS), metavar='name',
+                        help=f"бенчмарки по порядку, по умолчанию все: {', '.join(BENCHMARKS)}")
+    for name in parser.parse_args(argv).names or BENCHMARKS:
+        print(f"--- {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
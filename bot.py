@@ -1,53 +1,204 @@
 import logging
 import os
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+import bisect
+import functools
+import gzip
+import itertools
+import json
+import secrets
+import signal
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
+    InlineQueryResultArticle, InputTextMessageContent,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, 
-    CallbackQueryHandler, ConversationHandler, ContextTypes
+    CallbackQueryHandler, ConversationHandler, ContextTypes, BaseUpdateProcessor, InlineQueryHandler,
+    BasePersistence, PersistenceInput
 )
 import sqlite3
-from datetime import datetime
-from typing import Dict, List, Set
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Set
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 import re
 
 # ==================== СИСТЕМА БЕЗОПАСНОСТИ ====================
 
+class RateLimiter:
+    """Ограничитель частоты по алгоритму GCRA.
+
+    На пользователя хранится одно число - теоретическое время прибытия (TAT)
+    следующего запроса. Записи упорядочены по последнему обращению, давно
+    неактивные вытесняются с головы словаря, поэтому память ограничена
+    числом пользователей, писавших за последний период.
+    """
+
+    # Вытеснение раз в 1024 вызова
+    EVICT_EVERY_MASK = 1023
+
+    def __init__(self, limit: int, period: float = 60, block_duration: float = 60, max_users: int = 200_000):
+        self.interval = period / limit
+        self.tolerance = period - self.interval
+        self.block_duration = block_duration
+        self.max_users = max_users
+        self._tat: OrderedDict = OrderedDict()
+        self._calls = 0
+        # Блокировки выдаются на одинаковый срок, поэтому порядок вставки = порядок истечения
+        self._blocked_until: OrderedDict = OrderedDict()
+
+    def is_blocked(self, key, now: float = None) -> bool:
+        until = self._blocked_until.get(key)
+        return until is not None and until > (time.monotonic() if now is None else now)
+
+    def hit(self, key, now: float = None) -> bool:
+        """Учитывает запрос, возвращает True если он должен быть отклонен"""
+        if now is None:
+            now = time.monotonic()
+        self._calls += 1
+        if not self._calls & self.EVICT_EVERY_MASK or len(self._tat) > self.max_users:
+            self._evict(now)
+        
+        if self._blocked_until:
+            until = self._blocked_until.get(key)
+            if until is not None:
+                if until > now:
+                    return True
+                del self._blocked_until[key]
+        
+        # pop + вставка переносят ключ в конец порядка вытеснения
+        tat = self._tat.pop(key, now)
+        if tat < now:
+            tat = now
+        if tat - now > self.tolerance:
+            self._tat[key] = tat
+            self._blocked_until[key] = now + self.block_duration
+            return True
+        self._tat[key] = tat + self.interval
+        return False
+
+    def _evict(self, now: float):
+        """Снимает с головы записи с истекшим TAT (они эквивалентны отсутствию записи)"""
+        excess = len(self._tat) - self.max_users
+        stale = []
+        for key, tat in self._tat.items():
+            if tat > now and len(stale) >= excess:
+                break
+            stale.append(key)
+        for key in stale:
+            del self._tat[key]
+        
+        expired = []
+        for key, until in self._blocked_until.items():
+            if until > now:
+                break
+            expired.append(key)
+        for key in expired:
+            del self._blocked_until[key]
+
+    def __len__(self) -> int:
+        return len(self._tat)
+
+class InputValidator:
+    """Проверка текста за один проход: все правила собраны в одно регулярное выражение.
+
+    Выражение начинается с класса возможных первых символов, поэтому движок
+    перескакивает по тексту к кандидатам (обычная кириллица пропускается сразу),
+    а остаток правила проверяется только в этих позициях.
+    """
+
+    SUSPICIOUS = "Обнаружен подозрительный контент"
+    SQL_INJECTION = "Недопустимые символы в сообщении"
+
+    # (правило, первый символ, остаток шаблона, сообщение пользователю).
+    # Шаблоны урезаны до минимального совпадения, достаточного для решения.
+    # Email идет раньше упоминания, чтобы "name@mail.ru" определялось как email
+    RULES = [
+        ('url', r'h', r'ttps?://', SUSPICIOUS),
+        ('email', r'@', r'(?<=[\w\.-]@)[\w\.-]', SUSPICIOUS),
+        ('mention', r'@', r'\w', SUSPICIOUS),
+        ('card_number', r'0-9', r'[0-9]{15}', SUSPICIOUS),
+        ('admin', r'Aa', r'(?i:dmin)', SUSPICIOUS),
+        ('sql_drop', r'Dd', r'(?i:rop)', SQL_INJECTION),
+        ('sql_delete', r'Dd', r'(?i:elete)', SQL_INJECTION),
+        ('sql_update', r'Uu', r'(?i:pdate)', SQL_INJECTION),
+        ('sql_insert', r'Ii', r'(?i:nsert)', SQL_INJECTION),
+        ('sql_comment', r'\-', r'-', SQL_INJECTION),
+        ('sql_separator', r';', r'', SQL_INJECTION),
+    ]
+
+    def __init__(self):
+        first_chars = ''.join(dict.fromkeys(first for _, first, _, _ in self.RULES))
+        branches = '|'.join(f'(?<=[{first}])(?P<{name}>{rest})' for name, first, rest, _ in self.RULES)
+        self.pattern = re.compile(f'[{first_chars}](?:{branches})')
+        self.messages = {name: message for name, _, _, message in self.RULES}
+
+    def scan(self, text: str) -> Optional[str]:
+        """Имя первого (самого левого) сработавшего правила или None"""
+        match = self.pattern.search(text)
+        return match.lastgroup if match else None
+
+class EventSampler:
+    """Схлопывание повторяющихся событий.
+
+    Первое событие с данным ключом проходит сразу, повторы в течение window
+    секунд только подсчитываются. Когда окно истекает, expire() возвращает
+    число подавленных повторов для одной сводной записи.
+    """
+
+    def __init__(self, window: float = 60, max_keys: int = 10_000):
+        self.window = window
+        self.max_keys = max_keys
+        # Окна одинаковой длины: порядок вставки = порядок истечения
+        self._windows: OrderedDict = OrderedDict()
+
+    def offer(self, key, now: float) -> bool:
+        """True - событие нужно записать, False - повтор внутри окна"""
+        window = self._windows.get(key)
+        if window is not None and window[0] > now:
+            window[1] += 1
+            return False
+        self._windows.pop(key, None)
+        self._windows[key] = [now + self.window, 0]
+        return True
+
+    def expire(self, now: float = None) -> List[tuple]:
+        """Закрыть истекшие окна (все при now=None), вернуть [(key, подавлено), ...]"""
+        closed = []
+        while self._windows:
+            key, (expires_at, suppressed) = next(iter(self._windows.items()))
+            if now is not None and expires_at > now and len(self._windows) <= self.max_keys:
+                break
+            del self._windows[key]
+            if suppressed:
+                closed.append((key, suppressed))
+        return closed
+
 class SecurityManager:
     def __init__(self):
-        self.user_requests = defaultdict(list)
-        self.blocked_users = set()
-        self.suspicious_patterns = [
-            r'http[s]?://',  # URL
-            r'@\w+',         # Упоминания
-            r'[\w\.-]+@[\w\.-]+',  # Email
-            r'[0-9]{16}',    # Номера карт
-            r'(?i)admin',    # Админ команды
-        ]
+        self.input_validator = InputValidator()
         self.max_requests_per_minute = 30
         self.max_message_length = 1000
+        self.rate_limiter = RateLimiter(self.max_requests_per_minute, period=60, block_duration=60)
+        self.max_event_details = 200
+        self.event_sampler = EventSampler(window=60)
+        # WriteBehindBuffer с каналом security_logs, подключается после создания БД
+        self.event_sink = None
         
     def is_rate_limited(self, user_id: int) -> bool:
         """Защита от флуда"""
-        now = time.time()
-        
-        # Очистка старых запросов
-        self.user_requests[user_id] = [
-            req_time for req_time in self.user_requests[user_id] 
-            if now - req_time < 60
-        ]
-        
-        # Проверка лимита
-        if len(self.user_requests[user_id]) >= self.max_requests_per_minute:
-            if user_id not in self.blocked_users:
-                logging.warning(f"🚨 User {user_id} rate limited - too many requests")
-                self.blocked_users.add(user_id)
-            return True
-            
-        self.user_requests[user_id].append(now)
-        return user_id in self.blocked_users
+        now = time.monotonic()
+        was_blocked = self.rate_limiter.is_blocked(user_id, now)
+        limited = self.rate_limiter.hit(user_id, now)
+        if limited and not was_blocked:
+            self.log_security_event(user_id, "RATE_LIMITED", "too many requests")
+        return limited
     
     def validate_input(self, text: str, user_id: int) -> tuple[bool, str]:
         """Валидация входных данных"""
@@ -56,58 +207,387 @@ class SecurityManager:
             
         # Проверка длины
         if len(text) > self.max_message_length:
+            self.log_security_event(user_id, "MESSAGE_TOO_LONG", f"{len(text)} символов",
+                                    sample_key=(user_id, "MESSAGE_TOO_LONG", "length"))
             return False, "Сообщение слишком длинное"
             
-        # Проверка подозрительных паттернов
-        for pattern in self.suspicious_patterns:
-            if re.search(pattern, text):
-                logging.warning(f"🚨 Suspicious pattern from user {user_id}: {pattern} in '{text}'")
-                return False, "Обнаружен подозрительный контент"
-                
-        # Проверка SQL-инъекций
-        sql_keywords = ['DROP', 'DELETE', 'UPDATE', 'INSERT', '--', ';']
-        if any(keyword in text.upper() for keyword in sql_keywords):
-            logging.warning(f"🚨 SQL injection attempt from user {user_id}: {text}")
-            return False, "Недопустимые символы в сообщении"
+        # Подозрительные паттерны и SQL-инъекции - один проход по тексту
+        rule = self.input_validator.scan(text)
+        if rule:
+            event_type = "SQL_INJECTION" if rule.startswith('sql') else "SUSPICIOUS_INPUT"
+            # Повторы считаются по правилу, а не по тексту: флуд разными строками тоже схлопывается
+            self.log_security_event(user_id, event_type, f"{rule}: {text}", sample_key=(user_id, event_type, rule))
+            return False, self.input_validator.messages[rule]
             
         return True, ""
     
-    def log_security_event(self, user_id: int, event_type: str, details: str):
-        """Логирование событий безопасности"""
-        logging.warning(f"SECURITY: {event_type} - User {user_id} - {details}")
+    def log_security_event(self, user_id: int, event_type: str, details: str, sample_key: tuple = None):
+        """Логирование событий безопасности с выборкой повторов"""
+        now = time.monotonic()
+        for (repeated_user_id, repeated_type, repeated_details), suppressed in self.event_sampler.expire(now):
+            self._record_event(repeated_user_id, repeated_type, repeated_details, suppressed)
+        
+        details = details[:self.max_event_details]
+        if self.event_sampler.offer(sample_key or (user_id, event_type, details), now):
+            self._record_event(user_id, event_type, details, 1)
+    
+    def flush_events(self):
+        """Записать сводки по всем открытым окнам повторов (при остановке)"""
+        for (user_id, event_type, details), suppressed in self.event_sampler.expire():
+            self._record_event(user_id, event_type, details, suppressed)
+    
+    def _record_event(self, user_id: int, event_type: str, details: str, occurrences: int):
+        repeats = f" (повторов: {occurrences})" if occurrences > 1 else ""
+        logging.warning(f"SECURITY: {event_type} - User {user_id} - {details}{repeats}")
+        if self.event_sink:
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            self.event_sink.put('security_logs', (user_id, event_type, details, occurrences, timestamp))
 
 security_manager = SecurityManager()
 
+# ==================== МЕТРИКИ ====================
+
+# Границы корзин гистограмм времени, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: observe - bisect и два сложения"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам: верхняя граница корзины, в которую он попал"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return float('inf') if self.count else 0.0
+
+class MetricsRegistry:
+    """Реестр метрик в формате Prometheus.
+
+    Дочерняя метрика (с конкретными значениями меток) создается один раз, горячий
+    путь держит ссылку на нее и не ищет по словарю. Счетчики из потоков БД
+    обновляются без блокировки: под GIL редкая гонка стоит единицы в счетчике.
+    """
+
+    def __init__(self):
+        self._families: Dict[str, Dict] = {}
+        self._gauges: Dict[str, Dict] = {}
+
+    def _child(self, kind: str, name: str, help_text: str, labels: Dict, factory: Callable):
+        family = self._families.setdefault(name, {'type': kind, 'help': help_text, 'children': {}})
+        key = tuple(sorted(labels.items()))
+        child = family['children'].get(key)
+        if child is None:
+            child = family['children'][key] = factory()
+        return child
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._child('counter', name, help_text, labels, Counter)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._child('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float], **labels):
+        """Значение читается при отдаче метрик: глубины очередей, размеры кэшей"""
+        family = self._gauges.setdefault(name, {'help': help_text, 'children': {}})
+        family['children'][tuple(sorted(labels.items()))] = func
+
+    def family(self, name: str) -> Dict[tuple, object]:
+        return dict(self._families.get(name, {}).get('children', {}))
+
+    @staticmethod
+    def _labels(key: tuple, extra: str = '') -> str:
+        parts = [f'{label}="{value}"' for label, value in key]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        lines = []
+        for name, family in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for key, child in sorted(family['children'].items()):
+                if family['type'] == 'counter':
+                    lines.append(f"{name}{self._labels(key)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(child.buckets + ('+Inf',), child.counts):
+                    cumulative += count
+                    bucket = self._labels(key, 'le="%s"' % bound)
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {child.sum:.6f}")
+                lines.append(f"{name}_count{self._labels(key)} {child.count}")
+        for name, family in sorted(self._gauges.items()):
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, func in sorted(family['children'].items()):
+                try:
+                    lines.append(f"{name}{self._labels(key)} {func()}")
+                except Exception as e:
+                    logger.warning(f"Метрика {name} недоступна: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+rate_limited_total = metrics.counter("bot_rate_limited_total", "Обновления, отклоненные ограничением частоты")
+input_rejected_total = metrics.counter("bot_input_rejected_total", "Сообщения, отклоненные проверкой ввода")
+
+def timed_query(op: str):
+    """Декоратор методов Database: время и ошибки SQL по типу операции"""
+    def decorator(func):
+        latency = metrics.histogram("bot_db_query_duration_seconds", "Время SQL-запроса", op=op)
+        errors = metrics.counter("bot_db_errors_total", "Ошибки SQLite", op=op)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.Error:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
 # ==================== ОБЕРТКИ ДЛЯ ЗАЩИТЫ ====================
 
-def secure_handler(handler):
-    """Декоратор для защиты обработчиков"""
+def secure_handler(handler=None, *, validate_input: bool = True, rate_limit: bool = True):
+    """Декоратор для защиты обработчиков.
+
+    validate_input=False отключает проверку текста сообщения - для команд,
+    аргумент которых обработчик проверяет сам (например /check @username).
+    rate_limit=False - для inline-запросов: они приходят на каждое нажатие
+    клавиши и отвечаются из памяти.
+    """
+    if handler is None:
+        return functools.partial(secure_handler, validate_input=validate_input, rate_limit=rate_limit)
+
+    latency = metrics.histogram("bot_handler_duration_seconds", "Время работы обработчика", handler=handler.__name__)
+    errors = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках", handler=handler.__name__)
+
+    @functools.wraps(handler)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         message_text = update.message.text if update.message else ""
         
         # Проверка флуда
-        if security_manager.is_rate_limited(user.id):
-            await update.message.reply_text("🚫 Слишком много запросов. Попробуйте через минуту.")
+        if rate_limit and security_manager.is_rate_limited(user.id):
+            rate_limited_total.inc()
+            if update.callback_query:
+                await update.callback_query.answer("🚫 Слишком много запросов. Попробуйте через минуту.", show_alert=True)
+            else:
+                await update.message.reply_text("🚫 Слишком много запросов. Попробуйте через минуту.")
             return
             
         # Валидация входных данных
-        if message_text:
+        if message_text and validate_input:
+            # validate_input сам записывает событие безопасности
             is_valid, error_msg = security_manager.validate_input(message_text, user.id)
             if not is_valid:
-                security_manager.log_security_event(user.id, "INVALID_INPUT", message_text)
+                input_rejected_total.inc()
                 await update.message.reply_text(f"🚫 {error_msg}")
                 return
                 
         # Вызов оригинального обработчика
+        started = time.perf_counter()
         try:
             await handler(update, context)
         except Exception as e:
+            errors.inc()
             logging.error(f"Error in handler: {e}")
             security_manager.log_security_event(user.id, "HANDLER_ERROR", str(e))
+        finally:
+            latency.observe(time.perf_counter() - started)
             
     return wrapper
 
+# ==================== МАРШРУТИЗАЦИЯ INLINE-КНОПОК ====================
+
+# callback_data: {версия}{код действия}:{поле}:{поле}..., Telegram принимает до 64 байт
+CALLBACK_DATA_LIMIT = 64
+CALLBACK_SEPARATOR = ":"
+# Окно последних замеров для перцентилей времени обработки
+CALLBACK_LATENCY_WINDOW = 512
+
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def base36(value: int) -> str:
+    if value < 0:
+        raise ValueError("negative value")
+    digits = ""
+    while True:
+        value, digit = divmod(value, 36)
+        digits = BASE36_DIGITS[digit] + digits
+        if not value:
+            return digits
+
+class CallbackField:
+    """Поле callback_data: значение <-> компактная строка без разделителя"""
+
+    def __init__(self, encode: Callable, decode: Callable):
+        self.encode = encode
+        self.decode = decode
+
+def callback_choice(*values: str) -> CallbackField:
+    """Значение из фиксированного набора, в callback_data - один символ-индекс"""
+    return CallbackField(lambda value: base36(values.index(value)), lambda text: values[int(text, 36)])
+
+CALLBACK_INT = CallbackField(base36, lambda text: int(text, 36))
+
+def encode_callback_time(value: str) -> str:
+    """created_at "YYYY-MM-DD HH:MM:SS" как число YYYYMMDDHHMMSS в base36: 9 символов вместо 19"""
+    digits = value.replace("-", "").replace(" ", "").replace(":", "")
+    if len(digits) != 14:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    return base36(int(digits))
+
+def decode_callback_time(text: str) -> str:
+    d = str(int(text, 36))
+    if len(d) != 14:
+        raise ValueError(f"Invalid timestamp: {text!r}")
+    return f"{d[:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:]}"
+
+CALLBACK_TIME = CallbackField(encode_callback_time, decode_callback_time)
+
+class CallbackRoute:
+    def __init__(self, action: str, handler: Callable, fields: tuple, required: int, admin: bool):
+        self.action = action
+        self.handler = handler
+        self.fields = fields
+        self.required = required
+        self.admin = admin
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.latencies = deque(maxlen=CALLBACK_LATENCY_WINDOW)
+
+    def observe(self, elapsed: float, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.latencies.append(elapsed)
+
+    def stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+        return {
+            'name': self.handler.__name__,
+            'calls': self.calls,
+            'errors': self.errors,
+            'avg': self.total_time / self.calls if self.calls else 0.0,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'max': self.max_time,
+        }
+
+class CallbackRouter:
+    """Таблица маршрутов inline-кнопок: разбор callback_data и поиск обработчика за O(1).
+
+    Обработчик регистрируется декоратором route() вместе со схемой полей и
+    получает уже декодированные значения: handler(update, context, *values).
+    Кнопки другой версии кодека и испорченные данные не доходят до обработчиков.
+    """
+
+    def __init__(self, version: int = 1):
+        self.version = base36(version)
+        self._routes: Dict[str, CallbackRoute] = {}
+        self.stale = 0
+
+    def route(self, action: str, *fields: CallbackField, required: int = None, admin: bool = False):
+        """required - сколько первых полей обязательны, admin - только для ADMIN_IDS"""
+        def decorator(handler):
+            if action in self._routes:
+                raise ValueError(f"Callback action {action!r} already registered")
+            self._routes[action] = CallbackRoute(
+                action, handler, fields, len(fields) if required is None else required, admin)
+            return handler
+        return decorator
+
+    def encode(self, action: str, *values) -> str:
+        route = self._routes[action]
+        parts = [self.version + action]
+        for field, value in zip(route.fields, values):
+            if value is None:
+                break
+            parts.append(field.encode(value))
+        data = CALLBACK_SEPARATOR.join(parts)
+        if len(parts) - 1 < route.required or len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"Invalid callback data for {action!r}: {data!r}")
+        return data
+
+    def button(self, text: str, action: str, *values) -> InlineKeyboardButton:
+        return InlineKeyboardButton(text, callback_data=self.encode(action, *values))
+
+    def decode(self, data: str) -> tuple:
+        """(маршрут, значения) или (None, None) для устаревших и испорченных кнопок"""
+        head, *parts = (data or "").split(CALLBACK_SEPARATOR)
+        route = self._routes.get(head[1:]) if head[:1] == self.version else None
+        if not route or not route.required <= len(parts) <= len(route.fields):
+            return None, None
+        try:
+            return route, [field.decode(part) for field, part in zip(route.fields, parts)]
+        except (ValueError, IndexError):
+            return None, None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        route, values = self.decode(query.data)
+        if not route:
+            self.stale += 1
+            await query.answer("⚠️ Кнопка устарела, откройте меню заново", show_alert=True)
+            return
+        if route.admin and query.from_user.id not in ADMIN_IDS:
+            await query.answer("❌ У вас нет доступа к этой команде.", show_alert=True)
+            return
+        
+        started = time.perf_counter()
+        failed = True
+        try:
+            await route.handler(update, context, *values)
+            failed = False
+        finally:
+            route.observe(time.perf_counter() - started, failed)
+
+    def stats(self) -> List[Dict]:
+        return sorted((route.stats() for route in self._routes.values() if route.calls),
+                      key=lambda stats: stats['calls'], reverse=True)
+
+callback_router = CallbackRouter()
+
+@secure_handler
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единственный CallbackQueryHandler бота: все кнопки идут через callback_router"""
+    await callback_router.dispatch(update, context)
+
 # ==================== БАЗОВЫЙ КОД (БЕЗ ИЗМЕНЕНИЙ) ====================
 
 # Конфигурация
@@ -115,6 +595,27 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable is required")
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный https-адрес бота, например https://bot.example.com (без пути)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Обязателен вместе с WEBHOOK_URL; без него сервер слушает только 127.0.0.1
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '100'))
+# Сколько принятых, но еще не обработанных обновлений допускается до ответа 503
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '500'))
+# Сколько обновлений разных пользователей обрабатывается одновременно (1 - последовательно)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+# Текстовые метрики Prometheus: http://METRICS_LISTEN:METRICS_PORT/metrics, 0 - выключено
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# action_logs и security_logs старше срока выгружаются в LOG_ARCHIVE_DIR и удаляются, 0 - хранить все
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', '90'))
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', 'log_archive')
+
 ADMIN_IDS = {6240653984, 5828927567}
 ITEMS_PER_PAGE = 5
 
@@ -135,178 +636,879 @@ logger = logging.getLogger(__name__)
 (REQUEST_INFO_WHITE, REQUEST_INFO_SCAM, REQUEST_INFO_APPEAL, 
  PROVIDE_INFO_WHITE, PROVIDE_INFO_SCAM, PROVIDE_INFO_APPEAL) = range(14, 20)
 
-class Database:
+def counter_triggers(counter: str, table: str, condition: str) -> List[str]:
+    """Триггеры, поддерживающие в counters число строк table, удовлетворяющих condition.
+
+    condition - шаблон с подстановкой {row}, например "{row}.status = 'active'".
+    """
+    new_condition = condition.format(row='NEW')
+    old_condition = condition.format(row='OLD')
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{counter}_count_insert AFTER INSERT ON {table}
+        WHEN {new_condition}
+        BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = '{counter}';
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{counter}_count_delete AFTER DELETE ON {table}
+        WHEN {old_condition}
+        BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = '{counter}';
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{counter}_count_update AFTER UPDATE OF status ON {table}
+        WHEN ({new_condition}) IS NOT ({old_condition})
+        BEGIN
+            UPDATE counters SET value = value + ({new_condition}) - ({old_condition}) WHERE name = '{counter}';
+        END
+        ''',
+    ]
+
+def status_counter_triggers(table: str) -> List[str]:
+    """Счетчики строк table по каждому статусу в counters под именем '{table}:{status}'"""
+    increment = (
+        f"INSERT INTO counters (name, value) VALUES ('{table}:' || NEW.status, 1) "
+        f"ON CONFLICT(name) DO UPDATE SET value = value + 1;"
+    )
+    decrement = f"UPDATE counters SET value = value - 1 WHERE name = '{table}:' || OLD.status;"
+    return [
+        f'''
+        INSERT OR REPLACE INTO counters (name, value)
+        SELECT '{table}:' || status, COUNT(*) FROM {table} WHERE status IS NOT NULL GROUP BY status
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_status_insert AFTER INSERT ON {table}
+        WHEN NEW.status IS NOT NULL
+        BEGIN
+            {increment}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_status_delete AFTER DELETE ON {table}
+        WHEN OLD.status IS NOT NULL
+        BEGIN
+            {decrement}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_status_update AFTER UPDATE OF status ON {table}
+        WHEN NEW.status IS NOT OLD.status
+        BEGIN
+            {decrement}
+            {increment}
+        END
+        ''',
+    ]
+
+# Очередь модерации: таблица -> колонки для списка (без тяжелых proofs/file_ids)
+MODERATION_COLUMNS = {
+    "white_list_applications": "id, user_id, username, activity, city, created_at, status, version",
+    "scam_reports": "id, reporter_id, scammer_username, description, created_at, status, version",
+    "appeal_applications": "id, user_id, username, explanation, created_at, status, version",
+}
+MODERATION_TABLES = tuple(MODERATION_COLUMNS)
+
+def total_counter_triggers(table: str) -> List[str]:
+    """Счетчик всех строк table в counters под именем table"""
+    return [
+        f'''
+        INSERT OR REPLACE INTO counters (name, value) SELECT '{table}', COUNT(*) FROM {table}
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_total_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO counters (name, value) VALUES ('{table}', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_total_delete AFTER DELETE ON {table}
+        BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = '{table}';
+        END
+        ''',
+    ]
+
+def daily_rollup_triggers(table: str, metric: str) -> List[str]:
+    """Число новых строк table по дням (UTC) в daily_stats под именем metric"""
+    return [
+        f'''
+        INSERT OR REPLACE INTO daily_stats (day, metric, value)
+        SELECT date(created_at), '{metric}', COUNT(*) FROM {table}
+        WHERE created_at IS NOT NULL GROUP BY date(created_at)
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_daily AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO daily_stats (day, metric, value)
+            VALUES (date(COALESCE(NEW.created_at, CURRENT_TIMESTAMP)), '{metric}', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET value = value + 1;
+        END
+        ''',
+    ]
+
+def fts_triggers(table: str, columns: List[str], weights: List[float]) -> List[str]:
+    """Внешняя FTS5-таблица {table}_fts над columns, синхронизируемая триггерами.
+
+    weights - веса колонок для bm25: совпадение в username важнее, чем в описании.
+    """
+    fts = f"{table}_fts"
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"NEW.{column}" for column in columns)
+    old_values = ", ".join(f"OLD.{column}" for column in columns)
+    delete_old = f"INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});"
+    insert_new = f"INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.id, {new_values});"
+    return [
+        f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {column_list},
+            content='{table}', content_rowid='id',
+            tokenize="unicode61 remove_diacritics 2 tokenchars '_'",
+            prefix='2 3'
+        )
+        ''',
+        f"INSERT INTO {fts} ({fts}, rank) VALUES ('rank', 'bm25({', '.join(map(str, weights))})')",
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+        BEGIN
+            {insert_new}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+        BEGIN
+            {delete_old}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column_list} ON {table}
+        BEGIN
+            {delete_old}
+            {insert_new}
+        END
+        ''',
+    ]
+
+# Дневные сводки для статистики: таблица -> метрика
+DAILY_METRICS = {
+    "bot_users": "new_users",
+    "white_list": "white_added",
+    "scam_list": "scam_added",
+    "white_list_applications": "applications",
+    "scam_reports": "reports",
+    "appeal_applications": "appeals",
+    "action_logs": "admin_actions",
+}
+
+# Одобрение заявки: SQL с единственным параметром - id заявки
+MODERATION_APPROVALS = {
+    "white_list_applications": '''
+        INSERT INTO white_list (user_id, username, activity, city, link, description, proofs, file_ids)
+        SELECT user_id, username, activity, city, link, description, proofs, file_ids
+        FROM white_list_applications WHERE id = ?
+    ''',
+    "scam_reports": '''
+        INSERT INTO scam_list (username, reason, proofs, file_ids)
+        SELECT scammer_username, description, proofs, file_ids
+        FROM scam_reports WHERE id = ?
+    ''',
+    # Запись могла быть добавлена в другом регистре или с "@"
+    "appeal_applications": '''
+        UPDATE scam_list SET status = 'removed'
+        WHERE status = 'active' AND lower(ltrim(username, '@')) = (
+            SELECT lower(ltrim(username, '@')) FROM appeal_applications WHERE id = ?
+        )
+    ''',
+}
+# Какой список меняет одобрение
+MODERATION_LISTS = {
+    "white_list_applications": "white_list",
+    "scam_reports": "scam_list",
+    "appeal_applications": "scam_list",
+}
+
+def legacy_file_ids(attachments: Optional[List[Dict]]) -> str:
+    """Старый формат колонки file_ids: "тип:file_id" через запятую"""
+    return ",".join(f"{item['kind']}:{item['file_id']}" for item in attachments or [])
+
+def moderation_owner(item: Dict) -> Optional[int]:
+    """Автор заявки или жалобы: ему сообщается решение"""
+    return item.get('user_id') or item.get('reporter_id')
+
+# Отложенные задачи (таблица jobs), сроки в секундах
+INFO_REMINDER_DELAY = 24 * 3600
+# После стольких напоминаний без ответа запрос информации закрывается
+INFO_REMINDER_LIMIT = 3
+# Заявка без решения закрывается со статусом expired
+PENDING_EXPIRY = 14 * 24 * 3600
+# Заявки старше попадают в ночную сводку администраторам
+ESCALATION_AGE = 2 * 24 * 3600
+# Час запуска ночных задач, местное время
+NIGHTLY_HOUR = 4
+# Как часто переносить WAL в базу и сколько бот должен простаивать перед этим
+WAL_CHECKPOINT_INTERVAL = 15 * 60
+QUIET_PERIOD = 30
+
+# Таблицы логов с ограниченным сроком хранения: таблица -> колонка времени
+LOG_TABLES = {
+    'action_logs': 'created_at',
+    'security_logs': 'timestamp',
+}
+
+# Одна запись на (kind, key): повторное планирование только переносит срок
+SCHEDULE_JOB_SQL = '''
+    INSERT INTO jobs (kind, key, due_at) VALUES (?, ?, ?)
+    ON CONFLICT(kind, key) DO UPDATE SET due_at = excluded.due_at, attempts = 0
+'''
+
+# Миграции схемы: (версия, SQL-выражения). Применяются по порядку в init_db,
+# текущая версия хранится в settings под ключом schema_version
+MIGRATIONS = [
+    (1, [
+        # is_user_in_scam_list: покрывающий индекс для COUNT(*)
+        'CREATE INDEX IF NOT EXISTS idx_scam_list_username_status ON scam_list (username, status)',
+        # get_white_list / get_scam_list: фильтр по статусу + сортировка по дате
+        'CREATE INDEX IF NOT EXISTS idx_white_list_status_created ON white_list (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_scam_list_status_created ON scam_list (status, created_at)',
+        # get_active_info_request / get_info_request_by_type_id
+        'CREATE INDEX IF NOT EXISTS idx_info_requests_user_type_status ON info_requests (user_id, request_type, status)',
+        'CREATE INDEX IF NOT EXISTS idx_info_requests_user_status ON info_requests (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_info_requests_type_request ON info_requests (request_type, request_id, status)',
+        # get_pending_*
+        'CREATE INDEX IF NOT EXISTS idx_white_list_applications_status ON white_list_applications (status)',
+        'CREATE INDEX IF NOT EXISTS idx_scam_reports_status ON scam_reports (status)',
+        'CREATE INDEX IF NOT EXISTS idx_appeal_applications_status ON appeal_applications (status)',
+    ]),
+    (2, [
+        # Поддерживаемые триггерами счетчики вместо COUNT(*) на каждый клик
+        '''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO counters (name, value)
+        SELECT 'white_list', COUNT(*) FROM white_list WHERE status = 'approved'
+        ''',
+        '''
+        INSERT OR REPLACE INTO counters (name, value)
+        SELECT 'scam_list', COUNT(*) FROM scam_list WHERE status = 'active'
+        ''',
+        *counter_triggers('white_list', 'white_list', "{row}.status = 'approved'"),
+        *counter_triggers('scam_list', 'scam_list', "{row}.status = 'active'"),
+    ]),
+    (3, [
+        # Массовые рассылки: курсор last_user_id позволяет продолжить после перезапуска
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)',
+    ]),
+    (4, [
+        # Сводная запись о подавленных повторах хранит их число
+        'ALTER TABLE security_logs ADD COLUMN occurrences INTEGER DEFAULT 1',
+        'CREATE INDEX IF NOT EXISTS idx_security_logs_timestamp ON security_logs (timestamp)',
+    ]),
+    (5, [
+        # Состояние диалогов (SQLitePersistence): строка на ключ, NULL - ключ удален
+        '''
+        CREATE TABLE IF NOT EXISTS persistent_data (
+            scope TEXT NOT NULL,
+            owner INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, owner, key)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (6, [
+        # Очередь модерации: version для оптимистической блокировки, кто рассмотрел
+        *(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0' for table in MODERATION_TABLES),
+        *(f'ALTER TABLE {table} ADD COLUMN reviewed_by INTEGER' for table in MODERATION_TABLES),
+        # Keyset-страницы очереди: (status, created_at) вместо индекса только по status
+        *(f'DROP INDEX IF EXISTS idx_{table}_status' for table in MODERATION_TABLES),
+        *(f'CREATE INDEX IF NOT EXISTS idx_{table}_status_created ON {table} (status, created_at)'
+          for table in MODERATION_TABLES),
+        *(statement for table in MODERATION_TABLES for statement in status_counter_triggers(table)),
+    ]),
+    (7, [
+        # Статистика: итоговые счетчики и дневные сводки, которые ведут триггеры
+        '''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+        ''',
+        *total_counter_triggers('bot_users'),
+        *total_counter_triggers('action_logs'),
+        *(statement for table, metric in DAILY_METRICS.items()
+          for statement in daily_rollup_triggers(table, metric)),
+    ]),
+    (8, [
+        # Полнотекстовый поиск по спискам (/search)
+        *fts_triggers('white_list', ['username', 'activity', 'city', 'description'], [10.0, 4.0, 2.0, 1.0]),
+        *fts_triggers('scam_list', ['username', 'reason'], [10.0, 1.0]),
+    ]),
+    (9, [
+        # Поиск по username без регистра и "@": inline-проверка, снятие статуса скамера
+        "CREATE INDEX IF NOT EXISTS idx_scam_list_username_normalized ON scam_list (lower(ltrim(username, '@')))",
+        "CREATE INDEX IF NOT EXISTS idx_white_list_username_normalized ON white_list (lower(ltrim(username, '@')))",
+    ]),
+    (10, [
+        # Доказательства: файл хранится один раз по file_unique_id, заявки ссылаются на него
+        '''
+        CREATE TABLE IF NOT EXISTS proof_files (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            file_size INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS proof_links (
+            owner_type TEXT NOT NULL,
+            owner_id INTEGER NOT NULL,
+            file_unique_id TEXT NOT NULL REFERENCES proof_files (file_unique_id),
+            position INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (owner_type, owner_id, file_unique_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_proof_links_file ON proof_links (file_unique_id)',
+    ]),
+    (11, [
+        # Планировщик читает только MIN(due_at) и наступившие сроки - оба запроса по индексу
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            due_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (due_at)',
+        # Накопившиеся запросы и заявки получают задачи от даты создания
+        f'''
+        INSERT OR IGNORE INTO jobs (kind, key, due_at)
+        SELECT 'info_reminder', id, CAST(strftime('%s', created_at) AS INTEGER) + {INFO_REMINDER_DELAY}
+        FROM info_requests WHERE status = 'pending'
+        ''',
+    ] + [
+        f'''
+        INSERT OR IGNORE INTO jobs (kind, key, due_at)
+        SELECT 'moderation_expiry', '{table}:' || id, CAST(strftime('%s', created_at) AS INTEGER) + {PENDING_EXPIRY}
+        FROM {table} WHERE status = 'pending'
+        '''
+        for table in MODERATION_TABLES
+    ]),
+    (12, [
+        # Выборка логов старше срока хранения (security_logs уже проиндексирован в версии 4)
+        'CREATE INDEX IF NOT EXISTS idx_action_logs_created ON action_logs (created_at)',
+    ]),
+    (13, [
+        # Получатели рассылки после курсора last_user_id, которым сообщение уже ушло:
+        # воркеры пачки завершаются не по порядку, после перезапуска их нельзя слать заново
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            outcome TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+]
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def is_database_locked(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and "database is locked" in str(error)
+
+class ConnectionPool:
+    """Долгоживущие соединения SQLite: по одному на поток, PRAGMA применяются один раз при открытии"""
+
+    def __init__(self, db_path: str, timeout: float = 5, cached_statements: int = 256):
+        self.db_path = db_path
+        self.timeout = timeout
+        # Кэш подготовленных выражений sqlite3 (ключ - текст запроса)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            cached_statements=self.cached_statements,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        # Действует только для новой базы, существующую переводит DatabaseMaintenance
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Одна транзакция: commit при успехе, rollback при исключении"""
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+class WriteBehindBuffer:
+    """Отложенная запись мелких строк (пользователи, логи).
+
+    Строки копятся в памяти по каналам и сбрасываются фоновым потоком одной
+    транзакцией раз в flush_interval секунд или сразу при max_rows строк.
+    Канал с key схлопывает строки с одинаковым ключом (остается последняя),
+    канал с maxlen ограничен и при переполнении теряет самые старые строки.
+    """
+
+    def __init__(self, pool: ConnectionPool, flush_interval: float = 0.5, max_rows: int = 500):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.dropped_rows = 0
+        self._channels: Dict[str, tuple] = {}
+        self._rows: Dict[str, object] = {}
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def register(self, name: str, sql: str, key: Callable[[tuple], object] = None, maxlen: int = None):
+        self._channels[name] = (sql, key, maxlen)
+        self._rows[name] = self._new_rows(name)
+
+    def _new_rows(self, name: str):
+        _, key, maxlen = self._channels[name]
+        if key:
+            return OrderedDict()
+        return deque(maxlen=maxlen)
+
+    def put(self, name: str, params: tuple):
+        sql, key, maxlen = self._channels[name]
+        with self._lock:
+            rows = self._rows[name]
+            if key:
+                row_key = key(params)
+                if row_key not in rows:
+                    self._depth += 1
+                rows[row_key] = params
+            elif maxlen and len(rows) == maxlen:
+                # deque с maxlen сам вытеснит самую старую строку
+                rows.append(params)
+                self.dropped_rows += 1
+            else:
+                rows.append(params)
+                self._depth += 1
+            depth = self._depth
+        if self._thread is None:
+            self._start()
+        if depth >= self.max_rows:
+            self._wakeup.set()
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def flush(self) -> int:
+        """Записать накопленное одной транзакцией, возвращает число строк"""
+        with self._lock:
+            if not self._depth:
+                return 0
+            batch = self._rows
+            self._rows = {name: self._new_rows(name) for name in self._channels}
+            depth, self._depth = self._depth, 0
+        try:
+            with self.pool.transaction() as conn:
+                for name, rows in batch.items():
+                    if rows:
+                        conn.executemany(self._channels[name][0], list(rows.values()) if isinstance(rows, dict) else rows)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка отложенной записи ({depth} строк), повтор при следующем сбросе: {e}")
+            self._requeue(batch)
+            return 0
+        self.flushes += 1
+        self.flushed_rows += depth
+        return depth
+
+    def _requeue(self, batch: Dict[str, object]):
+        # Более новые строки с тем же ключом важнее старых, очереди идут впереди новых
+        with self._lock:
+            for name, rows in batch.items():
+                current = self._rows[name]
+                if isinstance(rows, dict):
+                    for row_key, params in rows.items():
+                        if row_key not in current:
+                            current[row_key] = params
+                            self._depth += 1
+                else:
+                    merged = deque(rows, maxlen=current.maxlen)
+                    merged.extend(current)
+                    self._depth += len(merged) - len(current)
+                    self.dropped_rows += len(rows) + len(current) - len(merged)
+                    self._rows[name] = merged
+
+    def stats(self) -> Dict:
+        return {
+            'depth': self._depth,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'dropped_rows': self.dropped_rows,
+        }
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Остановить фоновый поток и сбросить остаток"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+class UsernameIndex:
+    """Множество username в нижнем регистре без "@": проверка за O(1) без обращения к БД"""
+
     def __init__(self):
-        self.db_path = "scam_bot.db"
-        self.init_db()
+        self._usernames: Set[str] = set()
+
+    @staticmethod
+    def normalize(username: str) -> str:
+        return username.strip().lstrip('@').lower()
+
+    def load(self, usernames):
+        # Подмена множества целиком атомарна, читатели не видят его частично заполненным
+        self._usernames = {self.normalize(username) for username in usernames if username}
+
+    def add(self, username: str):
+        if username:
+            self._usernames.add(self.normalize(username))
+
+    def discard(self, username: str):
+        self._usernames.discard(self.normalize(username))
+
+    def __contains__(self, username: str) -> bool:
+        return bool(username) and self.normalize(username) in self._usernames
+
+    def __len__(self) -> int:
+        return len(self._usernames)
+
+class Database:
+    def __init__(self, db_path: str = "scam_bot.db"):
+        self.db_path = db_path
         self.query_timeout = 5  # seconds
         self.max_retries = 3
+        self.pool = ConnectionPool(self.db_path, timeout=self.query_timeout)
+        self.scam_index = UsernameIndex()
+        self.white_index = UsernameIndex()
+        self._change_listeners: List[Callable[[str], None]] = []
+        self.write_buffer = WriteBehindBuffer(self.pool)
+        # Upsert, а не REPLACE: REPLACE удаляет строку мимо DELETE-триггеров счетчиков и сбрасывает created_at
+        self.write_buffer.register('bot_users', '''
+            INSERT INTO bot_users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
+        ''', key=lambda params: params[0])
+        self.write_buffer.register('action_logs', '''
+            INSERT INTO action_logs (admin_id, action, target_user_id, details)
+            VALUES (?, ?, ?, ?)
+        ''')
+        # События безопасности: ограниченная очередь, при флуде теряются самые старые
+        self.write_buffer.register('security_logs', '''
+            INSERT INTO security_logs (user_id, activity, details, occurrences, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', maxlen=10_000)
+        # Состояние диалогов: последняя запись по ключу перекрывает предыдущие
+        self.write_buffer.register('persistent_data', '''
+            INSERT OR REPLACE INTO persistent_data (scope, owner, key, value)
+            VALUES (?, ?, ?, ?)
+        ''', key=lambda params: params[:3])
+        self.write_buffer.register('conversations', '''
+            INSERT OR REPLACE INTO conversations (name, key, state)
+            VALUES (?, ?, ?)
+        ''', key=lambda params: params[:2])
+        self.init_db()
+        self.load_scam_index()
+        self.load_white_index()
+
+    def close(self):
+        """Сбросить отложенные записи и закрыть соединения"""
+        self.write_buffer.stop()
+        self.pool.close_all()
+
+    def add_change_listener(self, listener: Callable[[str], None]):
+        """listener(table) вызывается после успешной записи в white_list / scam_list"""
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, table: str):
+        for listener in self._change_listeners:
+            listener(table)
     
-    def secure_execute(self, query, params=(), retry_count=0):
-        """Безопасное выполнение запроса с таймаутом"""
-        try:
-            conn = sqlite3.connect(self.db_path, timeout=self.query_timeout)
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA journal_mode=WAL")
-            cursor.execute("PRAGMA synchronous=NORMAL")
-            cursor.execute("PRAGMA foreign_keys=ON")
-            
-            if "DELETE" in query.upper() or "DROP" in query.upper():
-                logger.warning(f"Dangerous query attempted: {query}")
-            
-            result = cursor.execute(query, params)
-            conn.commit()
-            return result
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e) and retry_count < self.max_retries:
-                time.sleep(0.1)
-                return self.secure_execute(query, params, retry_count + 1)
-            raise e
-        finally:
-            conn.close()
+    @timed_query("execute")
+    def secure_execute(self, query, params=()):
+        """Безопасное выполнение запроса с таймаутом.
 
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Создаем таблицу для логов безопасности
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS security_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                activity TEXT,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        Повторы при "database is locked" выполняет AsyncDatabase с асинхронной
+        паузой, чтобы не усыплять поток, в котором крутится event loop.
+        """
+        if "DELETE" in query.upper() or "DROP" in query.upper():
+            logger.warning(f"Dangerous query attempted: {query}")
         
-        # Проверяем существование таблиц перед созданием
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS white_list (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                activity TEXT,
-                city TEXT,
-                link TEXT,
-                description TEXT,
-                proofs TEXT,
-                file_ids TEXT,
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'approved'
-            )
-        ''')
+        with self.pool.transaction() as conn:
+            return conn.execute(query, params)
+
+    @timed_query("fetchall")
+    def _fetchall(self, query, params=()) -> List[Dict]:
+        cursor = self.pool.connection().execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+    @timed_query("fetchone")
+    def _fetchone(self, query, params=()) -> Optional[Dict]:
+        row = self.pool.connection().execute(query, params).fetchone()
+        return dict(row) if row else None
+
+    @timed_query("scalar")
+    def _scalar(self, query, params=()):
+        row = self.pool.connection().execute(query, params).fetchone()
+        return row[0] if row else None
+
+    @timed_query("write")
+    def _write(self, query, params=()) -> int:
+        """Запись в отдельной транзакции, возвращает lastrowid"""
+        with self.pool.transaction() as conn:
+            return conn.execute(query, params).lastrowid
+
+    def init_db(self):
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+
+            # Создаем таблицу для логов безопасности
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS security_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    activity TEXT,
+                    details TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS scam_list (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                username TEXT,
-                reason TEXT,
-                proofs TEXT,
-                file_ids TEXT,
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'active'
-            )
-        ''')
+            # Проверяем существование таблиц перед созданием
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS white_list (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    activity TEXT,
+                    city TEXT,
+                    link TEXT,
+                    description TEXT,
+                    proofs TEXT,
+                    file_ids TEXT,
+                    admin_notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'approved'
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS white_list_applications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                activity TEXT,
-                city TEXT,
-                link TEXT,
-                description TEXT,
-                proofs TEXT,
-                file_ids TEXT,
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scam_list (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    username TEXT,
+                    reason TEXT,
+                    proofs TEXT,
+                    file_ids TEXT,
+                    admin_notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'active'
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS scam_reports (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                reporter_id INTEGER NOT NULL,
-                scammer_username TEXT,
-                description TEXT,
-                proofs TEXT,
-                file_ids TEXT,
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS white_list_applications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    activity TEXT,
+                    city TEXT,
+                    link TEXT,
+                    description TEXT,
+                    proofs TEXT,
+                    file_ids TEXT,
+                    admin_notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'pending'
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS appeal_applications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                explanation TEXT,
-                proofs TEXT,
-                file_ids TEXT,
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scam_reports (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    reporter_id INTEGER NOT NULL,
+                    scammer_username TEXT,
+                    description TEXT,
+                    proofs TEXT,
+                    file_ids TEXT,
+                    admin_notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'pending'
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS info_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_type TEXT,
-                request_id INTEGER,
-                user_id INTEGER,
-                admin_id INTEGER,
-                request_text TEXT,
-                response_text TEXT,
-                response_files TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS appeal_applications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    explanation TEXT,
+                    proofs TEXT,
+                    file_ids TEXT,
+                    admin_notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    status TEXT DEFAULT 'pending'
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS action_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER,
-                action TEXT,
-                target_user_id INTEGER,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS info_requests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    request_type TEXT,
+                    request_id INTEGER,
+                    user_id INTEGER,
+                    admin_id INTEGER,
+                    request_text TEXT,
+                    response_text TEXT,
+                    response_files TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bot_users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS action_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    admin_id INTEGER,
+                    action TEXT,
+                    target_user_id INTEGER,
+                    details TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT UNIQUE,
-                value TEXT
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES ("notification_channel", "")')
-        cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES ("mass_notifications", "1")')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT UNIQUE,
+                    value TEXT
+                )
+            ''')
         
-        conn.commit()
-        conn.close()
+            cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES ("notification_channel", "")')
+            cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES ("mass_notifications", "1")')
+
+        self.migrate()
         logger.info("База данных инициализирована")
+
+    def get_schema_version(self) -> int:
+        value = self._scalar('SELECT value FROM settings WHERE key = "schema_version"')
+        return int(value) if value else 0
+
+    def migrate(self):
+        """Применяет недостающие миграции, каждую в отдельной транзакции"""
+        version = self.get_schema_version()
+        conn = self.pool.connection()
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            with conn:
+                conn.execute('BEGIN')
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute('''
+                    INSERT INTO settings (key, value) VALUES ('schema_version', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                ''', (str(target),))
+            logger.info(f"Схема БД обновлена до версии {target}")
     
     def add_to_white_list(self, user_data: Dict) -> bool:
         try:
@@ -314,12 +1516,8 @@ class Database:
             if not all(key in user_data for key in ['user_id', 'username', 'activity']):
                 raise ValueError("Missing required fields")
             
-            # Экранирование специальных символов
-            for key, value in user_data.items():
-                if isinstance(value, str):
-                    user_data[key] = value.replace('"', '""').replace("'", "''")
-            
-            return self.secure_execute('''
+            # Запрос параметризован: значения сохраняются как введены, без экранирования
+            self.secure_execute('''
                 INSERT INTO white_list 
                 (user_id, username, activity, city, link, description, proofs, file_ids)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -333,33 +1531,56 @@ class Database:
                 user_data['proofs'],
                 user_data.get('file_ids', '')
             ))
+            self.white_index.add(user_data['username'])
+            self._notify_change('white_list')
+            return True
+        except sqlite3.OperationalError as e:
+            if is_database_locked(e):
+                raise
+            logger.error(f"Security error adding to white list: {e}")
+            return False
         except Exception as e:
             logger.error(f"Security error adding to white list: {e}")
             return False
 
     # Остальные методы Database остаются без изменений...
-    def get_white_list(self, page: int = 1) -> List[Dict]:
-        offset = (page - 1) * ITEMS_PER_PAGE
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM white_list 
-            WHERE status = 'approved'
-            ORDER BY created_at DESC 
-            LIMIT ? OFFSET ?
-        ''', (ITEMS_PER_PAGE, offset))
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return results
-
     def get_white_list_count(self) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM white_list WHERE status = "approved"')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        return self.get_counter('white_list')
+
+    def get_white_list_page(self, after: tuple = None, before: tuple = None) -> List[Dict]:
+        return self._list_page('white_list', 'approved', after, before)
+
+    def get_counter(self, name: str) -> int:
+        return self._scalar('SELECT value FROM counters WHERE name = ?', (name,)) or 0
+
+    def _list_page(self, table: str, status: str, after: tuple = None, before: tuple = None) -> List[Dict]:
+        """Keyset-страница по (created_at, id), от новых записей к старым.
+
+        after - ключ последней записи предыдущей страницы (листаем вперед),
+        before - ключ первой записи следующей страницы (листаем назад).
+        """
+        if before:
+            rows = self._fetchall(f'''
+                SELECT * FROM {table}
+                WHERE status = ? AND (created_at, id) > (?, ?)
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (status, *before, ITEMS_PER_PAGE))
+            rows.reverse()
+            return rows
+        if after:
+            return self._fetchall(f'''
+                SELECT * FROM {table}
+                WHERE status = ? AND (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (status, *after, ITEMS_PER_PAGE))
+        return self._fetchall(f'''
+            SELECT * FROM {table}
+            WHERE status = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (status, ITEMS_PER_PAGE))
 
     def add_to_scam_list(self, user_data: Dict) -> bool:
         try:
@@ -367,7 +1588,7 @@ class Database:
             if not all(key in user_data for key in ['username', 'reason']):
                 raise ValueError("Missing required fields")
             
-            return self.secure_execute('''
+            self.secure_execute('''
                 INSERT INTO scam_list 
                 (user_id, username, reason, proofs, file_ids)
                 VALUES (?, ?, ?, ?, ?)
@@ -378,182 +1599,346 @@ class Database:
                 user_data['proofs'],
                 user_data.get('file_ids', '')
             ))
+            self.scam_index.add(user_data['username'])
+            self._notify_change('scam_list')
+            return True
+        except sqlite3.OperationalError as e:
+            if is_database_locked(e):
+                raise
+            logger.error(f"Security error adding to scam list: {e}")
+            return False
         except Exception as e:
             logger.error(f"Security error adding to scam list: {e}")
             return False
 
-    def get_scam_list(self, page: int = 1) -> List[Dict]:
-        offset = (page - 1) * ITEMS_PER_PAGE
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM scam_list 
-            WHERE status = 'active'
-            ORDER BY created_at DESC 
-            LIMIT ? OFFSET ?
-        ''', (ITEMS_PER_PAGE, offset))
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return results
-
     def get_scam_list_count(self) -> int:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM scam_list WHERE status = "active"')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
-
-    def get_pending_applications(self) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM white_list_applications WHERE status = "pending"')
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return results
+        return self.get_counter('scam_list')
+
+    def get_scam_list_page(self, after: tuple = None, before: tuple = None) -> List[Dict]:
+        return self._list_page('scam_list', 'active', after, before)
+
+    def get_pending_applications(self, limit: int = ITEMS_PER_PAGE) -> List[Dict]:
+        return self.get_moderation_page("white_list_applications", "pending", limit=limit)
 
     def get_white_list_application_by_id(self, application_id: int) -> Dict:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM white_list_applications WHERE id = ?', (application_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+        return self._fetchone('SELECT * FROM white_list_applications WHERE id = ?', (application_id,))
 
     def update_application_status(self, application_id: int, status: str, admin_notes: str = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         if admin_notes:
-            cursor.execute('''
+            self._write('''
                 UPDATE white_list_applications 
-                SET status = ?, admin_notes = ? 
+                SET status = ?, admin_notes = ?, version = version + 1
                 WHERE id = ?
             ''', (status, admin_notes, application_id))
         else:
-            cursor.execute('''
+            self._write('''
                 UPDATE white_list_applications 
-                SET status = ? 
+                SET status = ?, version = version + 1
                 WHERE id = ?
             ''', (status, application_id))
-        conn.commit()
-        conn.close()
+        self._notify_change("white_list_applications")
 
-    def get_pending_reports(self) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM scam_reports WHERE status = "pending"')
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return results
+    def get_pending_reports(self, limit: int = ITEMS_PER_PAGE) -> List[Dict]:
+        return self.get_moderation_page("scam_reports", "pending", limit=limit)
 
     def get_scam_report_by_id(self, report_id: int) -> Dict:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM scam_reports WHERE id = ?', (report_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+        return self._fetchone('SELECT * FROM scam_reports WHERE id = ?', (report_id,))
 
     def update_report_status(self, report_id: int, status: str, admin_notes: str = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         if admin_notes:
-            cursor.execute('''
+            self._write('''
                 UPDATE scam_reports 
-                SET status = ?, admin_notes = ? 
+                SET status = ?, admin_notes = ?, version = version + 1
                 WHERE id = ?
             ''', (status, admin_notes, report_id))
         else:
-            cursor.execute('''
+            self._write('''
                 UPDATE scam_reports 
-                SET status = ? 
+                SET status = ?, version = version + 1
                 WHERE id = ?
             ''', (status, report_id))
-        conn.commit()
-        conn.close()
+        self._notify_change("scam_reports")
 
-    def get_pending_appeals(self) -> List[Dict]:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM appeal_applications WHERE status = "pending"')
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return results
+    def get_pending_appeals(self, limit: int = ITEMS_PER_PAGE) -> List[Dict]:
+        return self.get_moderation_page("appeal_applications", "pending", limit=limit)
 
     def get_appeal_by_id(self, appeal_id: int) -> Dict:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM appeal_applications WHERE id = ?', (appeal_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+        return self._fetchone('SELECT * FROM appeal_applications WHERE id = ?', (appeal_id,))
 
     def update_appeal_status(self, appeal_id: int, status: str, admin_notes: str = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         if admin_notes:
-            cursor.execute('''
+            self._write('''
                 UPDATE appeal_applications 
-                SET status = ?, admin_notes = ? 
+                SET status = ?, admin_notes = ?, version = version + 1
                 WHERE id = ?
             ''', (status, admin_notes, appeal_id))
         else:
-            cursor.execute('''
+            self._write('''
                 UPDATE appeal_applications 
-                SET status = ? 
+                SET status = ?, version = version + 1
                 WHERE id = ?
             ''', (status, appeal_id))
-        conn.commit()
-        conn.close()
+        self._notify_change("appeal_applications")
 
-    def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO bot_users 
-                (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"Error adding user: {e}")
+    def get_moderation_page(self, table: str, status: str, after: tuple = None,
+                            limit: int = ITEMS_PER_PAGE) -> List[Dict]:
+        """Keyset-страница очереди модерации от старых заявок к новым, только колонки для списка"""
+        columns = MODERATION_COLUMNS[table]
+        if after:
+            return self._fetchall(f'''
+                SELECT {columns} FROM {table}
+                WHERE status = ? AND (created_at, id) > (?, ?)
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (status, *after, limit))
+        return self._fetchall(f'''
+            SELECT {columns} FROM {table}
+            WHERE status = ?
+            ORDER BY created_at, id
+            LIMIT ?
+        ''', (status, limit))
 
-    def get_all_users(self) -> List[int]:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM bot_users')
-        results = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return results
+    def get_moderation_item(self, table: str, item_id: int) -> Optional[Dict]:
+        return self._fetchone(f'SELECT * FROM {table} WHERE id = ?', (item_id,))
 
-    def log_action(self, admin_id: int, action: str, target_user_id: int = None, details: str = None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO action_logs (admin_id, action, target_user_id, details)
-            VALUES (?, ?, ?, ?)
-        ''', (admin_id, action, target_user_id, details))
-        conn.commit()
-        conn.close()
+    def get_status_counts(self) -> Dict[str, Dict[str, int]]:
+        """Поддерживаемые триггерами счетчики по статусам: {table: {status: count}}"""
+        counts = {table: {} for table in MODERATION_TABLES}
+        for row in self._fetchall("SELECT name, value FROM counters WHERE name LIKE '%:%'"):
+            table, _, status = row['name'].partition(':')
+            if table in counts:
+                counts[table][status] = row['value']
+        return counts
 
-    def add_white_list_application(self, user_data: Dict) -> int:
+    def moderate_items(self, table: str, items: List[tuple], status: str, admin_id: int,
+                       action: str) -> List[Dict]:
+        """Решение по нескольким заявкам одной транзакцией.
+
+        items - пары (id, version). Смена статуса с проверкой version, запись в
+        белый список / список скамеров при одобрении и лог действия идут в
+        точке сохранения на каждую заявку: ошибка одной не откатывает остальные.
+        Результат по каждой заявке: done, conflict (версия устарела), missing, error.
+        """
+        results = []
+        with self.pool.transaction() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for item_id, version in items:
+                row = conn.execute(f'SELECT * FROM {table} WHERE id = ?', (item_id,)).fetchone()
+                if row is None:
+                    results.append({'id': item_id, 'result': 'missing', 'item': None})
+                    continue
+                item = dict(row)
+                conn.execute('SAVEPOINT moderate_item')
+                try:
+                    updated = conn.execute(f'''
+                        UPDATE {table}
+                        SET status = ?, reviewed_by = ?, version = version + 1
+                        WHERE id = ? AND version = ?
+                    ''', (status, admin_id, item_id, version)).rowcount
+                    if updated:
+                        if status == 'approved':
+                            conn.execute(MODERATION_APPROVALS[table], (item_id,))
+                        conn.execute('''
+                            INSERT INTO action_logs (admin_id, action, target_user_id, details)
+                            VALUES (?, ?, ?, ?)
+                        ''', (admin_id, action, moderation_owner(item), f"#{item_id}"))
+                        item.update(status=status, reviewed_by=admin_id, version=version + 1)
+                    conn.execute('RELEASE moderate_item')
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO moderate_item')
+                    conn.execute('RELEASE moderate_item')
+                    logger.error(f"Ошибка модерации {table} #{item_id}: {e}")
+                    results.append({'id': item_id, 'result': 'error', 'item': item})
+                    continue
+                results.append({'id': item_id, 'result': 'done' if updated else 'conflict', 'item': item})
+        
+        approved = [result['item'] for result in results if result['result'] == 'done' and status == 'approved']
+        if table == 'white_list_applications':
+            for item in approved:
+                self.white_index.add(item['username'])
+        elif table == 'scam_reports':
+            for item in approved:
+                self.scam_index.add(item['scammer_username'])
+        elif table == 'appeal_applications':
+            for item in approved:
+                self.scam_index.discard(item['username'])
+        if any(result['result'] == 'done' for result in results):
+            self._notify_change(table)
+        if approved and table in MODERATION_LISTS:
+            self._notify_change(MODERATION_LISTS[table])
+        return results
+
+    def add_user(self, user_id: int, username: str, first_name: str, last_name: str = None):
+        """Отложенная запись: повторные /start одного пользователя схлопываются"""
+        self.write_buffer.put('bot_users', (user_id, username, first_name, last_name))
+
+    def get_all_users(self) -> List[int]:
+        cursor = self.pool.connection().execute('SELECT user_id FROM bot_users')
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_security_summary(self, hours: int = 24, limit: int = 5) -> Dict:
+        """Сводка security_logs за последние hours часов: по типам событий и самые активные пользователи"""
+        since = f'-{int(hours)} hours'
+        by_type = self._fetchall('''
+            SELECT activity, SUM(occurrences) AS events, COUNT(DISTINCT user_id) AS users, MAX(timestamp) AS last_seen
+            FROM security_logs
+            WHERE timestamp >= datetime('now', ?)
+            GROUP BY activity
+            ORDER BY events DESC
+        ''', (since,))
+        top_users = self._fetchall('''
+            SELECT user_id, SUM(occurrences) AS events
+            FROM security_logs
+            WHERE timestamp >= datetime('now', ?)
+            GROUP BY user_id
+            ORDER BY events DESC
+            LIMIT ?
+        ''', (since, limit))
+        return {'by_type': by_type, 'top_users': top_users}
+
+    def get_stats_snapshot(self, days: int = 7) -> Dict:
+        """Все счетчики и дневные сводки за days дней: два запроса по маленьким таблицам"""
+        counters = {row['name']: row['value'] for row in self._fetchall('SELECT name, value FROM counters')}
+        daily = defaultdict(dict)
+        for row in self._fetchall('''
+            SELECT day, metric, value FROM daily_stats
+            WHERE day > date('now', ?)
+        ''', (f'-{days} days',)):
+            daily[row['day']][row['metric']] = row['value']
+        return {'counters': counters, 'daily': dict(daily)}
+
+    def search_lists(self, match: str, limit: int = 10) -> Dict[str, List[Dict]]:
+        """Поиск по белому списку и списку скамеров, лучшие совпадения первыми.
+
+        match - готовое выражение FTS5 (см. build_search_query).
+        """
+        white = self._fetchall('''
+            SELECT w.id, w.username, w.activity, w.city
+            FROM white_list_fts f JOIN white_list w ON w.id = f.rowid
+            WHERE white_list_fts MATCH ? AND w.status = 'approved'
+            ORDER BY f.rank
+            LIMIT ?
+        ''', (match, limit))
+        scam = self._fetchall('''
+            SELECT s.id, s.username, s.reason
+            FROM scam_list_fts f JOIN scam_list s ON s.id = f.rowid
+            WHERE scam_list_fts MATCH ? AND s.status = 'active'
+            ORDER BY f.rank
+            LIMIT ?
+        ''', (match, limit))
+        return {'white': white, 'scam': scam}
+
+    def get_setting(self, key: str, default: str = None) -> Optional[str]:
+        value = self._scalar('SELECT value FROM settings WHERE key = ?', (key,))
+        return default if value is None else value
+
+    def create_broadcast(self, admin_id: int, text: str) -> int:
+        return self._write('''
+            INSERT INTO broadcasts (admin_id, text, total)
+            VALUES (?, ?, (SELECT value FROM counters WHERE name = 'bot_users'))
+        ''', (admin_id, text))
+
+    def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        return self._fetchone('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+
+    def get_broadcasts(self, status: str = None, limit: int = 5) -> List[Dict]:
+        if status:
+            return self._fetchall('SELECT * FROM broadcasts WHERE status = ? ORDER BY id DESC LIMIT ?', (status, limit))
+        return self._fetchall('SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?', (limit,))
+
+    def get_broadcast_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> List[int]:
+        """Следующая пачка получателей по первичному ключу bot_users, без уже обработанных"""
+        cursor = self.pool.connection().execute('''
+            SELECT user_id FROM bot_users u
+            WHERE user_id > ? AND NOT EXISTS (
+                SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = u.user_id
+            )
+            ORDER BY user_id LIMIT ?
+        ''', (after_user_id, broadcast_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    def record_broadcast_delivery(self, broadcast_id: int, user_id: int, outcome: str):
+        """Итог отправки одному получателю (delivered, blocked, failed) и счетчик рассылки"""
+        if outcome not in ('delivered', 'blocked', 'failed'):
+            raise ValueError(f"Неизвестный итог отправки: {outcome}")
+        with self.pool.transaction() as conn:
+            inserted = conn.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, outcome) VALUES (?, ?, ?)
+            ''', (broadcast_id, user_id, outcome)).rowcount
+            if inserted:
+                conn.execute('''
+                    UPDATE broadcasts SET delivered = delivered + (? = 'delivered'),
+                        blocked = blocked + (? = 'blocked'), failed = failed + (? = 'failed')
+                    WHERE id = ?
+                ''', (outcome, outcome, outcome, broadcast_id))
+
+    def save_broadcast_progress(self, broadcast_id: int, last_user_id: int):
+        """Сдвиг курсора; отметки получателей до него больше не нужны"""
+        with self.pool.transaction() as conn:
+            conn.execute('UPDATE broadcasts SET last_user_id = ? WHERE id = ?', (last_user_id, broadcast_id))
+            conn.execute('DELETE FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id <= ?',
+                         (broadcast_id, last_user_id))
+
+    def set_broadcast_status(self, broadcast_id: int, status: str):
+        with self.pool.transaction() as conn:
+            conn.execute('''
+                UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (status, broadcast_id))
+            conn.execute('DELETE FROM broadcast_deliveries WHERE broadcast_id = ?', (broadcast_id,))
+
+    def log_action(self, admin_id: int, action: str, target_user_id: int = None, details: str = None):
+        self.write_buffer.put('action_logs', (admin_id, action, target_user_id, details))
+
+    def _insert_with_proofs(self, table: str, query: str, params: tuple,
+                            attachments: Optional[List[Dict]] = None) -> int:
+        """Вставка заявки вместе с ее доказательствами одной транзакцией, возвращает id заявки"""
+        with self.pool.transaction() as conn:
+            owner_id = conn.execute(query, params).lastrowid
+            if attachments:
+                # Файл, уже приложенный к другой заявке, хранится один раз
+                conn.executemany('''
+                    INSERT OR IGNORE INTO proof_files (file_unique_id, file_id, kind, file_size)
+                    VALUES (:file_unique_id, :file_id, :kind, :file_size)
+                ''', attachments)
+                conn.executemany('''
+                    INSERT OR IGNORE INTO proof_links (owner_type, owner_id, file_unique_id, position)
+                    VALUES (?, ?, ?, ?)
+                ''', [(table, owner_id, item['file_unique_id'], position)
+                      for position, item in enumerate(attachments)])
+            if table in MODERATION_TABLES:
+                conn.execute(SCHEDULE_JOB_SQL, ('moderation_expiry', f"{table}:{owner_id}",
+                                                int(time.time()) + PENDING_EXPIRY))
+        self._notify_change("jobs")
+        return owner_id
+
+    def get_proofs(self, owner_type: str, owner_id: int) -> List[Dict]:
+        return self._fetchall('''
+            SELECT f.file_unique_id, f.file_id, f.kind
+            FROM proof_links l JOIN proof_files f ON f.file_unique_id = l.file_unique_id
+            WHERE l.owner_type = ? AND l.owner_id = ?
+            ORDER BY l.position
+        ''', (owner_type, owner_id))
+
+    def find_proof_reuse(self, owner_type: str, owner_id: int) -> List[Dict]:
+        """Другие заявки и жалобы, к которым прикладывались те же файлы"""
+        return self._fetchall('''
+            SELECT other.owner_type, other.owner_id, COUNT(*) AS files
+            FROM proof_links own
+            JOIN proof_links other ON other.file_unique_id = own.file_unique_id
+            WHERE own.owner_type = ? AND own.owner_id = ?
+              AND NOT (other.owner_type = own.owner_type AND other.owner_id = own.owner_id)
+            GROUP BY other.owner_type, other.owner_id
+            ORDER BY other.owner_id DESC
+            LIMIT 10
+        ''', (owner_type, owner_id))
+
+    def add_white_list_application(self, user_data: Dict) -> int:
         try:
             # Валидация данных
             if not all(key in user_data for key in ['user_id', 'username', 'activity']):
                 raise ValueError("Missing required fields")
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
+            application_id = self._insert_with_proofs('white_list_applications', '''
                 INSERT INTO white_list_applications 
                 (user_id, username, activity, city, link, description, proofs, file_ids)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -565,13 +1950,14 @@ class Database:
                 user_data['link'],
                 user_data['description'],
                 user_data['proofs'],
-                user_data.get('file_ids', '')
-            ))
-            application_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+                user_data.get('file_ids') or legacy_file_ids(user_data.get('attachments'))
+            ), user_data.get('attachments'))
+            self._notify_change("white_list_applications")
             return application_id
         except Exception as e:
+            if is_database_locked(e):
+                # Повтор с паузой выполнит AsyncDatabase
+                raise
             logger.error(f"Error adding white list application: {e}")
             return 0
 
@@ -581,9 +1967,7 @@ class Database:
             if not all(key in report_data for key in ['reporter_id', 'scammer_username', 'description']):
                 raise ValueError("Missing required fields")
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
+            report_id = self._insert_with_proofs('scam_reports', '''
                 INSERT INTO scam_reports 
                 (reporter_id, scammer_username, description, proofs, file_ids)
                 VALUES (?, ?, ?, ?, ?)
@@ -592,13 +1976,14 @@ class Database:
                 report_data['scammer_username'],
                 report_data['description'],
                 report_data['proofs'],
-                report_data.get('file_ids', '')
-            ))
-            report_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+                report_data.get('file_ids') or legacy_file_ids(report_data.get('attachments'))
+            ), report_data.get('attachments'))
+            self._notify_change("scam_reports")
             return report_id
         except Exception as e:
+            if is_database_locked(e):
+                # Повтор с паузой выполнит AsyncDatabase
+                raise
             logger.error(f"Error adding scam report: {e}")
             return 0
 
@@ -608,9 +1993,7 @@ class Database:
             if not all(key in appeal_data for key in ['user_id', 'username', 'explanation']):
                 raise ValueError("Missing required fields")
             
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
+            appeal_id = self._insert_with_proofs('appeal_applications', '''
                 INSERT INTO appeal_applications 
                 (user_id, username, explanation, proofs, file_ids)
                 VALUES (?, ?, ?, ?, ?)
@@ -619,103 +2002,401 @@ class Database:
                 appeal_data['username'],
                 appeal_data['explanation'],
                 appeal_data['proofs'],
-                appeal_data.get('file_ids', '')
-            ))
-            appeal_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+                appeal_data.get('file_ids') or legacy_file_ids(appeal_data.get('attachments'))
+            ), appeal_data.get('attachments'))
+            self._notify_change("appeal_applications")
             return appeal_id
         except Exception as e:
+            if is_database_locked(e):
+                # Повтор с паузой выполнит AsyncDatabase
+                raise
             logger.error(f"Error adding appeal: {e}")
             return 0
 
+    def load_scam_index(self):
+        cursor = self.pool.connection().execute('SELECT username FROM scam_list WHERE status = "active"')
+        self.scam_index.load(row[0] for row in cursor)
+        logger.info(f"Индекс скамеров загружен: {len(self.scam_index)} username")
+
+    def load_white_index(self):
+        cursor = self.pool.connection().execute('SELECT username FROM white_list WHERE status = "approved"')
+        self.white_index.load(row[0] for row in cursor)
+        logger.info(f"Индекс белого списка загружен: {len(self.white_index)} username")
+
+    def get_list_entry(self, username: str) -> Dict[str, Optional[Dict]]:
+        """Свежие записи о username в списке скамеров и белом списке, без регистра и "@" """
+        normalized = UsernameIndex.normalize(username)
+        scam = self._fetchone('''
+            SELECT username, reason, created_at FROM scam_list
+            WHERE lower(ltrim(username, '@')) = ? AND status = 'active'
+            ORDER BY id DESC LIMIT 1
+        ''', (normalized,))
+        white = self._fetchone('''
+            SELECT username, activity, city, created_at FROM white_list
+            WHERE lower(ltrim(username, '@')) = ? AND status = 'approved'
+            ORDER BY id DESC LIMIT 1
+        ''', (normalized,))
+        return {'scam': scam, 'white': white}
+
     def is_user_in_scam_list(self, username: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM scam_list WHERE username = ? AND status = "active"', (username,))
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count > 0
+        """Проверка по индексу в памяти, без регистра и "@" """
+        return username in self.scam_index
 
     def remove_from_scam_list(self, username: str) -> bool:
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE scam_list SET status = "removed" WHERE username = ?', (username,))
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                conn.execute('UPDATE scam_list SET status = "removed" WHERE username = ?', (username,))
+                # Запись могла быть добавлена в другом регистре или с "@"
+                still_active = conn.execute(
+                    'SELECT 1 FROM scam_list WHERE status = "active" AND lower(ltrim(username, "@")) = ? LIMIT 1',
+                    (UsernameIndex.normalize(username),)
+                ).fetchone()
+            if not still_active:
+                self.scam_index.discard(username)
+            self._notify_change('scam_list')
             return True
         except Exception as e:
+            if is_database_locked(e):
+                # Повтор с паузой выполнит AsyncDatabase
+                raise
             logger.error(f"Error removing from scam list: {e}")
             return False
 
     def add_info_request(self, request_data: Dict) -> int:
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO info_requests 
-                (request_type, request_id, user_id, admin_id, request_text)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                request_data['request_type'],
-                request_data['request_id'],
-                request_data['user_id'],
-                request_data['admin_id'],
-                request_data['request_text']
-            ))
-            request_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                request_id = conn.execute('''
+                    INSERT INTO info_requests 
+                    (request_type, request_id, user_id, admin_id, request_text)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (
+                    request_data['request_type'],
+                    request_data['request_id'],
+                    request_data['user_id'],
+                    request_data['admin_id'],
+                    request_data['request_text']
+                )).lastrowid
+                conn.execute(SCHEDULE_JOB_SQL, ('info_reminder', str(request_id),
+                                                int(time.time()) + INFO_REMINDER_DELAY))
+            self._notify_change("jobs")
             return request_id
         except Exception as e:
+            if is_database_locked(e):
+                # Повтор с паузой выполнит AsyncDatabase
+                raise
             logger.error(f"Error adding info request: {e}")
             return 0
 
     def get_active_info_request(self, user_id: int, request_type: str = None):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
         if request_type:
-            cursor.execute('SELECT * FROM info_requests WHERE user_id = ? AND request_type = ? AND status = "pending" ORDER BY id DESC LIMIT 1', 
-                         (user_id, request_type))
-        else:
-            cursor.execute('SELECT * FROM info_requests WHERE user_id = ? AND status = "pending" ORDER BY id DESC LIMIT 1', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+            return self._fetchone('SELECT * FROM info_requests WHERE user_id = ? AND request_type = ? AND status = "pending" ORDER BY id DESC LIMIT 1', 
+                                  (user_id, request_type))
+        return self._fetchone('SELECT * FROM info_requests WHERE user_id = ? AND status = "pending" ORDER BY id DESC LIMIT 1', (user_id,))
 
     def update_info_request_response(self, request_id: int, response_text: str, response_files: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
+        self._write('''
             UPDATE info_requests 
             SET response_text = ?, response_files = ?, status = 'completed'
             WHERE id = ?
         ''', (response_text, response_files, request_id))
-        conn.commit()
-        conn.close()
+
+    def close_info_request(self, request_id: int, status: str):
+        self._write('UPDATE info_requests SET status = ? WHERE id = ?', (status, request_id))
 
     def get_info_request_by_id(self, request_id: int):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM info_requests WHERE id = ?', (request_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+        return self._fetchone('SELECT * FROM info_requests WHERE id = ?', (request_id,))
 
     def get_info_request_by_type_id(self, request_type: str, request_id: int):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM info_requests WHERE request_type = ? AND request_id = ? AND status = "pending"', 
-                       (request_type, request_id))
-        result = cursor.fetchone()
-        conn.close()
-        return dict(result) if result else None
+        return self._fetchone('SELECT * FROM info_requests WHERE request_type = ? AND request_id = ? AND status = "pending"', 
+                              (request_type, request_id))
+
+    # Отложенные задачи
+
+    def schedule_job(self, kind: str, key: str, due_at: int, replace: bool = True):
+        """replace=False - не переносить срок уже запланированной задачи"""
+        if replace:
+            self._write(SCHEDULE_JOB_SQL, (kind, key, due_at))
+        else:
+            self._write('INSERT OR IGNORE INTO jobs (kind, key, due_at) VALUES (?, ?, ?)', (kind, key, due_at))
+        self._notify_change("jobs")
+
+    def get_due_jobs(self, now: int, limit: int) -> List[Dict]:
+        return self._fetchall('SELECT * FROM jobs WHERE due_at <= ? ORDER BY due_at LIMIT ?', (now, limit))
+
+    def get_next_job_due(self) -> Optional[int]:
+        return self._scalar('SELECT MIN(due_at) FROM jobs')
+
+    def reschedule_job(self, kind: str, key: str, due_at: int, attempts: int = 0):
+        """Перенос после выполнения: без уведомления, планировщик сам перечитает ближайший срок"""
+        self._write('UPDATE jobs SET due_at = ?, attempts = ? WHERE kind = ? AND key = ?',
+                    (due_at, attempts, kind, key))
+
+    def delete_job(self, kind: str, key: str):
+        self._write('DELETE FROM jobs WHERE kind = ? AND key = ?', (kind, key))
+
+    def get_job_stats(self) -> List[Dict]:
+        return self._fetchall('SELECT kind, COUNT(*) AS jobs, MIN(due_at) AS next_due FROM jobs GROUP BY kind')
+
+    def get_stale_pending_counts(self, age: int) -> Dict[str, int]:
+        """Заявки в ожидании дольше age секунд, по индексу (status, created_at)"""
+        return {
+            table: self._scalar(
+                f"SELECT COUNT(*) FROM {table} WHERE status = 'pending' AND created_at < datetime('now', ?)",
+                (f'-{age} seconds',))
+            for table in MODERATION_TABLES
+        }
+
+    # Обслуживание
+
+    def optimize(self):
+        """PRAGMA optimize: ANALYZE только тех таблиц, где статистика устарела"""
+        self.pool.connection().execute('PRAGMA optimize')
+
+    def database_sizes(self) -> Dict[str, int]:
+        """Размеры в байтах: файл базы, WAL и свободные страницы внутри файла"""
+        conn = self.pool.connection()
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return {
+            'file': file_size(self.db_path),
+            'wal': file_size(self.db_path + '-wal'),
+            'free': conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size,
+        }
+
+    def checkpoint_wal(self, mode: str = 'TRUNCATE') -> tuple:
+        """(busy, страниц в WAL, перенесено в базу); busy=1 - мешали читатели, WAL не усечен"""
+        return tuple(self.pool.connection().execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+    def incremental_vacuum(self) -> int:
+        """Отдает ОС свободные страницы файла, возвращает их число.
+
+        База, созданная без auto_vacuum=INCREMENTAL, один раз переводится в
+        этот режим полным VACUUM.
+        """
+        conn = self.pool.connection()
+        # freelist_count читается первым: он перечитывает заголовок файла, иначе соединение
+        # другого потока может вернуть auto_vacuum, устаревший после VACUUM
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+            logger.info("База переведена в режим auto_vacuum=INCREMENTAL")
+        elif free_pages:
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+        return free_pages
+
+    def optimize_search_indexes(self) -> List[str]:
+        """Слияние сегментов FTS5-индексов поиска"""
+        tables = [row['name'] for row in self._fetchall(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL TABLE%fts5%'")]
+        with self.pool.transaction() as conn:
+            for table in tables:
+                conn.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+        return tables
+
+    def archive_logs(self, table: str, column: str, cutoff: str, path: str, batch: int = 5000) -> int:
+        """Строки table с column < cutoff дописываются в gzip-файл path (JSON по строке) и удаляются.
+
+        Пачка удаляется в той же транзакции, после того как записана в архив:
+        при сбое строки могут попасть в архив дважды, но не потеряются.
+        """
+        archived = 0
+        archive = None
+        try:
+            while True:
+                with self.pool.transaction() as conn:
+                    rows = conn.execute(
+                        f'SELECT * FROM {table} WHERE {column} < ? ORDER BY id LIMIT ?', (cutoff, batch)
+                    ).fetchall()
+                    if not rows:
+                        break
+                    if archive is None:
+                        archive = gzip.open(path, 'at', encoding='utf-8')
+                    archive.writelines(json.dumps(dict(row), ensure_ascii=False) + "\n" for row in rows)
+                    archive.flush()
+                    conn.execute(f'DELETE FROM {table} WHERE id <= ? AND {column} < ?', (rows[-1]['id'], cutoff))
+                archived += len(rows)
+        finally:
+            if archive:
+                archive.close()
+        return archived
+
+    def load_persistent_state(self) -> tuple:
+        """Теплый старт SQLitePersistence: удаляет строки удаленных ключей и читает остальное"""
+        with self.pool.transaction() as conn:
+            conn.execute('DELETE FROM persistent_data WHERE value IS NULL')
+            conn.execute('DELETE FROM conversations WHERE state IS NULL')
+            data = conn.execute('SELECT scope, owner, key, value FROM persistent_data').fetchall()
+            conversations = conn.execute('SELECT name, key, state FROM conversations').fetchall()
+        return data, conversations
+
+db_lock_retries_total = metrics.counter("bot_db_lock_retries_total", "Повторы запросов после database is locked")
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database: запросы уходят в выделенные потоки, event loop не блокируется"""
+
+    def __init__(self, database: Database, max_workers: int = 4, base_delay: float = 0.05):
+        self.database = database
+        self.max_retries = database.max_retries
+        self.base_delay = base_delay
+        # У каждого потока исполнителя свое соединение из ConnectionPool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить синхронную функцию в потоке БД с экспоненциальной асинхронной паузой при блокировке"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await loop.run_in_executor(self._executor, call)
+            except sqlite3.OperationalError as e:
+                if not is_database_locked(e) or attempt == self.max_retries:
+                    raise
+                db_lock_retries_total.inc()
+                await asyncio.sleep(self.base_delay * (2 ** attempt))
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+        # Полное время вызова из event loop, включая ожидание свободного потока БД
+        latency = metrics.histogram("bot_db_call_duration_seconds", "Вызов метода Database через AsyncDatabase",
+                                    method=name)
+
+        async def method(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await self.run(attr, *args, **kwargs)
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        method.__name__ = name
+        return method
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self.database.close()
 
 db = Database()
+async_db = AsyncDatabase(db)
+security_manager.event_sink = db.write_buffer
+
+# ==================== ХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ====================
+
+class SQLitePersistence(BasePersistence):
+    """Состояние ConversationHandler и user_data/chat_data/bot_data в базе бота.
+
+    Каждый ключ словаря хранится отдельной строкой в JSON. При сохранении
+    пишутся только ключи, изменившиеся с прошлой записи, и уходят они через
+    отложенную запись пачкой. Все данные читаются один раз при запуске.
+    """
+
+    def __init__(self, database: Database, update_interval: float = 5):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.database = database
+        self._loaded = False
+        self._data: Dict[str, Dict[int, dict]] = {'user': {}, 'chat': {}, 'bot': {}}
+        self._conversations: Dict[str, dict] = {}
+        # Последние записанные значения: (scope, owner) -> {key: json}
+        self._written: Dict[tuple, Dict[str, str]] = {}
+        self._unserializable: Set[str] = set()
+        self.written_keys = 0
+
+    def _load(self):
+        if self._loaded:
+            return
+        rows, conversations = self.database.load_persistent_state()
+        for row in rows:
+            scope, owner, key = row['scope'], row['owner'], row['key']
+            self._data[scope].setdefault(owner, {})[key] = json.loads(row['value'])
+            self._written.setdefault((scope, owner), {})[key] = row['value']
+        for row in conversations:
+            key = tuple(json.loads(row['key']))
+            self._conversations.setdefault(row['name'], {})[key] = json.loads(row['state'])
+        self._loaded = True
+        logger.info(f"Состояние диалогов загружено: {len(rows)} ключей, {len(conversations)} диалогов")
+
+    def _save(self, scope: str, owner: int, data: dict):
+        written = self._written.setdefault((scope, owner), {})
+        for key, value in data.items():
+            try:
+                if not isinstance(key, str):
+                    raise TypeError(f"ключ {key!r} не строка")
+                encoded = json.dumps(value, ensure_ascii=False, sort_keys=True)
+            except (TypeError, ValueError) as e:
+                if str(key) not in self._unserializable:
+                    self._unserializable.add(str(key))
+                    logger.warning(f"{scope}_data[{key!r}] не сохраняется: {e}")
+                continue
+            if written.get(key) != encoded:
+                written[key] = encoded
+                self.database.write_buffer.put('persistent_data', (scope, owner, key, encoded))
+                self.written_keys += 1
+        for key in [key for key in written if key not in data]:
+            # NULL - удаленный ключ, такие строки вычищаются при следующем запуске
+            del written[key]
+            self.database.write_buffer.put('persistent_data', (scope, owner, key, None))
+        if not written:
+            del self._written[(scope, owner)]
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        self._load()
+        return self._data['user']
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        self._load()
+        return self._data['chat']
+
+    async def get_bot_data(self) -> dict:
+        self._load()
+        return self._data['bot'].get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        self._load()
+        return self._conversations.get(name, {}).copy()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        states = self._conversations.setdefault(name, {})
+        if new_state is None:
+            states.pop(key, None)
+        else:
+            states[key] = new_state
+        self.database.write_buffer.put('conversations', (
+            name, json.dumps(list(key)), None if new_state is None else json.dumps(new_state)
+        ))
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._save('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._save('chat', chat_id, data)
+
+    async def update_bot_data(self, data: dict):
+        self._save('bot', 0, data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._save('user', user_id, {})
+
+    async def drop_chat_data(self, chat_id: int):
+        self._save('chat', chat_id, {})
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        self.database.write_buffer.flush()
+
 
 # Клавиатуры (без изменений)
 def get_main_menu_keyboard():
@@ -738,76 +2419,304 @@ def get_cancel_keyboard():
 
 def get_provide_info_keyboard(request_id: int, request_type: str):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📤 Отправить информацию", callback_data=f"provide_{request_type}_{request_id}")],
-        [InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_provide_{request_type}_{request_id}")]
+        [callback_router.button("📤 Отправить информацию", "pi", request_type, request_id)],
+        [callback_router.button("❌ Отменить", "pc", request_type, request_id)]
     ])
 
-def get_pagination_keyboard(page: int, total_pages: int, list_type: str):
+def get_pagination_keyboard(page: int, total_pages: int, list_type: str, first_row: Dict, last_row: Dict):
+    # В кнопке keyset-ключ (created_at, id) крайней записи страницы
     buttons = []
     if page > 1:
-        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{list_type}_page_{page-1}"))
+        buttons.append(callback_router.button(
+            "⬅️ Назад", "lp", list_type, "prev", page - 1, first_row['created_at'], first_row['id']))
     if page < total_pages:
-        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"{list_type}_page_{page+1}"))
+        buttons.append(callback_router.button(
+            "Вперед ➡️", "lp", list_type, "next", page + 1, last_row['created_at'], last_row['id']))
     return InlineKeyboardMarkup([buttons]) if buttons else None
 
 def get_application_actions_keyboard(application_id: int):
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🟩 Одобрить", callback_data=f"approve_white_{application_id}"),
-            InlineKeyboardButton("🟥 Отклонить", callback_data=f"reject_white_{application_id}")
+            callback_router.button("🟩 Одобрить", "ad", "white", application_id, "approved"),
+            callback_router.button("🟥 Отклонить", "ad", "white", application_id, "rejected")
         ],
         [
-            InlineKeyboardButton("🟦 Запросить доп. инфо", callback_data=f"info_white_{application_id}")
+            callback_router.button("🟦 Запросить доп. инфо", "ai", "white", application_id)
         ]
     ])
 
 def get_scam_report_actions_keyboard(report_id: int):
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🟥 Добавить в скамеры", callback_data=f"approve_scam_{report_id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_scam_{report_id}")
+            callback_router.button("🟥 Добавить в скамеры", "ad", "scam", report_id, "approved"),
+            callback_router.button("❌ Отклонить", "ad", "scam", report_id, "rejected")
         ],
         [
-            InlineKeyboardButton("🟦 Запросить доп. инфу", callback_data=f"info_scam_{report_id}")
+            callback_router.button("🟦 Запросить доп. инфу", "ai", "scam", report_id)
         ]
     ])
 
 def get_appeal_actions_keyboard(appeal_id: int):
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🔄 Снять статус", callback_data=f"approve_appeal_{appeal_id}"),
-            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_appeal_{appeal_id}")
+            callback_router.button("🔄 Снять статус", "ad", "appeal", appeal_id, "approved"),
+            callback_router.button("❌ Отклонить", "ad", "appeal", appeal_id, "rejected")
         ],
         [
-            InlineKeyboardButton("🟦 Запросить доп. инфо", callback_data=f"info_appeal_{appeal_id}")
+            callback_router.button("🟦 Запросить доп. инфо", "ai", "appeal", appeal_id)
         ]
     ])
 
-# Функция для обработки файлов (без изменений)
+# ==================== ДОКАЗАТЕЛЬСТВА ====================
+
+# Типы вложений, которые принимаются как доказательства, и их InputMedia для альбомов
+PROOF_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+# Telegram принимает в альбоме до 10 файлов; фото и видео можно смешивать, документы и аудио - нет
+MEDIA_GROUP_LIMIT = 10
+ALBUM_KINDS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+
+def extract_attachments(message) -> List[Dict]:
+    """Вложения сообщения. file_id и file_unique_id уже есть в обновлении, get_file не нужен"""
+    attachments = []
+    for kind in PROOF_MEDIA:
+        media = getattr(message, kind, None)
+        if not media:
+            continue
+        if kind == "photo":
+            # Список размеров одной фотографии, самый большой - последний
+            media = media[-1]
+        attachments.append({
+            'kind': kind,
+            'file_id': media.file_id,
+            'file_unique_id': media.file_unique_id,
+            'file_size': media.file_size,
+        })
+    return attachments
+
 async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-    file_ids = []
-    
-    if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        file_ids.append(f"photo:{file.file_id}")
-    elif update.message.document:
-        file = await update.message.document.get_file()
-        file_ids.append(f"document:{file.file_id}")
-    elif update.message.video:
-        file = await update.message.video.get_file()
-        file_ids.append(f"video:{file.file_id}")
-    elif update.message.audio:
-        file = await update.message.audio.get_file()
-        file_ids.append(f"audio:{file.file_id}")
-    
-    return ",".join(file_ids) if file_ids else ""
+    """Вложения сообщения в старом формате "тип:file_id" через запятую"""
+    return legacy_file_ids(extract_attachments(update.message))
+
+def add_proofs_to_draft(draft: Dict, attachments: List[Dict]) -> int:
+    """Добавить вложения в черновик заявки, повторно присланный файл не дублируется"""
+    files = draft.setdefault('attachments', [])
+    known = {item['file_unique_id'] for item in files}
+    added = 0
+    for item in attachments:
+        if item['file_unique_id'] not in known:
+            known.add(item['file_unique_id'])
+            files.append(item)
+            added += 1
+    return added
+
+class MediaGroupBuffer:
+    """Собирает части альбома в одну пачку.
+
+    Альбом приходит отдельными сообщениями с общим media_group_id; on_complete
+    вызывается один раз, когда delay секунд не было новых частей.
+    """
+
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay
+        self._groups: Dict[str, Dict] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add(self, group_id: str, count: int, on_complete: Callable):
+        """on_complete(count) - корутина, получает число файлов во всем альбоме"""
+        group = self._groups.get(group_id)
+        if group:
+            group['timer'].cancel()
+            group['count'] += count
+        else:
+            group = self._groups[group_id] = {'count': count}
+        group['on_complete'] = on_complete
+        group['timer'] = asyncio.get_running_loop().call_later(self.delay, self._complete, group_id)
+
+    def _complete(self, group_id: str):
+        group = self._groups.pop(group_id, None)
+        if group:
+            task = asyncio.ensure_future(group['on_complete'](group['count']))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+media_groups = MediaGroupBuffer()
+
+async def receive_proofs(update: Update, draft: Dict) -> bool:
+    """Принять вложения сообщения в черновик. Подтверждение на альбом отправляется одно.
+
+    Возвращает False, если в сообщении нет файлов.
+    """
+    message = update.message
+    attachments = extract_attachments(message)
+    if not attachments:
+        return False
+    
+    added = add_proofs_to_draft(draft, attachments)
+    total = len(draft['attachments'])
+    
+    async def acknowledge(count: int):
+        text = f"📎 Получено файлов: {count}. Всего приложено: {len(draft['attachments'])}"
+        await message.reply_text(text + "\n\nОтправьте еще файлы или нажмите «✅ Готово»")
+    
+    if message.media_group_id:
+        media_groups.add(message.media_group_id, added, acknowledge)
+    elif added:
+        await message.reply_text(f"📎 Файл добавлен. Всего приложено: {total}\n\nОтправьте еще файлы или нажмите «✅ Готово»")
+    else:
+        await message.reply_text("📎 Этот файл уже приложен")
+    return True
+
+def proof_albums(files: List[Dict]) -> List[List[Dict]]:
+    """Разбить файлы на допустимые альбомы: по типу и не больше MEDIA_GROUP_LIMIT"""
+    groups = defaultdict(list)
+    for item in files:
+        groups[ALBUM_KINDS[item['kind']]].append(item)
+    return [
+        group[start:start + MEDIA_GROUP_LIMIT]
+        for group in groups.values()
+        for start in range(0, len(group), MEDIA_GROUP_LIMIT)
+    ]
+
+async def send_proofs(bot, chat_id: int, files: List[Dict]):
+    """Отправить доказательства альбомами: один запрос на до 10 файлов"""
+    for album in proof_albums(files):
+        if len(album) == 1:
+            item = album[0]
+            await getattr(bot, f"send_{item['kind']}")(chat_id, item['file_id'])
+        else:
+            await bot.send_media_group(chat_id, [PROOF_MEDIA[item['kind']](item['file_id']) for item in album])
+
+def get_proofs_keyboard():
+    return ReplyKeyboardMarkup([["✅ Готово"], ["❌ Отменить"]], resize_keyboard=True)
+
+# Списки с keyset-пагинацией
+
+def shorten(text: Optional[str], limit: int = 60) -> str:
+    text = (text or "").replace("\n", " ")
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def format_white_list_entry(number: int, user: Dict) -> str:
+    lines = [f"{number}. @{user['username']}", f"   📝 {user['activity']}"]
+    if user['link'] and user['link'] != 'нет':
+        lines.append(f"   🔗 {user['link']}")
+    lines.append(f"   📅 {user['created_at'][:10]}")
+    return "\n".join(lines)
+
+def format_scam_list_entry(number: int, scammer: Dict) -> str:
+    return "\n".join([
+        f"{number}. @{scammer['username']}",
+        f"   ⚠️ {scammer['reason']}",
+        f"   📅 {scammer['created_at'][:10]}",
+    ])
+
+# list_type -> (заголовок, форматирование записи, метод страницы, метод счетчика)
+LIST_VIEWS = {
+    "white": ("🟩 Белый список", format_white_list_entry, "get_white_list_page", "get_white_list_count"),
+    "scam": ("🟥 Список скамеров", format_scam_list_entry, "get_scam_list_page", "get_scam_list_count"),
+}
+
+# Таблица БД -> list_type, для инвалидации кэша
+LIST_TABLES = {"white_list": "white", "scam_list": "scam"}
+
+class PageCache:
+    """Кэш отрисованных страниц списков (текст + клавиатура) со счетчиками попаданий.
+
+    У каждого списка есть поколение: запись в список увеличивает его, и страница,
+    отрисованная по данным старого поколения, в кэш уже не попадет.
+    tables - какой список сбрасывает запись в таблицу.
+    """
+
+    def __init__(self, tables: Dict[str, str], max_entries: int = 512):
+        self.tables = tables
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._pages: OrderedDict = OrderedDict()
+        self._generations = defaultdict(int)
+        # Инвалидация приходит из потоков БД
+        self._lock = threading.Lock()
+
+    def generation(self, list_type: str) -> int:
+        return self._generations[list_type]
+
+    def get(self, list_type: str, key: tuple):
+        with self._lock:
+            page = self._pages.get((list_type, key))
+            if page is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end((list_type, key))
+            self.hits += 1
+            return page
+
+    def put(self, list_type: str, generation: int, key: tuple, page: tuple):
+        with self._lock:
+            if generation != self._generations[list_type]:
+                return
+            self._pages[(list_type, key)] = page
+            self._pages.move_to_end((list_type, key))
+            if len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, list_type: str):
+        with self._lock:
+            self._generations[list_type] += 1
+            self.invalidations += 1
+            for cache_key in [cache_key for cache_key in self._pages if cache_key[0] == list_type]:
+                del self._pages[cache_key]
+
+    def on_table_change(self, table: str):
+        if table in self.tables:
+            self.invalidate(self.tables[table])
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._pages),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+list_page_cache = PageCache(LIST_TABLES)
+db.add_change_listener(list_page_cache.on_table_change)
+
+async def load_list_page(list_type: str, page: int, after: tuple = None, before: tuple = None):
+    """Текст и клавиатура страницы списка; after/before - keyset-курсор (created_at, id)"""
+    cache_key = (page, after, before)
+    cached = list_page_cache.get(list_type, cache_key)
+    if cached:
+        return cached
+    
+    generation = list_page_cache.generation(list_type)
+    title, format_entry, page_method, count_method = LIST_VIEWS[list_type]
+    rows = await getattr(async_db, page_method)(after, before)
+    if not rows:
+        rendered = (f"{title}\n\nПока нет записей", None)
+    else:
+        total_count = await getattr(async_db, count_method)()
+        total_pages = max(page, (total_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+        first_number = (page - 1) * ITEMS_PER_PAGE + 1
+        entries = [format_entry(number, row) for number, row in enumerate(rows, first_number)]
+        text = f"{title}\n\n" + "\n\n".join(entries) + f"\n\nСтраница {page} из {total_pages}"
+        rendered = (text, get_pagination_keyboard(page, total_pages, list_type, rows[0], rows[-1]))
+    
+    list_page_cache.put(list_type, generation, cache_key, rendered)
+    return rendered
 
 # ==================== ОСНОВНЫЕ ОБРАБОТЧИКИ С ЗАЩИТОЙ ====================
 
 @secure_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db.add_user(user.id, user.username or "", user.first_name, user.last_name)
+    await async_db.add_user(user.id, user.username or "", user.first_name, user.last_name)
     
     if user.id in ADMIN_IDS:
         await update.message.reply_text("👑 Панель администратора", reply_markup=get_admin_keyboard())
@@ -822,55 +2731,106 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ✉️ Подать заявку в белый список
 ❗️ Пожаловаться на скамера
 🔄 Обжаловать статус скамера
+🔍 /check @username - проверить пользователя
+🔎 /search текст - поиск по спискам
 
 Выберите действие: 👇"""
         await update.message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard())
 
 @secure_handler
 async def show_white_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    white_list = db.get_white_list(1)
-    total_count = db.get_white_list_count()
-    total_pages = (total_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-    
-    if not white_list:
-        text = "🟩 Белый список\n\nПока нет записей"
-        await update.message.reply_text(text)
-        return
-    
-    text = "🟩 Белый список\n\n"
-    for i, user in enumerate(white_list, 1):
-        text += f"{i}. @{user['username']}\n"
-        text += f"   📝 {user['activity']}\n"
-        if user['link'] and user['link'] != 'нет':
-            text += f"   🔗 {user['link']}\n"
-        text += f"   📅 {user['created_at'][:10]}\n\n"
-    
-    text += f"Страница 1 из {total_pages}"
-    reply_markup = get_pagination_keyboard(1, total_pages, "white")
+    text, reply_markup = await load_list_page("white", 1)
     await update.message.reply_text(text, reply_markup=reply_markup)
 
 @secure_handler
 async def show_scam_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    scam_list = db.get_scam_list(1)
-    total_count = db.get_scam_list_count()
-    total_pages = (total_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+    text, reply_markup = await load_list_page("scam", 1)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+@callback_router.route("lp", callback_choice(*LIST_TABLES.values()), callback_choice("next", "prev"),
+                       CALLBACK_INT, CALLBACK_TIME, CALLBACK_INT)
+async def handle_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                           list_type: str, direction: str, page: int, created_at: str, row_id: int):
+    query = update.callback_query
+    key = (created_at, row_id)
+    
+    if page <= 1:
+        # Первая страница всегда свежая: на ней должны быть новые записи
+        text, reply_markup = await load_list_page(list_type, 1)
+    elif direction == "next":
+        text, reply_markup = await load_list_page(list_type, page, after=key)
+    else:
+        text, reply_markup = await load_list_page(list_type, page, before=key)
     
-    if not scam_list:
-        text = "🟥 Список скамеров\n\nПока нет записей"
-        await update.message.reply_text(text)
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+# Username Telegram: 5-32 символа, но в списках встречаются и старые короткие
+USERNAME_PATTERN = re.compile(r'^@?([A-Za-z0-9_]{3,32})$')
+
+@secure_handler(validate_input=False)
+async def check_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) != 1:
+        await update.message.reply_text("🔍 Использование: /check @username")
         return
     
-    text = "🟥 Список скамеров\n\n"
-    for i, scammer in enumerate(scam_list, 1):
-        text += f"{i}. @{scammer['username']}\n"
-        text += f"   ⚠️ {scammer['reason']}\n"
-        text += f"   📅 {scammer['created_at'][:10]}\n\n"
+    match = USERNAME_PATTERN.match(context.args[0])
+    if not match:
+        await update.message.reply_text("❌ Некорректный username")
+        return
     
-    text += f"Страница 1 из {total_pages}"
-    reply_markup = get_pagination_keyboard(1, total_pages, "scam")
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    username = match.group(1)
+    # Индекс в памяти: без обращения к БД, поэтому без async_db
+    if db.is_user_in_scam_list(username):
+        await update.message.reply_text(f"🟥 @{username} находится в списке скамеров!")
+    else:
+        await update.message.reply_text(f"✅ @{username} не найден в списке скамеров")
 
 # Остальные обработчики остаются без изменений, но добавьте @secure_handler к основным:
+# Слова запроса для поиска: буквы, цифры и "_" (как в токенизаторе FTS5)
+SEARCH_TERM_PATTERN = re.compile(r'\w+')
+SEARCH_MAX_TERMS = 5
+SEARCH_MIN_TERM_LENGTH = 2
+
+def build_search_query(text: str) -> Optional[str]:
+    """Выражение FTS5 из пользовательского текста: каждое слово как префикс, все слова обязательны.
+
+    Слова берутся в кавычки, поэтому операторы FTS5 во вводе не работают.
+    """
+    terms = [term for term in SEARCH_TERM_PATTERN.findall(text.lower()) if len(term) >= SEARCH_MIN_TERM_LENGTH]
+    if not terms:
+        return None
+    return " AND ".join(f'"{term}"*' for term in terms[:SEARCH_MAX_TERMS])
+
+def format_search_results(text: str, results: Dict[str, List[Dict]]) -> str:
+    if not results['white'] and not results['scam']:
+        return f"🔍 По запросу «{text}» ничего не найдено"
+    lines = [f"🔍 Результаты по запросу «{text}»"]
+    if results['scam']:
+        lines += ["", "🟥 Список скамеров:"]
+        lines += [f"{number}. @{row['username']} — {shorten(row['reason'])}"
+                  for number, row in enumerate(results['scam'], 1)]
+    if results['white']:
+        lines += ["", "🟩 Белый список:"]
+        for number, row in enumerate(results['white'], 1):
+            city = f" ({row['city']})" if row['city'] else ""
+            lines.append(f"{number}. @{row['username']}{city} — {shorten(row['activity'])}")
+    return "\n".join(lines)
+
+@secure_handler(validate_input=False)
+async def search_lists(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args)
+    match = build_search_query(text)
+    if not match:
+        await update.message.reply_text(
+            "🔍 Использование: /search текст\n"
+            f"Ищет по username, деятельности, городу и причине (слова от {SEARCH_MIN_TERM_LENGTH} символов)"
+        )
+        return
+    
+    results = await async_db.search_lists(match)
+    await update.message.reply_text(format_search_results(text, results))
+
 @secure_handler
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -882,6 +2842,148 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_admin_keyboard()
     )
 
+def format_statistics(snapshot: Dict, days: int = 7) -> str:
+    counters, daily = snapshot['counters'], snapshot['daily']
+    today = datetime.now(timezone.utc).date()
+    dates = [(today - timedelta(days=offset)).isoformat() for offset in range(days)]
+
+    def added(metric: str) -> str:
+        today_value = daily.get(dates[0], {}).get(metric, 0)
+        week_value = sum(daily.get(day, {}).get(metric, 0) for day in dates)
+        return f"+{today_value} сегодня, +{week_value} за {days} дн."
+
+    def statuses(table: str) -> str:
+        return (f"⏳ {counters.get(f'{table}:pending', 0)} / "
+                f"✅ {counters.get(f'{table}:approved', 0)} / "
+                f"❌ {counters.get(f'{table}:rejected', 0)} / "
+                f"⌛ {counters.get(f'{table}:expired', 0)}")
+
+    lines = [
+        "📊 Статистика",
+        "",
+        f"👥 Пользователи бота: {counters.get('bot_users', 0)} ({added('new_users')})",
+        f"🟩 Белый список: {counters.get('white_list', 0)} ({added('white_added')})",
+        f"🟥 Скамеры: {counters.get('scam_list', 0)} ({added('scam_added')})",
+        "",
+        f"✉️ Заявки: {statuses('white_list_applications')}",
+        f"❗️ Жалобы: {statuses('scam_reports')}",
+        f"🔄 Обжалования: {statuses('appeal_applications')}",
+        f"🛠 Действия админов: {counters.get('action_logs', 0)} ({added('admin_actions')})",
+        "",
+        "📈 По дням (пользователи / заявки / жалобы / обжалования):",
+    ]
+    for day in dates:
+        metrics = daily.get(day, {})
+        lines.append(
+            f"{day[8:10]}.{day[5:7]}: {metrics.get('new_users', 0)} / {metrics.get('applications', 0)} / "
+            f"{metrics.get('reports', 0)} / {metrics.get('appeals', 0)}"
+        )
+    return "\n".join(lines)
+
+@secure_handler
+async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    snapshot = await async_db.get_stats_snapshot()
+    await update.message.reply_text(format_statistics(snapshot))
+
+@secure_handler
+async def show_cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    stats = list_page_cache.stats()
+    moderation = moderation_cache.stats()
+    inline = inline_cache.stats()
+    await update.message.reply_text(
+        "🗂 Кэш страниц списков\n\n"
+        f"Страниц в кэше: {stats['entries']}\n"
+        f"Попадания: {stats['hits']}\n"
+        f"Промахи: {stats['misses']}\n"
+        f"Доля попаданий: {stats['hit_rate']:.0%}\n"
+        f"Сбросы: {stats['invalidations']}\n\n"
+        f"📋 Очередь модерации: {moderation['entries']} страниц, "
+        f"попадания {moderation['hit_rate']:.0%}, сбросы {moderation['invalidations']}\n"
+        f"🔍 Inline-проверка: {inline['entries']} ответов, попадания {inline['hits']}, "
+        f"промахи {inline['misses']}, склеено {inline['coalesced']}"
+    )
+
+@secure_handler
+async def show_queue_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    stats = db.write_buffer.stats()
+    text = (
+        "🗄 Очереди записи\n\n"
+        f"Отложенная запись: {stats['depth']} строк в очереди\n"
+        f"Сбросов: {stats['flushes']}, записано строк: {stats['flushed_rows']}\n"
+        f"Потеряно при переполнении: {stats['dropped_rows']}"
+    )
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        updates = processor.stats()
+        text += (
+            "\n\n⚙️ Обработка обновлений\n"
+            f"В работе: {updates['in_flight']} из {updates['limit']} (пик {updates['peak_in_flight']})\n"
+            f"Пользователей с очередью: {updates['users']}\n"
+            f"Ждут своей очереди: {updates['waiting']}\n"
+            f"Обработано: {updates['processed']}"
+        )
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        text += f"\n\n💾 Состояние диалогов: записано ключей {persistence.written_keys}"
+    routes = callback_router.stats()
+    if routes or callback_router.stale:
+        text += "\n\n🔘 Inline-кнопки, мс (среднее / p95 / макс)"
+        for route in routes[:10]:
+            text += (f"\n{route['name']}: {route['calls']} шт., {route['avg'] * 1000:.1f} / "
+                     f"{route['p95'] * 1000:.1f} / {route['max'] * 1000:.1f}")
+            if route['errors']:
+                text += f", ошибок {route['errors']}"
+        text += f"\nУстаревших кнопок: {callback_router.stale}"
+    jobs = await async_db.get_job_stats()
+    if jobs:
+        text += f"\n\n🗓 Отложенные задачи (выполнено {job_scheduler.executed}, ошибок {job_scheduler.failed})"
+        now = time.time()
+        for row in jobs:
+            wait = max(0, row['next_due'] - now)
+            text += (f"\n{JOB_NAMES.get(row['kind'], row['kind'])}: {row['jobs']}, "
+                     f"ближайшая через {wait / 3600:.1f} ч.")
+    await update.message.reply_text(text)
+
+SECURITY_EVENT_NAMES = {
+    "RATE_LIMITED": "🚦 Флуд",
+    "SUSPICIOUS_INPUT": "🕵️ Подозрительный ввод",
+    "SQL_INJECTION": "💉 SQL-инъекции",
+    "MESSAGE_TOO_LONG": "📏 Слишком длинные сообщения",
+    "HANDLER_ERROR": "💥 Ошибки обработчиков",
+}
+
+@secure_handler
+async def show_security_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    hours = int(context.args[0]) if context.args and context.args[0].isdigit() else 24
+    summary = await async_db.get_security_summary(hours)
+    if not summary['by_type']:
+        await update.message.reply_text(f"🛡 За {hours} ч. событий безопасности нет")
+        return
+    
+    lines = [f"🛡 События безопасности за {hours} ч.", ""]
+    for row in summary['by_type']:
+        name = SECURITY_EVENT_NAMES.get(row['activity'], row['activity'])
+        lines.append(f"{name}: {row['events']} (пользователей: {row['users']}, последнее: {row['last_seen']})")
+    lines += ["", "Самые активные:"]
+    lines += [f"🆔 {row['user_id']}: {row['events']}" for row in summary['top_users']]
+    await update.message.reply_text("\n".join(lines))
+
 @secure_handler
 async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rules_text = """📜 Правила подачи заявок
@@ -914,57 +3016,1714 @@ async def show_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Создать безопасную среду для сделок"""
     await update.message.reply_text(about_text)
 
-# ==================== CONVERSATION HANDLERS (без изменений) ====================
+# ==================== INLINE-ПРОВЕРКА ====================
 
-# Заявка в белый список
-async def start_white_list_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Проверка безопасности
-    user = update.effective_user
-    if security_manager.is_rate_limited(user.id):
-        await update.message.reply_text("🚫 Слишком много запросов. Попробуйте через минуту.")
-        return ConversationHandler.END
-    
-    context.user_data['white_application'] = {
-        'user_id': user.id,
-        'username': user.username or user.first_name
-    }
-    
-    await update.message.reply_text(
-        "✉️ Заявка в белый список\n\n"
-        "Username и ID определены автоматически:\n"
-        f"👤 @{user.username or user.first_name}\n"
-        f"🆔 {user.id}\n\n"
-        "1. Чем ты занимаешься?\nКороткое описание деятельности:",
-        reply_markup=get_cancel_keyboard()
+# Telegram кэширует ответ на одинаковый inline-запрос у себя: списки меняются
+# редко, но новый скамер должен появиться в ответах быстро
+INLINE_CACHE_TIME = 60
+INLINE_HELP_CACHE_TIME = 3600
+
+class CoalescingCache:
+    """TTL-кэш асинхронных загрузок.
+
+    Одинаковые запросы, пришедшие пока загрузка идет, ждут ту же задачу,
+    а не запускают свою. Подходит для inline-запросов, которые Telegram
+    присылает на каждое нажатие клавиши.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: Dict[object, asyncio.Task] = {}
+        # Как в PageCache: сброс приходит из потоков БД, а загрузка, начатая
+        # до сброса, не должна положить в кэш устаревший результат
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    async def get(self, key, loader: Callable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            
+            task = self._inflight.get(key)
+            if task:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                task = asyncio.ensure_future(loader())
+                self._inflight[key] = task
+                task.add_done_callback(functools.partial(self._on_loaded, key, self._generation))
+        # shield: отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+    def _on_loaded(self, key, generation: int, task: asyncio.Task):
+        with self._lock:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+            if task.cancelled() or task.exception() or generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, task.result())
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            # Запросы после сброса не присоединяются к загрузке по старым данным
+            self._inflight.clear()
+
+    def on_table_change(self, table: str):
+        if table in LIST_TABLES:
+            self.clear()
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+inline_cache = CoalescingCache(ttl=INLINE_CACHE_TIME)
+db.add_change_listener(inline_cache.on_table_change)
+
+def inline_article(result_id: str, title: str, description: str, text: str) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=description,
+        input_message_content=InputTextMessageContent(text),
     )
-    return APPLICATION_ACTIVITY
 
-async def process_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == "❌ Отменить":
-        return await cancel_application(update, context)
+async def build_inline_results(username: str) -> List[InlineQueryResultArticle]:
+    """Ответ на inline-запрос: членство по индексам в памяти, в SQLite только за деталями найденного"""
+    in_scam = username in db.scam_index
+    in_white = username in db.white_index
+    if not in_scam and not in_white:
+        return [inline_article(
+            f"none:{username}", f"⚪️ @{username} нет в списках",
+            "Пользователь не найден ни в белом списке, ни среди скамеров",
+            f"⚪️ @{username} не найден ни в белом списке, ни в списке скамеров.\n"
+            "Будьте осторожны и используйте гаранта."
+        )]
     
-    # Валидация ввода
-    is_valid, error_msg = security_manager.validate_input(update.message.text, update.effective_user.id)
-    if not is_valid:
-        await update.message.reply_text(f"🚫 {error_msg}")
-        return APPLICATION_ACTIVITY
+    entry = await async_db.get_list_entry(username)
+    results = []
+    if in_scam and entry['scam']:
+        reason = shorten(entry['scam']['reason'], 200)
+        results.append(inline_article(
+            f"scam:{username}", f"🟥 @{username} в списке скамеров!", shorten(reason),
+            f"🟥 @{username} находится в списке скамеров!\n\n📝 Причина: {reason}"
+        ))
+    if in_white and entry['white']:
+        white = entry['white']
+        city = f"\n🏙 {white['city']}" if white['city'] else ""
+        results.append(inline_article(
+            f"white:{username}", f"🟩 @{username} в белом списке", shorten(white['activity']),
+            f"🟩 @{username} находится в белом списке.\n\n📝 {white['activity']}{city}"
+        ))
+    return results
+
+@secure_handler(rate_limit=False)
+async def inline_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    match = USERNAME_PATTERN.match(query.query.strip())
+    if not match:
+        await query.answer([inline_article(
+            "help", "🔍 Проверка пользователя", "Введите username, например durov",
+            "🔍 Проверить пользователя по белому списку и списку скамеров: "
+            f"наберите @{context.bot.username} username в любом чате."
+        )], cache_time=INLINE_HELP_CACHE_TIME)
+        return
     
-    context.user_data['white_application']['activity'] = update.message.text
-    await update.message.reply_text("2. Город / регион\nГде находится пользователь:")
-    return APPLICATION_CITY
+    username = UsernameIndex.normalize(match.group(1))
+    results = await inline_cache.get(username, functools.partial(build_inline_results, username))
+    await query.answer(results, cache_time=INLINE_CACHE_TIME)
 
-# Аналогично добавьте валидацию в process_city, process_link и т.д.
+# ==================== ОЧЕРЕДЬ МОДЕРАЦИИ ====================
 
-# Остальной код ConversationHandlers остается без изменений...
+MODERATION_QUEUES = {
+    # ключ в callback_data: (таблица, заголовок, подпись кнопки одобрения)
+    "white": ("white_list_applications", "✉️ Заявки в белый список", "🟩 Одобрить"),
+    "scam": ("scam_reports", "❗️ Жалобы на скамеров", "🟥 Добавить в скамеры"),
+    "appeal": ("appeal_applications", "🔄 Обжалования", "🔄 Снять статус"),
+}
 
-# ==================== ЗАПУСК БОТА ====================
+MODERATION_STATUSES = {
+    "pending": "⏳ На рассмотрении",
+    "approved": "✅ Одобренные",
+    "rejected": "❌ Отклоненные",
+    # Закрытые планировщиком без решения (PENDING_EXPIRY)
+    "expired": "⌛ Просроченные",
+}
 
-def main():
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN не установлен. Установите переменную окружения BOT_TOKEN.")
-        return
+MODERATION_NOTICES = {
+    ("white", "approved"): "🟩 Ваша заявка в белый список одобрена!",
+    ("white", "rejected"): "🟥 Ваша заявка в белый список отклонена.",
+    ("scam", "approved"): "✅ Ваша жалоба рассмотрена: пользователь добавлен в список скамеров.",
+    ("scam", "rejected"): "❌ Ваша жалоба на скамера отклонена.",
+    ("appeal", "approved"): "🔄 Обжалование одобрено: статус скамера снят.",
+    ("appeal", "rejected"): "❌ Ваше обжалование отклонено.",
+    ("white", "expired"): "⌛ Ваша заявка в белый список закрыта: срок рассмотрения истек. Вы можете подать ее заново.",
+    ("scam", "expired"): "⌛ Ваша жалоба на скамера закрыта: срок рассмотрения истек.",
+    ("appeal", "expired"): "⌛ Ваше обжалование закрыто: срок рассмотрения истек. Вы можете подать его заново.",
+}
+
+MODERATION_QUEUE_BY_TABLE = {table: queue for queue, (table, _, _) in MODERATION_QUEUES.items()}
+
+# Поля callback_data кнопок модерации
+CALLBACK_QUEUE = callback_choice(*MODERATION_QUEUES)
+CALLBACK_STATUS = callback_choice(*MODERATION_STATUSES)
+CALLBACK_DECISION = callback_choice("approved", "rejected")
+
+# Сколько заявок можно выбрать для одного массового решения
+MAX_BULK_MODERATION = 50
+
+moderation_cache = PageCache({table: table for table in MODERATION_TABLES})
+db.add_change_listener(moderation_cache.on_table_change)
+
+def format_moderation_row(queue: str, row: Dict) -> str:
+    if queue == "white":
+        city = f" ({row['city']})" if row['city'] else ""
+        return f"#{row['id']} @{row['username']}{city} — {shorten(row['activity'])}"
+    if queue == "scam":
+        return f"#{row['id']} на @{row['scammer_username']} — {shorten(row['description'])}"
+    return f"#{row['id']} @{row['username']} — {shorten(row['explanation'])}"
+
+def format_moderation_item(queue: str, item: Dict) -> str:
+    title = MODERATION_QUEUES[queue][1]
+    lines = [f"{title} #{item['id']}", ""]
+    if queue == "white":
+        lines += [
+            f"👤 @{item['username']} (ID {item['user_id']})",
+            f"📝 {item['activity']}",
+            f"🏙 {item['city'] or '—'}",
+            f"🔗 {item['link'] or '—'}",
+            f"📄 {item['description'] or '—'}",
+        ]
+    elif queue == "scam":
+        lines += [
+            f"🎯 На кого: @{item['scammer_username']}",
+            f"👤 Автор жалобы: {item['reporter_id']}",
+            f"📄 {item['description']}",
+        ]
+    else:
+        lines += [
+            f"👤 @{item['username']} (ID {item['user_id']})",
+            f"📄 {item['explanation']}",
+        ]
+    lines += [
+        f"📎 Доказательства: {item['proofs'] or '—'}",
+        f"📅 {item['created_at']}",
+        f"Статус: {MODERATION_STATUSES.get(item['status'], item['status'])}",
+    ]
+    if item['admin_notes']:
+        lines.append(f"🗒 {item['admin_notes']}")
+    return "\n".join(lines)
+
+def get_moderation_item_keyboard(queue: str, item: Dict, files: int = 0):
+    item_id = item['id']
+    rows = []
+    if files:
+        rows.append([callback_router.button(f"📎 Доказательства ({files})", "mf", queue, item_id)])
+    if item['status'] == "pending":
+        # version в callback_data: решение по устаревшей карточке не применится
+        rows.append([
+            callback_router.button(MODERATION_QUEUES[queue][2], "md", queue, item_id, item['version'], "approved"),
+            callback_router.button("❌ Отклонить", "md", queue, item_id, item['version'], "rejected"),
+        ])
+        rows.append([callback_router.button("🟦 Запросить доп. инфо", "ai", queue, item_id)])
+    rows.append([callback_router.button("🔙 К очереди", "mp", queue, item['status'])])
+    return InlineKeyboardMarkup(rows)
+
+PROOF_OWNERS = {table: title for table, title, _ in MODERATION_QUEUES.values()}
+
+async def render_moderation_card(queue: str, item: Dict):
+    """Карточка заявки с числом файлов и предупреждением о повторно приложенных доказательствах"""
+    table = MODERATION_QUEUES[queue][0]
+    files = await async_db.get_proofs(table, item['id'])
+    text = format_moderation_item(queue, item)
+    if files:
+        text += f"\n📎 Файлов: {len(files)}"
+        reuse = await async_db.find_proof_reuse(table, item['id'])
+        if reuse:
+            text += "\n⚠️ Эти файлы уже прикладывались к:\n" + "\n".join(
+                f"   {PROOF_OWNERS.get(row['owner_type'], row['owner_type'])} #{row['owner_id']} — файлов: {row['files']}"
+                for row in reuse
+            )
+    return text, get_moderation_item_keyboard(queue, item, len(files))
+
+async def load_moderation_menu():
+    counts = await async_db.get_status_counts()
+    lines = ["📋 Управление заявками", ""]
+    buttons = []
+    for queue, (table, title, _) in MODERATION_QUEUES.items():
+        by_status = counts[table]
+        pending = by_status.get("pending", 0)
+        lines.append(f"{title}: ⏳ {pending}, ✅ {by_status.get('approved', 0)}, "
+                     f"❌ {by_status.get('rejected', 0)}, ⌛ {by_status.get('expired', 0)}")
+        buttons.append([callback_router.button(f"{title} ({pending})", "mp", queue, "pending")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def load_moderation_page(queue: str, status: str, after: tuple = None, selected: Dict[str, int] = None):
+    """Страница очереди: от старых заявок к новым, after - keyset-курсор (created_at, id).
+
+    В кэше лежат текст и строки страницы, клавиатура с отметками выбранных
+    заявок собирается для каждого администратора заново.
+    """
+    table, title, _ = MODERATION_QUEUES[queue]
+    cache_key = (status, after)
+    cached = moderation_cache.get(table, cache_key)
+    if not cached:
+        generation = moderation_cache.generation(table)
+        rows = await async_db.get_moderation_page(table, status, after)
+        total = await async_db.get_counter(f"{table}:{status}")
+        header = f"{title}\n{MODERATION_STATUSES[status]}: {total}"
+        if rows:
+            text = header + "\n\n" + "\n".join(format_moderation_row(queue, row) for row in rows)
+        else:
+            text = header + "\n\nЗаявок нет"
+        cached = (text, rows)
+        moderation_cache.put(table, generation, cache_key, cached)
+    
+    text, rows = cached
+    return text, get_moderation_page_keyboard(queue, status, after, rows, selected or {})
+
+def get_moderation_page_keyboard(queue: str, status: str, after: tuple, rows: List[Dict], selected: Dict[str, int]):
+    buttons = []
+    for row in rows:
+        view = callback_router.button(format_moderation_row(queue, row)[:60], "mv", queue, row['id'])
+        if status == "pending":
+            mark = "☑️" if str(row['id']) in selected else "⬜️"
+            buttons.append([callback_router.button(mark, "ms", queue, row['id'], row['version']), view])
+        else:
+            buttons.append([view])
+    if status == "pending" and selected:
+        buttons.append([
+            callback_router.button(f"✅ Одобрить ({len(selected)})", "mb", queue, "approved"),
+            callback_router.button(f"❌ Отклонить ({len(selected)})", "mb", queue, "rejected"),
+            callback_router.button("✖️ Сбросить", "mb", queue, "clear"),
+        ])
+    navigation = []
+    if after:
+        navigation.append(callback_router.button("⏮ В начало", "mp", queue, status))
+    if len(rows) == ITEMS_PER_PAGE:
+        navigation.append(callback_router.button(
+            "Вперед ➡️", "mp", queue, status, rows[-1]['created_at'], rows[-1]['id']))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([
+        callback_router.button(label, "mp", queue, other)
+        for other, label in MODERATION_STATUSES.items() if other != status
+    ])
+    buttons.append([callback_router.button("🔙 К очередям", "mm")])
+    return InlineKeyboardMarkup(buttons)
+
+def moderation_selection(context: ContextTypes.DEFAULT_TYPE, queue: str) -> Dict[str, int]:
+    """Выбранные для массового решения заявки администратора: {id: version}"""
+    return context.user_data.setdefault('moderation_selection', {}).setdefault(queue, {})
+
+async def reload_moderation_page(query, context: ContextTypes.DEFAULT_TYPE, queue: str):
+    """Перерисовать страницу очереди, которую администратор смотрел последней"""
+    page = context.user_data.get('moderation_page')
+    if not page or page[0] != queue:
+        page = [queue, "pending", None]
+    _, status, after = page
+    after = tuple(after) if after else None
+    text, reply_markup = await load_moderation_page(queue, status, after, moderation_selection(context, queue))
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Содержимое не изменилось
+        if "not modified" not in str(e):
+            raise
+
+async def notify_moderation_result(bot, queue: str, status: str, item: Dict):
+    owner = moderation_owner(item)
+    if not owner:
+        return
+    try:
+        await bot.send_message(owner, MODERATION_NOTICES[(queue, status)])
+    except TelegramError as e:
+        logger.warning(f"Не удалось уведомить {owner} о решении по {queue} #{item['id']}: {e}")
+
+@secure_handler
+async def show_moderation_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    text, reply_markup = await load_moderation_menu()
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+@callback_router.route("mm", admin=True)
+async def handle_moderation_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    text, reply_markup = await load_moderation_menu()
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callback_router.route("mp", CALLBACK_QUEUE, CALLBACK_STATUS, CALLBACK_TIME, CALLBACK_INT, required=2, admin=True)
+async def handle_moderation_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 queue: str, status: str, created_at: str = None, row_id: int = None):
+    query = update.callback_query
+    after = (created_at, row_id) if created_at else None
+    context.user_data['moderation_page'] = [queue, status, after]
+    text, reply_markup = await load_moderation_page(queue, status, after, moderation_selection(context, queue))
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callback_router.route("mv", CALLBACK_QUEUE, CALLBACK_INT, admin=True)
+async def handle_moderation_view(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, item_id: int):
+    query = update.callback_query
+    item = await async_db.get_moderation_item(MODERATION_QUEUES[queue][0], item_id)
+    if not item:
+        await query.answer("❌ Заявка не найдена", show_alert=True)
+        return
+    
+    await query.answer()
+    text, keyboard = await render_moderation_card(queue, item)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+@callback_router.route("mf", CALLBACK_QUEUE, CALLBACK_INT, admin=True)
+async def handle_moderation_proofs(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, item_id: int):
+    query = update.callback_query
+    files = await async_db.get_proofs(MODERATION_QUEUES[queue][0], item_id)
+    if not files:
+        await query.answer("📎 Файлов нет", show_alert=True)
+        return
+    
+    await query.answer(f"📎 Отправляю файлов: {len(files)}")
+    await send_proofs(context.bot, query.message.chat_id, files)
+
+async def decide_moderation(context: ContextTypes.DEFAULT_TYPE, queue: str, items: List[tuple],
+                            status: str, admin_id: int) -> List[Dict]:
+    """Решение по заявкам одной транзакцией и уведомления авторам одобренных/отклоненных"""
+    results = await async_db.moderate_items(
+        MODERATION_QUEUES[queue][0], items, status, admin_id, f"{status}_{queue}")
+    for result in results:
+        if result['result'] == "done":
+            await notify_moderation_result(context.bot, queue, status, result['item'])
+    return results
+
+MODERATION_RESULTS = {
+    "done": "✅ Готово",
+    "conflict": "⚠️ Уже обработаны другим администратором",
+    "missing": "❓ Не найдены",
+    "error": "💥 Ошибка при сохранении",
+}
+
+def format_moderation_summary(queue: str, status: str, results: List[Dict]) -> str:
+    grouped = defaultdict(list)
+    for result in results:
+        grouped[result['result']].append(f"#{result['id']}")
+    decision = "одобрение" if status == "approved" else "отклонение"
+    lines = [f"{MODERATION_QUEUES[queue][1]}: {decision} {len(results)} шт.", ""]
+    for result, label in MODERATION_RESULTS.items():
+        if grouped[result]:
+            lines.append(f"{label} ({len(grouped[result])}): {', '.join(grouped[result])}")
+    return "\n".join(lines)
+
+@callback_router.route("md", CALLBACK_QUEUE, CALLBACK_INT, CALLBACK_INT, CALLBACK_DECISION, admin=True)
+async def handle_moderation_decision(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                     queue: str, item_id: int, version: int, status: str):
+    query = update.callback_query
+    [result] = await decide_moderation(context, queue, [(item_id, version)], status, query.from_user.id)
+    moderation_selection(context, queue).pop(str(item_id), None)
+    
+    item = result['item']
+    if result['result'] == "missing":
+        await query.answer("❌ Заявка не найдена", show_alert=True)
+        return
+    if result['result'] == "done":
+        await query.answer("✅ Решение сохранено")
+    elif result['result'] == "conflict":
+        # Карточка устарела: заявку уже обработал другой администратор
+        await query.answer("⚠️ Заявка уже обработана другим администратором", show_alert=True)
+    else:
+        await query.answer("💥 Не удалось сохранить решение, попробуйте еще раз", show_alert=True)
+    text, keyboard = await render_moderation_card(queue, item)
+    await query.edit_message_text(text, reply_markup=keyboard)
+
+@callback_router.route("ms", CALLBACK_QUEUE, CALLBACK_INT, CALLBACK_INT, admin=True)
+async def handle_moderation_select(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                   queue: str, item_id: int, version: int):
+    query = update.callback_query
+    item_id = str(item_id)
+    selected = moderation_selection(context, queue)
+    if item_id in selected:
+        del selected[item_id]
+    elif len(selected) >= MAX_BULK_MODERATION:
+        await query.answer(f"⚠️ За раз можно обработать не больше {MAX_BULK_MODERATION} заявок", show_alert=True)
+        return
+    else:
+        selected[item_id] = version
+    
+    await query.answer()
+    await reload_moderation_page(query, context, queue)
+
+@callback_router.route("mb", CALLBACK_QUEUE, callback_choice("approved", "rejected", "clear"), admin=True)
+async def handle_moderation_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, status: str):
+    query = update.callback_query
+    selected = moderation_selection(context, queue)
+    if status == "clear" or not selected:
+        selected.clear()
+        await query.answer()
+        await reload_moderation_page(query, context, queue)
+        return
+    
+    items = [(int(item_id), version) for item_id, version in selected.items()]
+    selected.clear()
+    results = await decide_moderation(context, queue, items, status, query.from_user.id)
+    
+    await query.answer("✅ Решения сохранены")
+    await query.message.reply_text(format_moderation_summary(queue, status, results))
+    await reload_moderation_page(query, context, queue)
+
+@callback_router.route("ad", CALLBACK_QUEUE, CALLBACK_INT, CALLBACK_DECISION, admin=True)
+async def handle_quick_decision(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                queue: str, item_id: int, status: str):
+    """Кнопки уведомления о новой заявке: версии в них нет, решение принимается по текущей"""
+    query = update.callback_query
+    item = await async_db.get_moderation_item(MODERATION_QUEUES[queue][0], item_id)
+    if not item:
+        await query.answer("❌ Заявка не найдена", show_alert=True)
+        return
+    if item['status'] != "pending":
+        await query.answer("⚠️ Заявка уже обработана другим администратором", show_alert=True)
+        text, keyboard = await render_moderation_card(queue, item)
+        await query.edit_message_text(text, reply_markup=keyboard)
+        return
+    await handle_moderation_decision(update, context, queue, item_id, item['version'], status)
+
+# Запросы дополнительной информации
+
+@callback_router.route("ai", CALLBACK_QUEUE, CALLBACK_INT, admin=True)
+async def handle_info_request(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, item_id: int):
+    query = update.callback_query
+    item = await async_db.get_moderation_item(MODERATION_QUEUES[queue][0], item_id)
+    if not item or not moderation_owner(item):
+        await query.answer("❌ Заявка не найдена", show_alert=True)
+        return
+    
+    # Следующее сообщение администратора станет текстом запроса (receive_info_message)
+    context.user_data['info_question'] = [queue, item_id]
+    await query.answer()
+    await query.message.reply_text(
+        f"🟦 Напишите, какую информацию запросить по заявке #{item_id}.",
+        reply_markup=get_cancel_keyboard()
+    )
+
+@callback_router.route("pi", CALLBACK_QUEUE, CALLBACK_INT)
+async def handle_provide_info(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, item_id: int):
+    query = update.callback_query
+    request = await async_db.get_info_request_by_type_id(queue, item_id)
+    if not request or request['user_id'] != query.from_user.id:
+        await query.answer("⚠️ Запрос уже закрыт", show_alert=True)
+        return
+    
+    context.user_data['info_answer'] = request['id']
+    await query.answer()
+    await query.message.reply_text(
+        "📤 Отправьте одним сообщением ответ: текст или файл с подписью.",
+        reply_markup=get_cancel_keyboard()
+    )
+
+@callback_router.route("pc", CALLBACK_QUEUE, CALLBACK_INT)
+async def handle_cancel_provide(update: Update, context: ContextTypes.DEFAULT_TYPE, queue: str, item_id: int):
+    query = update.callback_query
+    request = await async_db.get_info_request_by_type_id(queue, item_id)
+    if request and request['user_id'] == query.from_user.id:
+        await async_db.close_info_request(request['id'], "cancelled")
+    context.user_data.pop('info_answer', None)
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=None)
+
+async def receive_info_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Последний обработчик сообщений: забирает только ожидаемый ответ на запрос информации.
+
+    Остальные сообщения пропускаются до secure_handler, чтобы не расходовать
+    лимит флуда пользователя и не отвечать там, где бот молчит.
+    """
+    if 'info_question' in context.user_data or 'info_answer' in context.user_data:
+        await handle_info_message(update, context)
+
+@secure_handler
+async def handle_info_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение после «Запросить доп. инфо» (админ) или «Отправить информацию» (автор заявки)"""
+    message = update.message
+    user = update.effective_user
+    if message.text == "❌ Отменить":
+        context.user_data.pop('info_question', None)
+        context.user_data.pop('info_answer', None)
+        await message.reply_text("❌ Отменено", reply_markup=get_main_menu_keyboard())
+        return
+    
+    text = message.text or message.caption or ""
+    if 'info_question' in context.user_data:
+        queue, item_id = context.user_data.pop('info_question')
+        item = await async_db.get_moderation_item(MODERATION_QUEUES[queue][0], item_id)
+        owner = moderation_owner(item) if item else None
+        if not owner or not text:
+            await message.reply_text("❌ Запрос не отправлен", reply_markup=get_admin_keyboard())
+            return
+        await async_db.add_info_request({
+            'request_type': queue,
+            'request_id': item_id,
+            'user_id': owner,
+            'admin_id': user.id,
+            'request_text': text,
+        })
+        try:
+            await context.bot.send_message(
+                owner,
+                f"🟦 Администратор запросил дополнительную информацию по заявке #{item_id}:\n\n{text}",
+                reply_markup=get_provide_info_keyboard(item_id, queue)
+            )
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить запрос информации {owner}: {e}")
+        await message.reply_text("✅ Запрос отправлен", reply_markup=get_admin_keyboard())
+        return
+    
+    request = await async_db.get_info_request_by_id(context.user_data.pop('info_answer'))
+    if not request or request['status'] != "pending":
+        await message.reply_text("⚠️ Запрос уже закрыт", reply_markup=get_main_menu_keyboard())
+        return
+    attachments = extract_attachments(message)
+    await async_db.update_info_request_response(request['id'], text, legacy_file_ids(attachments))
+    try:
+        await context.bot.send_message(
+            request['admin_id'],
+            f"📨 Ответ по заявке #{request['request_id']} от {user.id}:\n\n{text or '—'}",
+            reply_markup=InlineKeyboardMarkup([[
+                callback_router.button("📋 Открыть заявку", "mv", request['request_type'], request['request_id'])
+            ]])
+        )
+        await send_proofs(context.bot, request['admin_id'], attachments)
+    except TelegramError as e:
+        logger.warning(f"Не удалось переслать ответ на запрос #{request['id']}: {e}")
+    await message.reply_text("✅ Информация отправлена администратору", reply_markup=get_main_menu_keyboard())
+
+# ==================== CONVERSATION HANDLERS (без изменений) ====================
+
+# Заявка в белый список
+async def start_white_list_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Проверка безопасности
+    user = update.effective_user
+    if security_manager.is_rate_limited(user.id):
+        await update.message.reply_text("🚫 Слишком много запросов. Попробуйте через минуту.")
+        return ConversationHandler.END
+    
+    context.user_data['white_application'] = {
+        'user_id': user.id,
+        'username': user.username or user.first_name
+    }
+    
+    await update.message.reply_text(
+        "✉️ Заявка в белый список\n\n"
+        "Username и ID определены автоматически:\n"
+        f"👤 @{user.username or user.first_name}\n"
+        f"🆔 {user.id}\n\n"
+        "1. Чем ты занимаешься?\nКороткое описание деятельности:",
+        reply_markup=get_cancel_keyboard()
+    )
+    return APPLICATION_ACTIVITY
+
+async def process_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text == "❌ Отменить":
+        return await cancel_application(update, context)
+    
+    # Валидация ввода
+    is_valid, error_msg = security_manager.validate_input(update.message.text, update.effective_user.id)
+    if not is_valid:
+        await update.message.reply_text(f"🚫 {error_msg}")
+        return APPLICATION_ACTIVITY
+    
+    context.user_data['white_application']['activity'] = update.message.text
+    await update.message.reply_text("2. Город / регион\nГде находится пользователь:")
+    return APPLICATION_CITY
+
+async def save_application_field(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str,
+                                 state: int, next_state: int, prompt: str, reply_markup=None):
+    """Шаг заявки: отмена, валидация ввода, сохранение поля и следующий вопрос"""
+    if update.message.text == "❌ Отменить":
+        return await cancel_application(update, context)
+    
+    is_valid, error_msg = security_manager.validate_input(update.message.text, update.effective_user.id)
+    if not is_valid:
+        await update.message.reply_text(f"🚫 {error_msg}")
+        return state
+    
+    context.user_data['white_application'][field] = update.message.text
+    await update.message.reply_text(prompt, reply_markup=reply_markup)
+    return next_state
+
+async def process_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await save_application_field(
+        update, context, 'city', APPLICATION_CITY, APPLICATION_LINK,
+        "3. Ссылка на канал, магазин или отзывы\nЕсли ссылки нет, напишите «нет»:")
+
+async def process_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await save_application_field(
+        update, context, 'link', APPLICATION_LINK, APPLICATION_DESC,
+        "4. Расскажите о себе подробнее\nОпыт, сколько сделок провели, кто может поручиться:")
+
+async def process_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await save_application_field(
+        update, context, 'description', APPLICATION_DESC, APPLICATION_PROOFS,
+        "5. Доказательства\nПришлите скриншоты, видео, документы или ссылки, затем нажмите «✅ Готово»:",
+        reply_markup=get_proofs_keyboard())
+
+async def process_proofs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text == "❌ Отменить":
+        return await cancel_application(update, context)
+    
+    draft = context.user_data['white_application']
+    # Фото, видео, документы и аудио; альбом подтверждается одним сообщением
+    if await receive_proofs(update, draft):
+        return APPLICATION_PROOFS
+    
+    if update.message.text == "✅ Готово":
+        draft.setdefault('proofs', '')
+        await update.message.reply_text(
+            "Проверьте заявку:\n\n"
+            f"👤 @{draft['username']}\n"
+            f"📝 {draft.get('activity', '—')}\n"
+            f"🏙 {draft.get('city') or '—'}\n"
+            f"🔗 {draft.get('link') or '—'}\n"
+            f"📄 {draft.get('description') or '—'}\n"
+            f"📎 Файлов: {len(draft.get('attachments', []))}",
+            reply_markup=ReplyKeyboardMarkup([["✅ Отправить"], ["❌ Отменить"]], resize_keyboard=True)
+        )
+        return APPLICATION_CONFIRM
+    
+    if not update.message.text:
+        await update.message.reply_text("📎 Этот тип файла не принимается. Пришлите фото, видео, документ или аудио")
+        return APPLICATION_PROOFS
+    
+    # Текстовые доказательства (описание, ссылки) дописываются к уже присланным
+    is_valid, error_msg = security_manager.validate_input(update.message.text, update.effective_user.id)
+    if not is_valid:
+        await update.message.reply_text(f"🚫 {error_msg}")
+        return APPLICATION_PROOFS
+    
+    draft['proofs'] = "\n".join(filter(None, [draft.get('proofs'), update.message.text]))
+    await update.message.reply_text("📝 Добавлено. Отправьте еще доказательства или нажмите «✅ Готово»",
+                                    reply_markup=get_proofs_keyboard())
+    return APPLICATION_PROOFS
+
+async def finish_white_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text != "✅ Отправить":
+        return await cancel_application(update, context)
+    
+    draft = context.user_data.pop('white_application', None)
+    application_id = await async_db.add_white_list_application(draft) if draft else 0
+    if not application_id:
+        await update.message.reply_text("💥 Не удалось сохранить заявку, попробуйте позже",
+                                        reply_markup=get_main_menu_keyboard())
+        return ConversationHandler.END
+    
+    await update.message.reply_text(
+        f"✅ Заявка #{application_id} отправлена на рассмотрение. Решение придет в этот чат.",
+        reply_markup=get_main_menu_keyboard()
+    )
+    for admin_id in ADMIN_IDS:
+        try:
+            await context.bot.send_message(
+                admin_id,
+                f"✉️ Новая заявка в белый список #{application_id}\n\n"
+                f"👤 @{draft['username']} (ID {draft['user_id']})\n"
+                f"📝 {draft['activity']}\n"
+                f"📎 Файлов: {len(draft.get('attachments', []))}",
+                reply_markup=get_application_actions_keyboard(application_id)
+            )
+        except TelegramError as e:
+            logger.warning(f"Не удалось уведомить администратора {admin_id} о заявке #{application_id}: {e}")
+    return ConversationHandler.END
+
+async def cancel_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop('white_application', None)
+    await update.message.reply_text("❌ Заявка отменена", reply_markup=get_main_menu_keyboard())
+    return ConversationHandler.END
+
+
+# Остальной код ConversationHandlers остается без изменений...
+
+# ==================== МАССОВАЯ РАССЫЛКА ====================
+
+class AsyncRateLimiter:
+    """Равномерный интервал между операциями: не больше rate в секунду на все корутины"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(self._next_slot, now)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        """Сдвинуть все следующие слоты, например после RetryAfter от Telegram"""
+        resume_at = asyncio.get_running_loop().time() + seconds
+        self._next_slot = max(self._next_slot, resume_at)
+
+class BroadcastEngine:
+    """Массовая рассылка по bot_users.
+
+    Получатели читаются пачками по курсору user_id, пачка рассылается пулом
+    воркеров с общим ограничением частоты (лимит Telegram ~30 сообщений/с,
+    на чат приходится одно сообщение). Итог по каждому получателю сразу
+    пишется в broadcast_deliveries, курсор в broadcasts сдвигается после пачки.
+    После перезапуска рассылка продолжается с курсора и пропускает отмеченных
+    получателей: повторно может уйти только сообщение, отправленное в момент
+    остановки, но еще не отмеченное.
+    """
+
+    def __init__(self, database: AsyncDatabase, messages_per_second: float = 25, workers: int = 8,
+                 batch_size: int = 100, max_attempts: int = 3):
+        self.database = database
+        self.limiter = AsyncRateLimiter(messages_per_second)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self, bot):
+        """Продолжить рассылки, прерванные остановкой бота"""
+        self.bot = bot
+        for broadcast in await self.database.get_broadcasts('running', limit=100):
+            logger.info(f"Продолжаем рассылку #{broadcast['id']} с user_id > {broadcast['last_user_id']}")
+            self._spawn(broadcast['id'])
+
+    async def launch(self, admin_id: int, text: str) -> int:
+        broadcast_id = await self.database.create_broadcast(admin_id, text)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if not task:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await self.database.set_broadcast_status(broadcast_id, 'cancelled')
+        return True
+
+    async def stop(self):
+        """Остановка бота: рассылки остаются в статусе running и продолжатся при запуске"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id: int):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(functools.partial(self._on_task_done, broadcast_id))
+
+    def _on_task_done(self, broadcast_id: int, task: asyncio.Task):
+        self._tasks.pop(broadcast_id, None)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Рассылка #{broadcast_id} остановлена с ошибкой: {task.exception()}")
+
+    async def _run(self, broadcast_id: int):
+        broadcast = await self.database.get_broadcast(broadcast_id)
+        last_user_id = broadcast['last_user_id']
+        while True:
+            recipients = await self.database.get_broadcast_recipients(broadcast_id, last_user_id, self.batch_size)
+            if not recipients:
+                break
+            outcomes = [None] * len(recipients)
+            try:
+                await self._send_batch(broadcast_id, broadcast['text'], recipients, outcomes)
+            finally:
+                # Курсор двигается по непрерывному префиксу обработанных получателей,
+                # обработанные после первого пропуска отмечены в broadcast_deliveries
+                done = list(itertools.takewhile(lambda outcome: outcome is not None, outcomes))
+                if done:
+                    last_user_id = recipients[len(done) - 1]
+                    await self.database.save_broadcast_progress(broadcast_id, last_user_id)
+        await self.database.set_broadcast_status(broadcast_id, 'done')
+        logger.info(f"Рассылка #{broadcast_id} завершена")
+
+    async def _send_batch(self, broadcast_id: int, text: str, recipients: List[int],
+                          outcomes: List[Optional[str]]):
+        pending = iter(enumerate(recipients))
+
+        async def worker():
+            for index, chat_id in pending:
+                outcome = await self._deliver(chat_id, text)
+                await self.database.record_broadcast_delivery(broadcast_id, chat_id, outcome)
+                outcomes[index] = outcome
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(recipients)))))
+
+    async def _deliver(self, chat_id: int, text: str) -> str:
+        for attempt in range(self.max_attempts):
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return 'delivered'
+            except RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+                return 'failed'
+            except NetworkError as e:
+                logger.warning(f"Рассылка: сетевая ошибка для {chat_id} (попытка {attempt + 1}): {e}")
+            except TelegramError as e:
+                logger.warning(f"Рассылка: не удалось отправить {chat_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+broadcast_engine = BroadcastEngine(async_db)
+
+BROADCAST_STATUSES = {
+    'running': '⏳ идет',
+    'done': '✅ завершена',
+    'cancelled': '⛔️ отменена',
+}
+
+def format_broadcast(broadcast: Dict) -> str:
+    processed = broadcast['delivered'] + broadcast['blocked'] + broadcast['failed']
+    return (
+        f"#{broadcast['id']} {BROADCAST_STATUSES.get(broadcast['status'], broadcast['status'])} "
+        f"({processed}/{broadcast['total']})\n"
+        f"   📬 доставлено: {broadcast['delivered']}, 🚫 заблокировали: {broadcast['blocked']}, "
+        f"❌ ошибки: {broadcast['failed']}"
+    )
+
+# Текст рассылки может содержать ссылки и упоминания, доступ только у админов
+@secure_handler(validate_input=False)
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        await update.message.reply_text("📢 Использование: /broadcast текст рассылки")
+        return
+    
+    if await async_db.get_setting("mass_notifications", "1") != "1":
+        await update.message.reply_text("❌ Массовые рассылки отключены в настройках")
+        return
+    
+    broadcast_id = await broadcast_engine.launch(update.effective_user.id, text)
+    await async_db.log_action(update.effective_user.id, "broadcast", details=f"#{broadcast_id}")
+    await update.message.reply_text(f"📢 Рассылка #{broadcast_id} запущена. Статус: /broadcast_status")
+
+@secure_handler
+async def show_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    broadcasts = await async_db.get_broadcasts()
+    if not broadcasts:
+        await update.message.reply_text("📢 Рассылок пока не было")
+        return
+    await update.message.reply_text("📢 Последние рассылки\n\n" + "\n\n".join(map(format_broadcast, broadcasts)))
+
+@secure_handler
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_cancel номер")
+        return
+    
+    if await broadcast_engine.cancel(int(context.args[0])):
+        await update.message.reply_text(f"⛔️ Рассылка #{context.args[0]} отменена")
+    else:
+        await update.message.reply_text("❌ Активная рассылка с таким номером не найдена")
+
+# ==================== ОТЛОЖЕННЫЕ ЗАДАЧИ ====================
+
+def sqlite_timestamp(value: str) -> int:
+    """CURRENT_TIMESTAMP из SQLite (UTC) в unix-время"""
+    return int(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+def next_nightly_run(now: float) -> int:
+    """Ближайшие NIGHTLY_HOUR:00 по местному времени после now"""
+    moment = datetime.fromtimestamp(now)
+    run = moment.replace(hour=NIGHTLY_HOUR, minute=0, second=0, microsecond=0)
+    if run <= moment:
+        run += timedelta(days=1)
+    return int(run.timestamp())
+
+class JobScheduler:
+    """Задачи со сроком выполнения из таблицы jobs.
+
+    Сроки хранятся в SQLite с индексом по due_at, поэтому задачи переживают
+    перезапуск. Цикл не опрашивает таблицу: он выбирает наступившие задачи и
+    спит до MIN(due_at). Новая задача (schedule_job) будит его через
+    уведомление об изменении таблицы jobs - вдруг ее срок раньше текущего сна.
+
+    Обработчик вида задачи получает (bot, key, now) и возвращает следующий
+    срок или None, если задача выполнена. Исключение - повтор с удвоением
+    паузы, после max_attempts задача снимается. Ошибки чтения и обновления
+    jobs логируются, цикл продолжается после паузы error_delay.
+    """
+
+    def __init__(self, database: AsyncDatabase, batch_size: int = 50, max_attempts: int = 5,
+                 retry_delay: int = 60, error_delay: float = 5):
+        self.database = database
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Пауза после ошибки самого планировщика (чтение или обновление jobs)
+        self.error_delay = error_delay
+        self.bot = None
+        self._handlers: Dict[str, Callable] = {}
+        self._nightly: Dict[str, Callable] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.executed = 0
+        self.failed = 0
+        self.job("nightly")(self._run_nightly)
+
+    def job(self, kind: str):
+        """Декоратор обработчика задач вида kind"""
+        def decorator(handler):
+            latency = metrics.histogram("bot_job_duration_seconds", "Время выполнения отложенной задачи", kind=kind)
+            errors = metrics.counter("bot_job_errors_total", "Ошибки отложенных задач", kind=kind)
+            self._handlers[kind] = (handler, latency, errors)
+            return handler
+        return decorator
+
+    def nightly(self, name: str):
+        """Декоратор ежедневной задачи: handler(bot), запуск в NIGHTLY_HOUR"""
+        def decorator(handler):
+            self._nightly[name] = handler
+            return handler
+        return decorator
+
+    async def _run_nightly(self, bot, name: str, now: int) -> Optional[int]:
+        handler = self._nightly.get(name)
+        if handler is None:
+            return None
+        await handler(bot)
+        return next_nightly_run(now)
+
+    async def start(self, bot):
+        self.bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        first_run = next_nightly_run(time.time())
+        for name in self._nightly:
+            await self.database.schedule_job("nightly", name, first_run, replace=False)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def on_table_change(self, table: str):
+        # Вызывается из потока пула AsyncDatabase
+        if table == "jobs" and self._task:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._run_pass()
+            except Exception:
+                # Ошибка SQLite (например, database is locked после всех повторов) не должна
+                # останавливать напоминания, закрытие заявок и ночные задачи
+                logger.exception(f"Ошибка планировщика задач, повтор через {self.error_delay} с")
+                await asyncio.sleep(self.error_delay)
+
+    async def _run_pass(self):
+        """Наступившие задачи, затем сон до ближайшего срока или нового планирования"""
+        self._wakeup.clear()
+        now = int(time.time())
+        jobs = await self.database.get_due_jobs(now, self.batch_size)
+        stored = [await self._execute(job, now) for job in jobs]
+        if not all(stored):
+            # Строка задачи осталась с наступившим сроком - не крутиться на ней без паузы
+            await asyncio.sleep(self.error_delay)
+            return
+        if len(jobs) == self.batch_size:
+            return
+        next_due = await self.database.get_next_job_due()
+        timeout = None if next_due is None else max(0, next_due - time.time())
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _execute(self, job: Dict, now: int) -> bool:
+        """Выполнение задачи; False - не удалось обновить ее строку в jobs"""
+        kind, key = job['kind'], job['key']
+        attempts = 0
+        if kind in self._handlers:
+            next_due, attempts = await self._call(job, now)
+        else:
+            logger.warning(f"Неизвестный вид отложенной задачи {kind}:{key}, задача снята")
+            next_due = None
+        try:
+            if next_due is None:
+                await self.database.delete_job(kind, key)
+            else:
+                await self.database.reschedule_job(kind, key, next_due, attempts)
+        except Exception:
+            logger.exception(f"Не удалось обновить задачу {kind}:{key}")
+            return False
+        return True
+
+    async def _call(self, job: Dict, now: int) -> tuple:
+        """Вызов обработчика: (следующий срок или None, число неудачных попыток подряд)"""
+        kind, key = job['kind'], job['key']
+        handler, latency, errors = self._handlers[kind]
+        started = time.perf_counter()
+        try:
+            next_due = await handler(self.bot, key, now)
+        except Exception as e:
+            errors.inc()
+            self.failed += 1
+            attempts = job['attempts'] + 1
+            if attempts < self.max_attempts:
+                logger.warning(f"Задача {kind}:{key} не выполнена (попытка {attempts}): {e}")
+                return now + self.retry_delay * 2 ** (attempts - 1), attempts
+            if kind == "nightly":
+                logger.error(f"Ночная задача {key} не выполнена за {attempts} попыток: {e}")
+                return next_nightly_run(now), 0
+            logger.error(f"Задача {kind}:{key} снята после {attempts} неудачных попыток: {e}")
+            return None, 0
+        finally:
+            latency.observe(time.perf_counter() - started)
+        self.executed += 1
+        return next_due, 0
+
+job_scheduler = JobScheduler(async_db)
+db.add_change_listener(job_scheduler.on_table_change)
+
+JOB_NAMES = {
+    "info_reminder": "⏰ Напоминания о запросах информации",
+    "moderation_expiry": "⌛ Закрытие просроченных заявок",
+    "nightly": "🌙 Ночные задачи",
+    "wal_checkpoint": "🗄 Чекпоинт WAL",
+}
+
+@job_scheduler.job("info_reminder")
+async def remind_info_request(bot, key: str, now: int) -> Optional[int]:
+    """Напоминание автору каждые INFO_REMINDER_DELAY, после INFO_REMINDER_LIMIT запрос закрывается"""
+    request = await async_db.get_info_request_by_id(int(key))
+    if not request or request['status'] != "pending":
+        return None
+    created = sqlite_timestamp(request['created_at'])
+    reminders = (now - created) // INFO_REMINDER_DELAY
+    try:
+        if reminders <= INFO_REMINDER_LIMIT:
+            await bot.send_message(
+                request['user_id'],
+                f"⏰ Напоминаем: администратор ждет дополнительную информацию по заявке "
+                f"#{request['request_id']}:\n\n{request['request_text']}",
+                reply_markup=get_provide_info_keyboard(request['request_id'], request['request_type'])
+            )
+            return created + (reminders + 1) * INFO_REMINDER_DELAY
+    except Forbidden:
+        # Пользователь заблокировал бота - ответа не будет
+        pass
+    await async_db.close_info_request(request['id'], 'expired')
+    try:
+        await bot.send_message(
+            request['admin_id'],
+            f"⌛ Запрос информации по заявке #{request['request_id']} закрыт: пользователь не ответил"
+        )
+    except TelegramError as e:
+        logger.warning(f"Не удалось уведомить {request['admin_id']} о закрытии запроса #{request['id']}: {e}")
+    return None
+
+@job_scheduler.job("moderation_expiry")
+async def expire_moderation_item(bot, key: str, now: int) -> Optional[int]:
+    """Заявка без решения за PENDING_EXPIRY закрывается со статусом expired"""
+    table, _, item_id = key.partition(":")
+    item = await async_db.get_moderation_item(table, int(item_id))
+    if not item or item['status'] != "pending":
+        return None
+    queue = MODERATION_QUEUE_BY_TABLE[table]
+    [result] = await async_db.moderate_items(table, [(item['id'], item['version'])], "expired", 0, f"expire_{queue}")
+    if result['result'] == "done":
+        logger.info(f"Заявка {queue} #{item['id']} закрыта по сроку")
+        await notify_moderation_result(bot, queue, "expired", result['item'])
+    return None
+
+@job_scheduler.nightly("moderation_digest")
+async def send_moderation_digest(bot):
+    """Сводка администраторам: заявки, ждущие решения дольше ESCALATION_AGE"""
+    stale = await async_db.get_stale_pending_counts(ESCALATION_AGE)
+    if not any(stale.values()):
+        return
+    lines = [f"⏳ Заявки без решения дольше {ESCALATION_AGE // 86400} дн.", ""]
+    for queue, (table, title, _) in MODERATION_QUEUES.items():
+        if stale[table]:
+            lines.append(f"{title}: {stale[table]}")
+    lines += ["", f"Через {PENDING_EXPIRY // 86400} дн. без решения заявка закрывается автоматически. /moderation"]
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(admin_id, "\n".join(lines))
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить сводку модерации {admin_id}: {e}")
+
+# ==================== ОБСЛУЖИВАНИЕ БАЗЫ ====================
+
+class DatabaseMaintenance:
+    """Обслуживание scam_bot.db задачами JobScheduler.
+
+    Ночью логи старше срока хранения выгружаются в сжатые архивы и удаляются,
+    освободившиеся страницы возвращаются ОС (incremental_vacuum), FTS-индексы
+    сливаются, PRAGMA optimize обновляет статистику, WAL усекается. Днем WAL
+    переносится в базу каждые WAL_CHECKPOINT_INTERVAL, но только когда бот
+    простаивает QUIET_PERIOD: под нагрузкой хватает автоматического чекпоинта SQLite.
+    """
+
+    def __init__(self, database: AsyncDatabase, archive_dir: str, retention_days: int):
+        self.database = database
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.processor = None
+        self.last_report: Optional[Dict] = None
+        self.checkpoints = 0
+        self.deferred_checkpoints = 0
+
+    async def start(self, application: Application):
+        if isinstance(application.update_processor, PerUserUpdateProcessor):
+            self.processor = application.update_processor
+        await self.database.schedule_job("wal_checkpoint", "main", int(time.time()) + WAL_CHECKPOINT_INTERVAL,
+                                         replace=False)
+
+    def is_quiet(self) -> bool:
+        if self.processor is None:
+            return True
+        return self.processor.in_flight == 0 and time.monotonic() - self.processor.last_activity >= QUIET_PERIOD
+
+    async def checkpoint(self) -> tuple:
+        busy, wal_pages, moved = await self.database.checkpoint_wal('TRUNCATE')
+        self.checkpoints += 1
+        if busy:
+            logger.info(f"Чекпоинт WAL не завершен: перенесено {moved} из {wal_pages} страниц")
+        return busy, wal_pages, moved
+
+    async def archive_logs(self) -> Dict[str, int]:
+        if not self.retention_days:
+            return {}
+        os.makedirs(self.archive_dir, exist_ok=True)
+        now = datetime.now(timezone.utc)
+        cutoff = (now - timedelta(days=self.retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+        archived = {}
+        for table, column in LOG_TABLES.items():
+            path = os.path.join(self.archive_dir, f"{table}-{now:%Y-%m}.jsonl.gz")
+            archived[table] = await self.database.archive_logs(table, column, cutoff, path)
+            if archived[table]:
+                log_rows_archived_total[table].inc(archived[table])
+        return archived
+
+    async def run(self) -> Dict:
+        """Полное обслуживание, отчет сохраняется в last_report"""
+        started = time.perf_counter()
+        report = {'started_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        report['before'] = await self.database.database_sizes()
+        report['archived'] = await self.archive_logs()
+        report['freed_pages'] = await self.database.incremental_vacuum()
+        report['fts'] = await self.database.optimize_search_indexes()
+        await self.database.optimize()
+        report['checkpoint'] = await self.checkpoint()
+        report['after'] = await self.database.database_sizes()
+        report['duration'] = time.perf_counter() - started
+        self.last_report = report
+        logger.info(format_maintenance_report(report).replace("\n", "; "))
+        return report
+
+log_rows_archived_total = {
+    table: metrics.counter("bot_log_rows_archived_total", "Строки логов, выгруженные в архив", table=table)
+    for table in LOG_TABLES
+}
+
+db_maintenance = DatabaseMaintenance(async_db, LOG_ARCHIVE_DIR, LOG_RETENTION_DAYS)
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+def format_maintenance_report(report: Dict) -> str:
+    before, after = report['before'], report['after']
+    archived = ", ".join(f"{table} {rows}" for table, rows in report['archived'].items()) or "срок хранения не задан"
+    busy = report['checkpoint'][0]
+    return "\n".join([
+        f"🧹 Обслуживание базы {report['started_at']} ({report['duration']:.1f} с)",
+        f"В архив выгружено строк: {archived}",
+        f"База: {format_size(before['file'])} → {format_size(after['file'])}",
+        f"WAL: {format_size(before['wal'])} → {format_size(after['wal'])}" + (" (мешали читатели)" if busy else ""),
+        f"Свободно внутри файла: {format_size(before['free'])} → {format_size(after['free'])}",
+    ])
+
+@job_scheduler.nightly("maintenance")
+async def run_maintenance(bot):
+    await db_maintenance.run()
+
+@job_scheduler.job("wal_checkpoint")
+async def checkpoint_wal(bot, key: str, now: int) -> Optional[int]:
+    if not db_maintenance.is_quiet():
+        db_maintenance.deferred_checkpoints += 1
+        return now + QUIET_PERIOD
+    await db_maintenance.checkpoint()
+    return now + WAL_CHECKPOINT_INTERVAL
+
+@secure_handler
+async def show_maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    if context.args == ["run"]:
+        await update.message.reply_text("🧹 Обслуживание запущено...")
+        await async_db.log_action(update.effective_user.id, "maintenance")
+        await update.message.reply_text(format_maintenance_report(await db_maintenance.run()))
+        return
+
+    sizes = await async_db.database_sizes()
+    lines = [
+        f"🗄 База: {format_size(sizes['file'])}, WAL: {format_size(sizes['wal'])}, "
+        f"свободно: {format_size(sizes['free'])}",
+        f"Чекпоинтов WAL: {db_maintenance.checkpoints}, отложено из-за нагрузки: {db_maintenance.deferred_checkpoints}",
+        f"Срок хранения логов: {LOG_RETENTION_DAYS or '∞'} дн., архив: {LOG_ARCHIVE_DIR}",
+    ]
+    if db_maintenance.last_report:
+        lines += ["", format_maintenance_report(db_maintenance.last_report)]
+    lines += ["", "Запустить сейчас: /maintenance run"]
+    await update.message.reply_text("\n".join(lines))
+
+# ==================== ОБРАБОТКА ОБНОВЛЕНИЙ ====================
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя выполняются строго по очереди, поэтому
+    шаги ConversationHandler (APPLICATION_ACTIVITY -> APPLICATION_CITY ...)
+    не гоняются между собой. Общий лимит параллельности задает
+    max_concurrent_updates: его соблюдает process_update из PTB, а очередь
+    пользователя берется уже внутри слота. Ожидающее обновление пользователя
+    занимает слот, поэтому лимит выбирается с запасом на такие ожидания.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # ключ -> [замок, число обновлений в работе или ожидании]
+        self._user_locks: Dict[int, list] = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.processed = 0
+        # Обновления в слотах, ждущие своей очереди пользователя
+        self.waiting = 0
+        # Время завершения последнего обновления: по нему DatabaseMaintenance ищет затишье
+        self.last_activity = time.monotonic()
+
+    @staticmethod
+    def ordering_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Семафор PTB и asyncio.Lock пропускают ожидающих в порядке FIFO, а задачи
+            # на обновления создаются в порядке поступления - порядок пользователя сохраняется
+            self.waiting += 1
+            try:
+                await entry[0].acquire()
+            finally:
+                self.waiting -= 1
+            try:
+                await self._run(coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def _run(self, coroutine) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+            self.processed += 1
+            self.last_activity = time.monotonic()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.max_concurrent_updates,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'users': len(self._user_locks),
+            'processed': self.processed,
+            'waiting': self.waiting,
+        }
+
+# ==================== WEBHOOK ====================
+
+class HttpRequest:
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+class HttpServer:
+    """Минимальный HTTP/1.1 сервер на asyncio: webhook Telegram и служебные эндпоинты.
+
+    Одновременно выполняется не больше max_concurrency обработчиков запросов,
+    сверх лимита сразу отвечаем 503. Обработчик webhook только ставит
+    обновление в очередь, поэтому отставание бота ограничивает не этот лимит,
+    а WebhookReceiver.max_pending.
+    """
+
+    def __init__(self, host: str, port: int, max_concurrency: int = 100,
+                 max_body_size: int = 1 << 20, read_timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        self.read_timeout = read_timeout
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.rejected = 0
+        self._routes: Dict[tuple, Callable] = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler: Callable):
+        """handler(request) -> (status, content_type, body)"""
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+                if request is None:
+                    break
+                status, content_type, body = await self._dispatch(request)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[HttpRequest]:
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body_size:
+            raise ValueError("request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return HttpRequest(method, target.split('?', 1)[0], headers, body)
+
+    async def _dispatch(self, request: HttpRequest) -> tuple:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self._routes)
+            return (405 if known_path else 404), "text/plain", b""
+        if self.in_flight >= self.max_concurrency:
+            self.rejected += 1
+            return 503, "text/plain", b"busy"
+        self.in_flight += 1
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+class WebhookReceiver:
+    """Принимает обновления от Telegram и кладет их в очередь Application.
+
+    Если принятых, но еще не обработанных обновлений больше max_pending,
+    отвечаем 503: Telegram повторит доставку, а бот не копит отставание без
+    предела.
+    """
+
+    def __init__(self, application: Application, secret: str = '', max_pending: int = 500):
+        self.application = application
+        self.secret = secret.encode()
+        self.max_pending = max_pending
+        self.received = 0
+        self.rejected = 0
+
+    def backlog(self) -> int:
+        processor = self.application.update_processor
+        if isinstance(processor, PerUserUpdateProcessor):
+            # Учитывает и задачи, которые Application уже забрал из очереди,
+            # но которые ждут слота параллельности
+            return max(0, self.received - processor.processed)
+        return self.application.update_queue.qsize()
+
+    async def handle_update(self, request: HttpRequest) -> tuple:
+        if self.secret:
+            token = request.headers.get('x-telegram-bot-api-secret-token', '').encode('latin-1')
+            if not secrets.compare_digest(token, self.secret):
+                return 403, "text/plain", b""
+        if self.backlog() >= self.max_pending:
+            self.rejected += 1
+            return 503, "text/plain", b"busy"
+        try:
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError(f"ожидался объект, получено {type(data).__name__}")
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return 400, "text/plain", b""
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return 200, "text/plain", b""
+
+    async def handle_health(self, request: HttpRequest) -> tuple:
+        body = json.dumps({
+            'status': 'ok',
+            'updates_received': self.received,
+            'update_queue': self.application.update_queue.qsize(),
+            'backlog': self.backlog(),
+        })
+        return 200, "application/json", body.encode()
+
+def build_webhook_server(application: Application, host: str, port: int, secret: str) -> tuple:
+    """HTTP сервер с маршрутами webhook: (server, receiver)"""
+    receiver = WebhookReceiver(application, secret, WEBHOOK_MAX_PENDING)
+    server = HttpServer(host, port, max_concurrency=WEBHOOK_MAX_CONCURRENCY)
+    server.route("POST", WEBHOOK_PATH, receiver.handle_update)
+    server.route("GET", "/healthz", receiver.handle_health)
+    metrics.gauge("bot_webhook_in_flight", "Запросы webhook в обработке", lambda: server.in_flight)
+    metrics.gauge("bot_webhook_rejected", "Запросы webhook, отклоненные с 503",
+                  lambda: server.rejected + receiver.rejected)
+    metrics.gauge("bot_webhook_backlog", "Принятые через webhook и еще не обработанные обновления",
+                  receiver.backlog)
+    metrics.gauge("bot_webhook_updates_received", "Обновления, принятые через webhook", lambda: receiver.received)
+    return server, receiver
+
+async def run_webhook(application: Application):
+    """Запуск в режиме webhook: собственный HTTP сервер вместо long polling"""
+    listen = WEBHOOK_LISTEN
+    if not WEBHOOK_SECRET:
+        # Без секрета любой, кто достучится до порта, может прислать обновление от имени администратора
+        if WEBHOOK_URL:
+            raise ValueError("WEBHOOK_SECRET environment variable is required when WEBHOOK_URL is set")
+        logger.warning("WEBHOOK_SECRET не задан: webhook слушает только 127.0.0.1")
+        listen = "127.0.0.1"
+    server, receiver = build_webhook_server(application, listen, WEBHOOK_PORT, WEBHOOK_SECRET)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # post_init/post_shutdown вызывает только run_polling/run_webhook, здесь - вручную
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+            )
+            logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL не задан: webhook не регистрируется, ожидаются локальные запросы")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ==================== ЭКСПОРТ МЕТРИК ====================
+
+def register_runtime_metrics(application: Application):
+    """Gauge-метрики состояния: читаются в момент запроса /metrics"""
+    metrics.gauge("bot_update_queue_size", "Обновления, ожидающие в очереди Application",
+                  application.update_queue.qsize)
+    metrics.gauge("bot_write_buffer_depth", "Строки в очереди отложенной записи",
+                  lambda: db.write_buffer.stats()['depth'])
+    metrics.gauge("bot_write_buffer_dropped", "Строки, потерянные при переполнении отложенной записи",
+                  lambda: db.write_buffer.stats()['dropped_rows'])
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        metrics.gauge("bot_updates_in_flight", "Обновления в обработке", lambda: processor.in_flight)
+        metrics.gauge("bot_update_user_queues", "Пользователи с обновлениями в очереди",
+                      lambda: len(processor._user_locks))
+    for name, cache in (("lists", list_page_cache), ("moderation", moderation_cache), ("inline", inline_cache)):
+        metrics.gauge("bot_cache_entries", "Записей в кэше", lambda cache=cache: cache.stats()['entries'], cache=name)
+        metrics.gauge("bot_cache_hits", "Попадания в кэш", lambda cache=cache: cache.hits, cache=name)
+        metrics.gauge("bot_cache_misses", "Промахи кэша", lambda cache=cache: cache.misses, cache=name)
+    metrics.gauge("bot_callback_stale", "Нажатия устаревших inline-кнопок", lambda: callback_router.stale)
+    metrics.gauge("bot_db_file_bytes", "Размер файла базы", lambda: file_size(db.db_path))
+    metrics.gauge("bot_db_wal_bytes", "Размер WAL", lambda: file_size(db.db_path + '-wal'))
+
+async def handle_metrics_request(request: HttpRequest) -> tuple:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+
+# Отдельный сервер на локальном интерфейсе: метрики не должны быть видны снаружи вместе с webhook
+metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT, max_concurrency=4)
+metrics_server.route("GET", "/metrics", handle_metrics_request)
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return
+    try:
+        await metrics_server.start()
+    except OSError as e:
+        logger.warning(f"Сервер метрик не запущен ({METRICS_LISTEN}:{METRICS_PORT}): {e}")
+
+def format_histogram_line(name: str, histogram: Histogram) -> str:
+    return (f"{name}: {histogram.count}, {histogram.quantile(0.5) * 1000:g} / "
+            f"{histogram.quantile(0.95) * 1000:g} мс")
+
+def format_metrics_summary(limit: int = 10) -> str:
+    lines = ["📈 Метрики", "", "⏱ Обработчики: вызовов, p50 / p95"]
+    handlers = sorted(metrics.family("bot_handler_duration_seconds").items(),
+                      key=lambda item: item[1].count, reverse=True)
+    errors = {key: counter.value for key, counter in metrics.family("bot_handler_errors_total").items()}
+    for key, histogram in handlers[:limit]:
+        if histogram.count:
+            line = format_histogram_line(dict(key)['handler'], histogram)
+            if errors.get(key):
+                line += f", ошибок {errors[key]}"
+            lines.append(line)
+    
+    lines += ["", "🗄 SQL: запросов, p50 / p95"]
+    for key, histogram in sorted(metrics.family("bot_db_query_duration_seconds").items()):
+        if histogram.count:
+            lines.append(format_histogram_line(dict(key)['op'], histogram))
+    slowest = sorted(metrics.family("bot_db_call_duration_seconds").items(),
+                     key=lambda item: item[1].quantile(0.95), reverse=True)
+    if slowest:
+        lines.append("Медленные методы БД (p95):")
+        lines += [format_histogram_line(dict(key)['method'], histogram) for key, histogram in slowest[:5]]
+    
+    lines += [
+        "",
+        f"🚫 Отклонено: флуд {rate_limited_total.value}, проверка ввода {input_rejected_total.value}",
+        f"🔁 Повторы после блокировки БД: {db_lock_retries_total.value}",
+    ]
+    if METRICS_PORT:
+        lines.append(f"\nПолный набор: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return "\n".join(lines)
+
+@secure_handler
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    await update.message.reply_text(format_metrics_summary())
+
+# ==================== ЗАПУСК БОТА ====================
+
+async def on_startup(application: Application):
+    await broadcast_engine.start(application.bot)
+    await job_scheduler.start(application.bot)
+    await db_maintenance.start(application)
+    register_runtime_metrics(application)
+    await start_metrics_server()
+
+async def on_shutdown(application: Application):
+    await broadcast_engine.stop()
+    await job_scheduler.stop()
+    await metrics_server.stop()
+    security_manager.flush_events()
+    async_db.shutdown()
+
+def build_application(token: str, base_url: str = None, updater: bool = True) -> Application:
+    """Application со всеми обработчиками.
+
+    base_url - адрес Bot API вместо api.telegram.org (нагрузочный тест подставляет
+    локальную заглушку), updater=False - обновления кладутся в update_queue извне.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence(db))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # ConversationHandler для заявки в белый список
     white_list_conv = ConversationHandler(
@@ -974,10 +4733,13 @@ def main():
             APPLICATION_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_city)],
             APPLICATION_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_link)],
             APPLICATION_DESC: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_description)],
-            APPLICATION_PROOFS: [MessageHandler(filters.TEXT | filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO, process_proofs)],
+            APPLICATION_PROOFS: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.ATTACHMENT, process_proofs)],
             APPLICATION_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, finish_white_application)]
         },
-        fallbacks=[MessageHandler(filters.Regex("^❌ Отменить$"), cancel_application), CommandHandler("cancel", cancel_application)]
+        fallbacks=[MessageHandler(filters.Regex("^❌ Отменить$"), cancel_application), CommandHandler("cancel", cancel_application)],
+        # Недозаполненная заявка переживает перезапуск бота
+        name="white_list_application",
+        persistent=True
     )
     
     # Остальные ConversationHandlers без изменений...
@@ -985,22 +4747,51 @@ def main():
     # Основные обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("check", check_username))
+    application.add_handler(CommandHandler("search", search_lists))
+    application.add_handler(CommandHandler("cache", show_cache_stats))
+    application.add_handler(CommandHandler("queues", show_queue_stats))
+    application.add_handler(CommandHandler("metrics", show_metrics))
+    application.add_handler(CommandHandler("maintenance", show_maintenance))
+    application.add_handler(CommandHandler("security", show_security_summary))
+    application.add_handler(CommandHandler("broadcast", start_broadcast))
+    application.add_handler(CommandHandler("broadcast_status", show_broadcast_status))
+    application.add_handler(CommandHandler("broadcast_cancel", cancel_broadcast))
     
     application.add_handler(MessageHandler(filters.Regex("^🟩 Белый список$"), show_white_list))
     application.add_handler(MessageHandler(filters.Regex("^🟥 Список скамеров$"), show_scam_list))
     application.add_handler(MessageHandler(filters.Regex("^📜 Правила подачи заявок$"), show_rules))
     application.add_handler(MessageHandler(filters.Regex("^ℹ️ О проекте$"), show_about))
+    application.add_handler(MessageHandler(filters.Regex("^📋 Управление заявками$"), show_moderation_menu))
+    application.add_handler(MessageHandler(filters.Regex("^📊 Статистика$"), show_statistics))
     
     # Добавление ConversationHandler
     application.add_handler(white_list_conv)
     # Добавьте остальные ConversationHandlers...
     
     # Обработчик callback запросов
+    application.add_handler(InlineQueryHandler(inline_check))
+    # Все inline-кнопки разбирает callback_router
     application.add_handler(CallbackQueryHandler(handle_callback))
     
+    # Ответы на запросы доп. информации - после остальных обработчиков сообщений
+    application.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.ATTACHMENT, receive_info_message))
+    return application
+
+def main():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не установлен. Установите переменную окружения BOT_TOKEN.")
+        return
+    
+    # В режиме webhook обновления приходят через собственный HTTP сервер, Updater не нужен
+    application = build_application(BOT_TOKEN, updater=BOT_MODE != "webhook")
+    
     # Запуск бота
-    logger.info("🛡️ Бот запущен с системой безопасности")
-    application.run_polling()
+    logger.info(f"🛡️ Бот запущен с системой безопасности (режим: {BOT_MODE})")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file